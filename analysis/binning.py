@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+'''
+Binning of photons into the pixels delimited by the stage markers.
+
+The stage sends a marker every trigger step, so consecutive markers
+delimit the pixels of a line. The photons in every pixel are counted
+with np.searchsorted over the sorted photon times, and the exposure
+of every pixel is the time between its markers. Markers that were
+missed or that came twice are detected from the expected spacing
+between markers and repaired before binning.
+'''
+
+import numpy as np
+
+def repair_markers(markers, period=None, expected=None, tol=0.5):
+    '''
+    Remove duplicated markers and fill in missing ones.
+
+    A marker that comes less than tol*period after the previous one is
+    taken as a duplicate and dropped, a gap of about k periods between
+    two markers is filled with k-1 evenly spaced markers.
+
+    Parameters
+    ----------
+    markers  (np.array): sorted marker times
+    period   (float): expected time between markers, if None
+                      the median time between markers is used.
+    expected (int): expected number of markers, if given markers
+                    are added after the last one or dropped
+                    from the end to match it.
+    tol      (float): fraction of a period
+
+    Returns
+    -------
+    markers (np.array): the repaired marker times
+    report  (dict): number of duplicates dropped, markers inserted
+                    in gaps, and markers added or dropped at the end.
+    '''
+    markers = np.asarray(markers, dtype=np.int64)
+    report = {'duplicates': 0, 'inserted': 0, 'appended': 0, 'truncated': 0}
+    if len(markers) < 2:
+        return markers, report
+    if period is None:
+        period = np.median(np.diff(markers))
+    # drop markers too close to the last kept one
+    keep = np.ones(len(markers), dtype=bool)
+    gaps = np.diff(markers)
+    if np.any(gaps < tol * period):
+        last = markers[0]
+        for i in range(1, len(markers)):
+            if markers[i] - last < tol * period:
+                keep[i] = False
+            else:
+                last = markers[i]
+        report['duplicates'] = int((~keep).sum())
+        markers = markers[keep]
+        gaps = np.diff(markers)
+    # fill gaps of several periods
+    steps = np.maximum(np.round(gaps / period).astype(np.int64), 1)
+    if np.any(steps > 1):
+        fractions = np.concatenate([np.arange(k) / k for k in steps])
+        starts = np.repeat(markers[:-1], steps)
+        widths = np.repeat(gaps, steps)
+        markers = np.append(starts + np.round(fractions * widths).astype(np.int64),
+                            markers[-1])
+        report['inserted'] = int((steps - 1).sum())
+    if expected is not None:
+        if len(markers) < expected:
+            missing = expected - len(markers)
+            extra = markers[-1] + np.round(period * np.arange(1, missing + 1)).astype(np.int64)
+            markers = np.append(markers, extra)
+            report['appended'] = int(missing)
+        elif len(markers) > expected:
+            report['truncated'] = int(len(markers) - expected)
+            markers = markers[:expected]
+    return markers, report
+
+def bin_photons(times, boundaries):
+    '''
+    Number of photons in every pixel, the pixel i going
+    from boundaries[i] to boundaries[i+1].
+
+    Parameters
+    ----------
+    times      (np.array): sorted photon times
+    boundaries (np.array): sorted times of the pixel boundaries
+
+    Returns
+    -------
+    counts (np.array): of length len(boundaries) - 1
+    '''
+    return np.diff(np.searchsorted(times, boundaries, side='left'))
+
+def bin_markers(times, markers, expected=None, period=None,
+                time_unit=None, dwell_time=None, repair=True, lag=0.):
+    '''
+    Counts, exposure, and rate in the pixels delimited by the markers.
+
+    The exposure is given in seconds either with time_unit, the
+    duration of one unit of the times (e.g. the sync period
+    for truensyncs), or with dwell_time, the nominal exposure of a
+    pixel, which is then taken to correspond to the period
+    between markers.
+
+    Parameters
+    ----------
+    times      (np.array): sorted photon times
+    markers    (np.array): sorted marker times
+    expected   (int): expected number of markers
+    period     (float): expected time between markers, if None
+                        the median time between markers is used.
+    time_unit  (float): in s
+    dwell_time (float): in s
+    repair     (bool): if True, missing or duplicate markers are repaired.
+    lag        (float): in s, the markers are moved this much later, e.g. to
+                        account for the delay between the stage trigger and
+                        the actual position of the stage.
+
+    Returns
+    -------
+    binned (dict): with keys counts, exposure (s), rate (Hz),
+                   boundaries, repair (the report of repair_markers),
+                   and measured, True for the boundaries that are
+                   markers that were received, not inserted or appended.
+    '''
+    markers = np.asarray(markers, dtype=np.int64)
+    if period is None and len(markers) > 1:
+        period = np.median(np.diff(markers))
+    if repair:
+        received = markers
+        markers, report = repair_markers(markers, period, expected)
+        measured = np.isin(markers, received)
+    else:
+        report = None
+        measured = np.ones(len(markers), dtype=bool)
+    if lag:
+        if time_unit is not None:
+            markers = markers + int(round(lag / time_unit))
+        elif dwell_time is not None and period:
+            markers = markers + int(round(lag / dwell_time * period))
+    counts = bin_photons(times, markers)
+    intervals = np.diff(markers).astype(float)
+    if time_unit is not None:
+        exposure = intervals * time_unit
+    elif dwell_time is not None and period:
+        exposure = intervals / period * dwell_time
+    else:
+        exposure = intervals
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = counts / exposure
+    return {'counts': counts,
+            'exposure': exposure,
+            'rate': rate,
+            'boundaries': markers,
+            'repair': report,
+            'measured': measured}
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+'''
+Photon correlations from time-tagged data.
+
+All functions take sorted arrays of integer photon arrival times, all of
+them in the same units (e.g. the 4 ps of T2 truetimes), and lags and
+bin widths are given in those same units. Pairs of photons are found with
+np.searchsorted over the sorted arrival times, so that the cost grows
+with the number of photons and the number of pairs inside the lag window
+instead of with the square of the number of photons.
+'''
+
+import numpy as np
+
+def channel_times(events, channel):
+    '''
+    Arrival times of the photons in the given channel.
+
+    Parameters
+    ----------
+    events  (np.array): decoded T2 events with columns channel, truetime,
+                        as given by zialab.instruments.tttr.decode_t2
+    channel (int)
+
+    Returns
+    -------
+    times (np.array): sorted arrival times of the channel
+    '''
+    return events[events[:, 0] == channel, 1]
+
+def lag_edges(max_lag, bin_width):
+    '''
+    Bin edges for a histogram of delays in [-max_lag, max_lag),
+    with an edge at zero lag. max_lag is rounded up to
+    a whole number of bins.
+    '''
+    half_bins = int(np.ceil(max_lag / bin_width))
+    return np.arange(-half_bins, half_bins + 1, dtype=np.int64) * bin_width
+
+def _pairs(t_a, t_b, max_lag):
+    # indices of all the pairs with t_b - t_a in [-max_lag, max_lag)
+    lo = np.searchsorted(t_b, t_a - max_lag, side='left')
+    hi = np.searchsorted(t_b, t_a + max_lag, side='left')
+    num_pairs = hi - lo
+    total = int(num_pairs.sum())
+    owner = np.repeat(np.arange(len(t_a)), num_pairs)
+    starts = np.cumsum(num_pairs) - num_pairs
+    partner = lo[owner] + np.arange(total) - starts[owner]
+    return owner, partner
+
+def pair_delays(t_a, t_b, max_lag, self_offset=None):
+    '''
+    Delays t_b - t_a of all the pairs of photons with
+    delays in [-max_lag, max_lag).
+
+    Parameters
+    ----------
+    t_a, t_b    (np.array): sorted arrival times
+    max_lag     (int)
+    self_offset (int): if t_a is a slice of t_b starting at index
+                       self_offset, the pairs of a photon with
+                       itself are skipped.
+
+    Returns
+    -------
+    delays (np.array)
+    '''
+    owner, partner = _pairs(t_a, t_b, max_lag)
+    if self_offset is not None:
+        keep = (partner != owner + self_offset)
+        owner, partner = owner[keep], partner[keep]
+    return t_b[partner] - t_a[owner]
+
+def _histogram(delays, edges):
+    bin_width = edges[1] - edges[0]
+    idx = (delays - edges[0]) // bin_width
+    idx = idx[(idx >= 0) & (idx < len(edges) - 1)]
+    return np.bincount(idx, minlength=len(edges) - 1)
+
+def cross_correlation(t_a, t_b, max_lag, bin_width, chunk_size=1000000):
+    '''
+    Histogram of the delays t_b - t_a between all pairs of photons,
+    for delays in [-max_lag, max_lag).
+
+    If t_a and t_b are the same array the autocorrelation is computed,
+    and photons are not paired with themselves.
+
+    Parameters
+    ----------
+    t_a, t_b   (np.array): sorted arrival times
+    max_lag    (int): largest delay
+    bin_width  (int): width of the histogram bins
+    chunk_size (int): photons of t_a paired at once, bounds the memory used.
+
+    Returns
+    -------
+    lags   (np.array): centers of the bins
+    counts (np.array): number of pairs in every bin
+    '''
+    edges = lag_edges(max_lag, bin_width)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    autocorr = t_a is t_b
+    t_a = np.asarray(t_a)
+    t_b = np.asarray(t_b)
+    for start in range(0, len(t_a), chunk_size):
+        delays = pair_delays(t_a[start:start + chunk_size], t_b, edges[-1],
+                             self_offset=start if autocorr else None)
+        counts += _histogram(delays, edges)
+    return (edges[:-1] + edges[1:]) / 2, counts
+
+def start_stop(t_start, t_stop, max_lag, bin_width):
+    '''
+    Start-stop histogram, as measured with a TCSPC card in histogram
+    mode: every stop photon is paired with the last start photon
+    that preceded it, provided no other stop came in between.
+
+    For a low detection efficiency this approximates the
+    positive half of cross_correlation.
+
+    Parameters
+    ----------
+    t_start, t_stop (np.array): sorted arrival times
+    max_lag   (int): largest delay
+    bin_width (int): width of the histogram bins
+
+    Returns
+    -------
+    lags   (np.array): centers of the bins
+    counts (np.array): number of start-stop pairs in every bin
+    '''
+    t_start = np.asarray(t_start)
+    t_stop = np.asarray(t_stop)
+    num_bins = int(np.ceil(max_lag / bin_width))
+    edges = np.arange(num_bins + 1, dtype=np.int64) * bin_width
+    # the first stop after every start
+    nxt = np.searchsorted(t_stop, t_start, side='right')
+    valid = nxt < len(t_stop)
+    # a start only counts if it is the last one before its stop
+    valid[:-1] &= (nxt[:-1] != nxt[1:])
+    delays = t_stop[nxt[valid]] - t_start[valid]
+    return (edges[:-1] + edges[1:]) / 2, _histogram(delays, edges)
+
+def log_edges(min_lag, max_lag, bins_per_decade=10):
+    '''
+    Logarithmically spaced bin edges between min_lag and max_lag,
+    rounded to integers, and without repeated edges.
+    '''
+    num_decades = np.log10(max_lag / min_lag)
+    num_edges = int(np.ceil(num_decades * bins_per_decade)) + 1
+    edges = np.logspace(np.log10(min_lag), np.log10(max_lag), num_edges)
+    return np.unique(np.round(edges).astype(np.int64))
+
+def multi_tau(t_a, t_b, min_lag, max_lag, bins_per_decade=10, normalize=True):
+    '''
+    Correlation in logarithmically spaced lag bins, to cover
+    lags from the antibunching dip up to blinking time scales.
+
+    The number of pairs within every bin edge is counted with one
+    np.searchsorted over all the photons, so the cost only grows with
+    the number of bins and not with the number of pairs.
+
+    Parameters
+    ----------
+    t_a, t_b        (np.array): sorted arrival times
+    min_lag         (int): first bin edge, must be > 0
+    max_lag         (int): last bin edge
+    bins_per_decade (int)
+    normalize       (bool): if True the counts are divided by those
+                            of uncorrelated photons at the same rates,
+                            so that g2 tends to 1 at long lags.
+
+    Returns
+    -------
+    lags   (np.array): geometric centers of the bins
+    g2     (np.array): counts, or normalized correlation, in every bin
+    '''
+    t_a = np.asarray(t_a)
+    t_b = np.asarray(t_b)
+    edges = log_edges(min_lag, max_lag, bins_per_decade)
+    below = np.array([np.searchsorted(t_b, t_a + edge, side='left').sum()
+                      for edge in edges], dtype=np.int64)
+    counts = np.diff(below)
+    lags = np.sqrt(edges[:-1] * edges[1:])
+    if normalize:
+        duration = max(t_a[-1], t_b[-1]) - min(t_a[0], t_b[0])
+        return lags, normalize_counts(counts, np.diff(edges),
+                                      len(t_a), len(t_b), duration, lags)
+    return lags, counts
+
+def normalize_counts(counts, bin_widths, num_a, num_b, duration, lags=None):
+    '''
+    Divide the histogram of pair delays by the counts expected for
+    uncorrelated photons, num_a * num_b * bin_width / duration.
+
+    If lags are given the expected counts are reduced by the
+    fraction (duration - |lag|) / duration of the measurement in
+    which both photons of a pair can be recorded.
+    '''
+    expected = num_a * num_b * np.asarray(bin_widths, dtype=float) / duration
+    if lags is not None:
+        expected = expected * (1 - np.abs(lags) / duration)
+    return counts / expected
+
+def g2(events, max_lag, bin_width, channels=(0, 1), normalize=True):
+    '''
+    Second order correlation between two channels of decoded T2 data.
+
+    Parameters
+    ----------
+    events    (np.array): decoded T2 events with columns channel, truetime
+    max_lag   (int): largest delay, in units of the T2 resolution
+    bin_width (int): width of the histogram bins, in units of the T2 resolution
+    channels  (tuple): the start and stop channels
+    normalize (bool): if True the normalized g2 is returned
+                      instead of the counts.
+
+    Returns
+    -------
+    lags (np.array): centers of the bins
+    g2   (np.array)
+    '''
+    t_a = channel_times(events, channels[0])
+    t_b = channel_times(events, channels[1])
+    if channels[0] == channels[1]:
+        t_b = t_a
+    lags, counts = cross_correlation(t_a, t_b, max_lag, bin_width)
+    if normalize:
+        if len(t_a) == 0 or len(t_b) == 0:
+            # without photons there is nothing to normalize
+            return lags, counts.astype(float)
+        duration = max(events[-1, 1] - events[0, 1], 1)
+        return lags, normalize_counts(counts, bin_width,
+                                      len(t_a), len(t_b), duration, lags)
+    return lags, counts
+
+class CrossCorrelator():
+    '''
+    Accumulate the cross correlation of a stream of decoded T2 events
+    that arrives in chunks, e.g. from a T2Decoder fed by a FifoWorker,
+    for live antibunching checks.
+
+    The photons within max_lag of the end of every chunk are kept,
+    so that pairs straddling two chunks are also counted, and no pair
+    is counted twice.
+    '''
+
+    def __init__(self, max_lag, bin_width, channels=(0, 1)):
+        '''
+        Parameters
+        ----------
+        max_lag   (int): largest delay, in units of the T2 resolution
+        bin_width (int): width of the histogram bins
+        channels  (tuple): the two channels to correlate
+        '''
+        self.edges = lag_edges(max_lag, bin_width)
+        self.lags = (self.edges[:-1] + self.edges[1:]) / 2
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget all the photons seen so far.
+        '''
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.num_a = 0
+        self.num_b = 0
+        self.first_time = None
+        self.last_time = None
+        self._tail_a = np.zeros(0, dtype=np.int64)
+        self._tail_b = np.zeros(0, dtype=np.int64)
+
+    def add(self, events):
+        '''
+        Add a chunk of decoded T2 events, later than all the previous ones.
+        '''
+        if len(events) == 0:
+            return self.counts
+        max_lag = self.edges[-1]
+        new_a = channel_times(events, self.channels[0])
+        new_b = channel_times(events, self.channels[1])
+        all_b = np.concatenate((self._tail_b, new_b))
+        # pairs with a new photon in a, and pairs with an old photon in a
+        # and a new one in b, old photons only reach within max_lag
+        if self.channels[0] == self.channels[1]:
+            delays = pair_delays(new_a, all_b, max_lag, self_offset=len(self._tail_b))
+        else:
+            delays = pair_delays(new_a, all_b, max_lag)
+        self.counts += _histogram(delays, self.edges)
+        self.counts += _histogram(pair_delays(self._tail_a, new_b, max_lag), self.edges)
+        self.num_a += len(new_a)
+        self.num_b += len(new_b)
+        if self.first_time is None:
+            self.first_time = int(events[0, 1])
+        self.last_time = int(events[-1, 1])
+        cutoff = self.last_time - max_lag
+        all_a = np.concatenate((self._tail_a, new_a))
+        self._tail_a = all_a[np.searchsorted(all_a, cutoff):]
+        self._tail_b = all_b[np.searchsorted(all_b, cutoff):]
+        return self.counts
+
+    def g2(self):
+        '''
+        The normalized g2 of all the photons added so far.
+        '''
+        duration = max(self.last_time - self.first_time, 1)
+        return normalize_counts(self.counts, self.edges[1] - self.edges[0],
+                                self.num_a, self.num_b, duration, self.lags)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+'''
+Fluorescence-lifetime imaging from the T3 records of confocal scans.
+
+Every photon is assigned to the pixel given by the stage markers that
+bracket its truensync, and its dtime (the microtime, the delay with
+respect to the laser sync) is binned, giving a cube of
+pixel x microtime histograms from which lifetime maps are computed.
+
+All inputs are decoded T3 events as given by
+zialab.instruments.tttr.decode_t3, with columns
+channel, dtime, nsync, and truensync.
+'''
+
+import numpy as np
+
+PHOTON_CHANNELS = (0, 1, 2, 3) # the channels that are not special records
+DTIME_BINS = 4096 # number of possible dtimes of the PicoHarp 300
+
+def marker_times(events, marker=8):
+    '''
+    Truensyncs of the markers that have the given marker bit set.
+    '''
+    markers = (events[:, 0] == 0xF) & ((events[:, 1] & marker) != 0)
+    return events[markers, 3]
+
+def photons(events, channel=None):
+    '''
+    The events that are photons, in the given channel or in any channel.
+    '''
+    if channel is None:
+        return events[events[:, 0] != 0xF]
+    return events[events[:, 0] == channel]
+
+def bin_width(num_bins):
+    '''
+    Number of dtimes in each of num_bins microtime bins, which have
+    to split the DTIME_BINS dtimes of the PicoHarp evenly.
+    '''
+    if num_bins <= 0 or DTIME_BINS % num_bins != 0:
+        raise ValueError('num_bins has to divide %d, got %r.' % (DTIME_BINS, num_bins))
+    return DTIME_BINS // num_bins
+
+def assign_pixels(times, boundaries):
+    '''
+    Index of the pixel in which every time falls, the pixel i going
+    from boundaries[i] to boundaries[i+1]. Times outside of all
+    the pixels get -1.
+
+    Parameters
+    ----------
+    times      (np.array): sorted times
+    boundaries (np.array): sorted times of the pixel boundaries, e.g. the markers.
+
+    Returns
+    -------
+    pixels (np.array)
+    '''
+    pixels = np.searchsorted(boundaries, times, side='right') - 1
+    pixels[pixels >= len(boundaries) - 1] = -1
+    return pixels
+
+def flim_cube(events, boundaries=None, marker=8, num_bins=256,
+              channel=None, dtype=np.uint32):
+    '''
+    Histograms of the dtimes of the photons in every pixel of a line.
+
+    Parameters
+    ----------
+    events     (np.array): decoded T3 events of the line
+    boundaries (np.array): truensyncs of the pixel boundaries, if None
+                           the markers with the given marker bit are used.
+    marker     (int): marker bit of the stage trigger
+    num_bins   (int): number of microtime bins, the 4096 dtimes of the
+                      PicoHarp are grouped into bins of 4096 // num_bins,
+                      so it has to divide 4096.
+    channel    (int): if None the photons of all channels are used
+    dtype      : of the cube
+
+    Returns
+    -------
+    cube (np.array): shape (num_pixels, num_bins)
+    '''
+    width = bin_width(num_bins)
+    if boundaries is None:
+        boundaries = marker_times(events, marker)
+    num_pixels = max(len(boundaries) - 1, 0)
+    ph = photons(events, channel)
+    pixels = assign_pixels(ph[:, 3], boundaries)
+    inside = (pixels >= 0)
+    microtime = ph[inside, 1] // width
+    flat = pixels[inside] * num_bins + microtime
+    cube = np.bincount(flat, minlength=num_pixels * num_bins)
+    return cube.reshape(num_pixels, num_bins).astype(dtype)
+
+def microtimes(num_bins=256, resolution=1.):
+    '''
+    Centers of the microtime bins of a cube with num_bins bins,
+    resolution being the time of one dtime.
+    '''
+    width = bin_width(num_bins)
+    return (np.arange(num_bins) + 0.5) * width * resolution
+
+def intensity(cube):
+    '''
+    Photons in every pixel.
+    '''
+    return cube.sum(axis=-1)
+
+def mean_arrival_time(cube, resolution=1., t0=0.):
+    '''
+    Mean arrival time of the photons in every pixel, measured from t0.
+    Pixels without photons get nan.
+
+    Parameters
+    ----------
+    cube       (np.array): of shape (..., num_bins)
+    resolution (float): time of one dtime
+    t0         (float): e.g. the position of the instrument response
+    '''
+    t = microtimes(cube.shape[-1], resolution) - t0
+    counts = intensity(cube).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (cube @ t) / counts
+
+def phasor(cube, frequency, resolution, t0=0.):
+    '''
+    Phasor coordinates of the decays in every pixel.
+
+    Parameters
+    ----------
+    cube       (np.array): of shape (..., num_bins)
+    frequency  (float): the modulation frequency, usually the
+                        repetition rate of the laser
+    resolution (float): time of one dtime
+    t0         (float): time of the excitation
+
+    Returns
+    -------
+    g, s (np.array): nan for pixels without photons
+    '''
+    omega_t = 2 * np.pi * frequency * (microtimes(cube.shape[-1], resolution) - t0)
+    counts = intensity(cube).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        g = (cube @ np.cos(omega_t)) / counts
+        s = (cube @ np.sin(omega_t)) / counts
+    return g, s
+
+def phasor_lifetimes(g, s, frequency):
+    '''
+    Phase and modulation lifetimes from phasor coordinates,
+    which coincide for monoexponential decays.
+
+    Returns
+    -------
+    tau_phase, tau_modulation (np.array)
+    '''
+    omega = 2 * np.pi * frequency
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tau_phase = s / g / omega
+        tau_modulation = np.sqrt(1 / (g**2 + s**2) - 1) / omega
+    return tau_phase, tau_modulation
+
+def stack_rows(cubes, num_pixels=None):
+    '''
+    Stack the cubes of every row into a (rows, pixels, bins) cube,
+    rows with a different number of pixels are cropped or padded
+    with zeros to num_pixels, which by default is the most common
+    number of pixels.
+    '''
+    if num_pixels is None:
+        sizes, counts = np.unique([len(c) for c in cubes], return_counts=True)
+        num_pixels = sizes[np.argmax(counts)]
+    num_bins = cubes[0].shape[1]
+    stack = np.zeros((len(cubes), num_pixels, num_bins), dtype=cubes[0].dtype)
+    for i, c in enumerate(cubes):
+        n = min(num_pixels, len(c))
+        stack[i, :n] = c[:n]
+    return stack
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+'''
+Localization of emitters in confocal maps.
+
+The candidates are the local maxima of the map, found with a maximum
+filter, that stand above the background by a number of robust standard
+deviations. A window around every candidate is then fitted with a 2D
+Gaussian on a constant background, all windows at once, with a
+Levenberg-Marquardt iteration vectorized over the windows, which gives
+positions to a fraction of a pixel and their uncertainties.
+
+Usage
+-----
+emitters = localize(final_map, xs, ys)
+emitters['x'], emitters['y'], emitters['x_err'], emitters['y_err']
+'''
+
+import numpy as np
+from scipy import ndimage
+
+NUM_PARAMS = 5 # amplitude, x0, y0, sigma, background
+
+def background_level(image):
+    '''
+    Median and robust standard deviation, from the median absolute
+    deviation, of the finite pixels of an image.
+    '''
+    values = image[np.isfinite(image)]
+    if len(values) == 0:
+        return 0., 0.
+    background = np.median(values)
+    noise = 1.4826 * np.median(np.abs(values - background))
+    if noise == 0:
+        noise = np.std(values)
+    return background, noise
+
+def find_peaks(image, half_width=2, nsigma=5., background_size=None):
+    '''
+    Local maxima of the image that are nsigma above the background.
+
+    Parameters
+    ----------
+    image           (np.array): 2D, nan where there is no data
+    half_width      (int): a maximum is the largest pixel in the
+                           (2*half_width+1) square around it.
+    nsigma          (float): threshold above the background in robust
+                             standard deviations of the image.
+    background_size (int): if given, the background is the median in a
+                           square of this size around every pixel,
+                           otherwise the median of the whole image.
+
+    Returns
+    -------
+    rows, cols (np.array): of the maxima, brightest first.
+    '''
+    background, noise = background_level(image)
+    filled = np.where(np.isfinite(image), image, background)
+    if background_size is not None:
+        background = ndimage.median_filter(filled, size=background_size, mode='nearest')
+    is_max = ndimage.maximum_filter(filled, size=2*half_width+1, mode='nearest') == filled
+    peaks = is_max & np.isfinite(image) & (filled > background + nsigma * noise)
+    rows, cols = np.nonzero(peaks)
+    order = np.argsort(filled[rows, cols])[::-1]
+    return rows[order], cols[order]
+
+def windows(image, rows, cols, half_width):
+    '''
+    The (2*half_width+1) square windows of the image centered at
+    every (row, col), padded with nan beyond the edges.
+
+    Returns
+    -------
+    stack (np.array): of shape (len(rows), 2*half_width+1, 2*half_width+1)
+    '''
+    padded = np.pad(image.astype(float), half_width, constant_values=np.nan)
+    size = 2*half_width + 1
+    view = np.lib.stride_tricks.sliding_window_view(padded, (size, size))
+    return view[rows, cols].copy()
+
+def _model(params, u, v):
+    amplitude, x0, y0, sigma, background = [params[:, k, None] for k in range(NUM_PARAMS)]
+    r2 = (u - x0)**2 + (v - y0)**2
+    g = np.exp(-r2 / (2 * sigma**2))
+    model = amplitude * g + background
+    jacobian = np.stack([g,
+                         amplitude * g * (u - x0) / sigma**2,
+                         amplitude * g * (v - y0) / sigma**2,
+                         amplitude * g * r2 / sigma**3,
+                         np.ones_like(g)], axis=-1)
+    return model, jacobian
+
+def fit_gaussians(stack, sigma=1.5, iterations=50):
+    '''
+    Fit every window of the stack with
+        amplitude * exp(-((u-x0)**2 + (v-y0)**2) / (2 sigma**2)) + background
+    with u, v the columns and rows measured from the center of the
+    window, all windows at once. Pixels that are nan are left out.
+
+    Parameters
+    ----------
+    stack      (np.array): of shape (num_windows, size, size)
+    sigma      (float): initial width, in pixels
+    iterations (int): of Levenberg-Marquardt
+
+    Returns
+    -------
+    params (np.array): of shape (num_windows, 5), amplitude, x0, y0, sigma, background
+    errors (np.array): standard errors of the params
+    '''
+    num, size, _ = stack.shape
+    half = (size - 1) / 2
+    v, u = np.mgrid[0:size, 0:size] - half
+    u, v = u.ravel()[None, :], v.ravel()[None, :]
+    data = stack.reshape(num, -1)
+    weights = np.isfinite(data).astype(float)
+    data = np.nan_to_num(data)
+    background = np.array([np.min(d[w > 0]) if w.any() else 0. for d, w in zip(data, weights)])
+    params = np.column_stack([data[:, size*size//2] - background,
+                              np.zeros(num), np.zeros(num),
+                              np.full(num, float(sigma)), background])
+    damping = np.full(num, 1e-3)
+    model, jacobian = _model(params, u, v)
+    cost = np.sum(weights * (data - model)**2, axis=1)
+    for _ in range(iterations):
+        residual = weights * (data - model)
+        jtj = np.einsum('nmi,nm,nmj->nij', jacobian, weights, jacobian)
+        jtr = np.einsum('nmi,nm->ni', jacobian, residual)
+        diagonal = np.einsum('nii->ni', jtj)
+        damped = jtj + (damping[:, None] * diagonal)[:, :, None] * np.eye(NUM_PARAMS)
+        try:
+            step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.array([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(damped, jtr)])
+        trial = params + step
+        trial[:, 3] = np.abs(trial[:, 3])
+        trial_model, trial_jacobian = _model(trial, u, v)
+        trial_cost = np.sum(weights * (data - trial_model)**2, axis=1)
+        better = trial_cost < cost
+        params[better] = trial[better]
+        model[better], jacobian[better] = trial_model[better], trial_jacobian[better]
+        cost[better] = trial_cost[better]
+        damping = np.where(better, damping / 10, damping * 10)
+    # covariance from the curvature and the variance of the residuals
+    jtj = np.einsum('nmi,nm,nmj->nij', jacobian, weights, jacobian)
+    dof = np.maximum(weights.sum(axis=1) - NUM_PARAMS, 1)
+    covariance = np.linalg.pinv(jtj) * (cost / dof)[:, None, None]
+    errors = np.sqrt(np.abs(np.einsum('nii->ni', covariance)))
+    return params, errors
+
+def localize(image, xs=None, ys=None, half_width=3, nsigma=5.,
+             background_size=None, sigma=1.5, min_sigma=0.5):
+    '''
+    Find the emitters in a map and fit their positions.
+
+    Parameters
+    ----------
+    image           (np.array): 2D, nan where there is no data
+    xs, ys          (np.array): coordinates of the columns and rows, evenly
+                                spaced, e.g. in mm on the stage, if None
+                                the positions are in pixels.
+    half_width      (int): half the size of the fitted windows, also used
+                           to find the maxima.
+    nsigma          (float): threshold of find_peaks
+    background_size (int): see find_peaks
+    sigma           (float): initial width of the fits, in pixels
+    min_sigma       (float): narrowest width of an emitter, in pixels, the
+                             fits of single hot pixels are narrower.
+
+    Returns
+    -------
+    emitters (dict): brightest first, with arrays
+                     x, y, x_err, y_err: position and standard errors
+                     sigma: width in the units of the coordinates
+                     amplitude, background: in the units of the image
+                     row, col: of the maximum the fit started from
+                     ok: False for the fits that left their window,
+                         did not converge, or are narrower than min_sigma.
+    '''
+    image = np.asarray(image, dtype=float)
+    if xs is None:
+        xs = np.arange(image.shape[1])
+    if ys is None:
+        ys = np.arange(image.shape[0])
+    dx = xs[1] - xs[0] if len(xs) > 1 else 1.
+    dy = ys[1] - ys[0] if len(ys) > 1 else 1.
+    rows, cols = find_peaks(image, min(half_width, 2), nsigma, background_size)
+    if len(rows) == 0:
+        params, errors = np.zeros((0, NUM_PARAMS)), np.zeros((0, NUM_PARAMS))
+    else:
+        params, errors = fit_gaussians(windows(image, rows, cols, half_width), sigma)
+    ok = (np.all(np.isfinite(errors), axis=1)
+          & (np.abs(params[:, 1]) <= half_width) & (np.abs(params[:, 2]) <= half_width)
+          & (params[:, 0] > 0)
+          & (params[:, 3] > min_sigma) & (params[:, 3] < 2 * half_width))
+    return {'x': xs[cols] + params[:, 1] * dx,
+            'y': ys[rows] + params[:, 2] * dy,
+            'x_err': errors[:, 1] * abs(dx),
+            'y_err': errors[:, 2] * abs(dy),
+            'sigma': params[:, 3] * abs(dx),
+            'amplitude': params[:, 0],
+            'background': params[:, 4],
+            'row': rows,
+            'col': cols,
+            'ok': ok}
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks of the TTTR decoding, binning, and correlation paths.
+
+Synthetic T2 and T3 streams of fixed sizes are generated with
+realistic overflow and marker densities, every path is timed in
+records per second and its peak memory is measured with tracemalloc.
+The results are stored as JSON together with the git commit, so that
+runs can be compared across commits.
+
+Usage
+-----
+python -m zialab.benchmarks.tttr_benchmark --sizes 1e5 1e6 1e7
+python -m zialab.benchmarks.tttr_benchmark --compare old.json new.json
+
+T3_parsing and g2_scan live in picoharp.py, which needs phlib64.dll to
+be imported, so they are timed through what they do: memory mapping
+a file of records and decoding it, and cross correlating the T2
+channels.
+'''
+
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+from time import perf_counter
+from datetime import datetime
+from zialab.instruments.tttr import (decode_t2, decode_t3, encode_t2, encode_t3,
+                                     T2Decoder, T3Decoder, T2RESOLUTION)
+from zialab.instruments.tttrfile import TTTRWriter, read_records
+from zialab.analysis import binning, correlation, flim
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+FIFO_BLOCK = 131072 # records per FIFO read
+
+def synthetic_t3(num_records, count_rate=2e5, sync_rate=20e6,
+                 dwell_time=1e-3, lifetime=3e-9, resolution=16e-12, seed=0):
+    '''
+    T3 records of a confocal scan, photons at count_rate with
+    exponential dtimes and a marker every dwell_time.
+    '''
+    rng = np.random.default_rng(seed)
+    marker_rate = 1 / dwell_time
+    num_events = int(num_records)
+    # waiting times between events, a fraction of them are markers
+    gaps = rng.exponential(1 / (count_rate + marker_rate), num_events)
+    truensync = (np.cumsum(gaps) * sync_rate).astype(np.int64)
+    is_marker = rng.random(num_events) < marker_rate / (count_rate + marker_rate)
+    channel = np.where(is_marker, 0xF, 1)
+    dtime = np.where(is_marker, 8,
+                     np.minimum(rng.exponential(lifetime / resolution, num_events), 4095).astype(np.int64))
+    records, _ = encode_t3(channel, dtime, truensync)
+    return records[:num_events]
+
+def synthetic_t2(num_records, count_rate=2e5, dwell_time=1e-3, seed=0):
+    '''
+    T2 records of two detectors at count_rate each and a marker every dwell_time.
+    '''
+    rng = np.random.default_rng(seed)
+    marker_rate = 1 / dwell_time
+    num_events = int(num_records)
+    gaps = rng.exponential(1 / (2 * count_rate + marker_rate), num_events)
+    truetime = (np.cumsum(gaps) / T2RESOLUTION).astype(np.int64)
+    kind = rng.random(num_events) * (2 * count_rate + marker_rate)
+    channel = np.where(kind < count_rate, 0, np.where(kind < 2 * count_rate, 1, 0xF))
+    records, _ = encode_t2(channel, truetime)
+    return records[:num_events]
+
+def measure(func, repeats=3):
+    '''
+    Best wall time of func over repeats, and its peak traced memory.
+    '''
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+def _stream(decoder, records):
+    for start in range(0, len(records), FIFO_BLOCK):
+        decoder.decode(records[start:start + FIFO_BLOCK])
+
+def _t3_file(records, directory):
+    path = os.path.join(directory, 'bench.tttr')
+    with TTTRWriter(path, mode='T3') as writer:
+        for start in range(0, len(records), FIFO_BLOCK):
+            writer.write(records[start:start + FIFO_BLOCK])
+    return path
+
+def benchmarks(num_records, repeats=3, max_lag=25000, bin_width=125):
+    '''
+    Run all the benchmarks on streams of num_records records.
+
+    Returns
+    -------
+    results (list): one dict per path with its name, records,
+                    seconds, records_per_s, and peak_bytes.
+    '''
+    results = []
+
+    def run(name, func, records):
+        seconds, peak = measure(func, repeats)
+        results.append({'name': name,
+                        'records': int(records),
+                        'seconds': seconds,
+                        'records_per_s': records / seconds if seconds else float('inf'),
+                        'peak_bytes': int(peak)})
+        print('%-28s %10d records %10.3g rec/s %10.1f MB'
+              % (name, records, results[-1]['records_per_s'], peak / 1e6))
+
+    t3 = synthetic_t3(num_records)
+    run('parse_events', lambda: decode_t3(t3), len(t3))
+    run('T3Decoder stream', lambda: _stream(T3Decoder(), t3), len(t3))
+    with tempfile.TemporaryDirectory() as directory:
+        path = _t3_file(t3, directory)
+        # what TTTR_Functions.T3_parsing does
+        run('T3_parsing (memmap+decode)', lambda: decode_t3(read_records(path)), len(t3))
+    events = decode_t3(t3)
+    del t3
+    markers = flim.marker_times(events)
+    photon_times = flim.photons(events)[:, 3]
+    run('bin_markers', lambda: binning.bin_markers(photon_times, markers, dwell_time=1e-3), len(events))
+    run('flim_cube', lambda: flim.flim_cube(events, boundaries=markers), len(events))
+    del events, markers, photon_times
+
+    t2 = synthetic_t2(num_records)
+    run('parse_T2_events', lambda: decode_t2(t2), len(t2))
+    run('T2Decoder stream', lambda: _stream(T2Decoder(), t2), len(t2))
+    events = decode_t2(t2)
+    del t2
+    t_a = correlation.channel_times(events, 0)
+    t_b = correlation.channel_times(events, 1)
+    # what Confocal_Functions.g2_scan does, +-100 ns in 0.5 ns bins
+    run('g2 cross_correlation', lambda: correlation.cross_correlation(t_a, t_b, max_lag, bin_width), len(events))
+    run('g2 multi_tau', lambda: correlation.multi_tau(t_a, t_b, 250, 250000000), len(events))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(old_file, new_file, threshold=0.1):
+    '''
+    Print the change in throughput between two result files, flagging
+    paths that got slower by more than threshold. Returns the regressions.
+    '''
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    before = {(r['name'], r['records']): r for r in old['results']}
+    regressions = []
+    print('%s -> %s' % (old['commit'], new['commit']))
+    for r in new['results']:
+        key = (r['name'], r['records'])
+        if key not in before:
+            continue
+        ratio = r['records_per_s'] / before[key]['records_per_s']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  <-- slower'
+            regressions.append({'name': r['name'], 'records': r['records'], 'ratio': ratio})
+        print('%-28s %10d records x%.2f%s' % (r['name'], r['records'], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e5, 1e6, 1e7],
+                        help='number of records of the synthetic streams, up to 1e8')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='JSON file for the results, by default in benchmarks/results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args(argv)
+    if args.compare:
+        return 1 if compare(*args.compare) else 0
+    commit = git_commit()
+    run = {'commit': commit,
+           'date': datetime.now().isoformat(timespec='seconds'),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'platform': platform.platform(),
+           'cpu_count': os.cpu_count(),
+           'results': []}
+    for size in args.sizes:
+        run['results'] += benchmarks(int(size), args.repeats)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'tttr-%s-%s.json'
+                              % (datetime.now().strftime('%Y%m%d-%H%M%S'), commit))
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=1)
+    print('Results saved to %s' % output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Live view of a confocal scan, started by instruments.preview.ScanPreview.
+
+Every update only the rows whose version changed are copied from the
+shared memory and only they are used to grow the colour scale, the
+image is then redrawn as a whole.
+
+python scanview.py <shared memory name> [--title TITLE] [--extent XI XF YI YF]
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtGui, QtCore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from instruments import preview
+
+parser = argparse.ArgumentParser()
+parser.add_argument('name')
+parser.add_argument('--title', default='scan')
+parser.add_argument('--extent', type=float, nargs=4, default=None)
+parser.add_argument('--interval', type=int, default=200, help='between updates, in ms')
+args = parser.parse_args()
+
+try:
+    shm, header, versions, shared_image = preview.attach(args.name)
+except FileNotFoundError:
+    sys.exit('The scan %s is already done, there is nothing to show.' % args.name)
+num_rows, num_cols = shared_image.shape
+image = np.full((num_rows, num_cols), np.nan, dtype=np.float32)
+shown = np.zeros(num_rows, dtype=np.int64)
+levels = [np.inf, -np.inf]
+
+pg.setConfigOption('background', 'k')
+pg.setConfigOption('foreground', 'w')
+pg.setConfigOption('imageAxisOrder', 'row-major')
+
+app = QtGui.QApplication([])
+win = pg.GraphicsLayoutWidget(show=True)
+win.setWindowTitle(args.title)
+win.setGeometry(80, 80, 800, 800)
+label = pg.LabelItem(justify='center')
+win.addItem(label, row=0, col=0)
+plot = win.addPlot(row=1, col=0)
+plot.setAspectLocked(True)
+item = pg.ImageItem()
+plot.addItem(item)
+colorbar = pg.HistogramLUTItem()
+colorbar.setImageItem(item)
+colorbar.gradient.loadPreset('viridis')
+win.addItem(colorbar, row=1, col=1)
+if args.extent is not None:
+    xi, xf, yi, yf = args.extent
+    plot.setLabel(axis='bottom', text='x/mm')
+    plot.setLabel(axis='left', text='y/mm')
+else:
+    xi, xf, yi, yf = 0, num_cols, 0, num_rows
+item.setImage(image, autoLevels=False, levels=(0, 1))
+item.setRect(QtCore.QRectF(xi, yi, xf - xi, yf - yi))
+
+def update():
+    global shm, header, versions, shared_image
+    if shm is None:
+        return
+    done = bool(header[2])
+    new_rows = np.flatnonzero(versions != shown)
+    if len(new_rows):
+        shown[new_rows] = versions[new_rows]
+        rows = shared_image[new_rows]
+        image[new_rows] = rows
+        finite = rows[np.isfinite(rows)]
+        if len(finite):
+            levels[0] = min(levels[0], finite.min())
+            levels[1] = max(levels[1], finite.max())
+        if levels[1] > levels[0]:
+            colorbar.setLevels(*levels)
+            item.setImage(image, autoLevels=False, levels=tuple(levels))
+        else:
+            item.setImage(image, autoLevels=False)
+        label.setText('%s | %d of %d rows' % (args.title, np.count_nonzero(shown), num_rows))
+    if done:
+        # the scan released the memory, the image stays on screen
+        label.setText('%s | done' % args.title)
+        del header, versions, shared_image
+        shm.close()
+        shm = None
+        timer.stop()
+
+timer = QtCore.QTimer()
+timer.timeout.connect(update)
+timer.start(args.interval)
+
+if __name__ == '__main__':
+    if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
+        QtGui.QApplication.instance().exec_()
@@ -4,9 +4,17 @@ import numpy as np
 from time import sleep, time
 import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 codebase_dir = 'D:/ZiaLab/Codebase/'
 sys.path.append(codebase_dir)
 from zialab.misc.sugar import send_message
+from zialab.instruments.tttr import decode_t2, decode_t3, T2Decoder, T2MARKER_CHANNEL, T2RESOLUTION
+from zialab.instruments.fifo_worker import FifoWorker
+from zialab.instruments.scanstore import ScanStore
+from zialab.instruments.preview import ScanPreview
+from zialab.instruments import runways
+from zialab.instruments.pipython import pitools
+from zialab.analysis import correlation, flim, binning
 from tenacity import retry, stop_after_attempt
 
 AXES_RANGE = 40. # in mm 700, 838, 562
@@ -21,6 +29,33 @@ def parse_num_coords(str_coord):
     nums = ''.join(re.findall('(\d)',str_coord))
     return np.array([int(nums),letters[letter]])
 
+def move_async(stage, positions, timeout=300):
+    '''
+    Start moving the axes to the commanded positions, all at once,
+    and return without waiting.
+    Parameters
+    ----------
+    positions (dict): position in mm for 'x', 'y' or both
+    timeout   (float): in s
+    Returns
+    -------
+    future (concurrent.futures.Future): done when all the axes are on
+        target, the stage is polled more often when the move is expected
+        to end, and moves of other stages can overlap with this one.
+    '''
+    targets = {}
+    for axis, position in positions.items():
+        assert axis in ['x','y']
+        assert type(position) in [int,float,np.float64, np.float32, np.int32, np.int64], "wacky position"
+        assert abs(position) < AXES_RANGE, "position out of range"
+        targets[{'x':'1','y':'2'}[axis]] = position
+    expected = pitools.movetime(stage, targets)
+    for axis, position in targets.items():
+        stage.MOV(axis,position)
+    return pitools.waitfuture(pitools.asyncwaiton(lambda: all(stage.qONT()[axis] for axis in targets),
+                                                  timeout=timeout, polldelay=0.05, expected=expected,
+                                                  name='move_async'))
+
 def move_and_wait(stage, axis, position):
     '''
     Move to the commanded position and wait until it's reached.
@@ -29,13 +64,7 @@ def move_and_wait(stage, axis, position):
     axis  (str): 'x' or 'y'
     position (float): position in mm
     '''
-    assert axis in ['x','y']
-    axis = {'x':'1','y':'2'}[axis]
-    assert type(position) in [int,float,np.float64, np.float32, np.int32, np.int64], "wacky position"
-    assert abs(position) < AXES_RANGE, "position out of range"
-    stage.MOV(axis,position)
-    while not stage.qONT()[axis]:
-        sleep(0.01)
+    move_async(stage, {axis: position}).result()
 
 def TRO(stage, tro_state):
     if tro_state.lower() == 'off':
@@ -46,57 +75,32 @@ def TRO(stage, tro_state):
         stage.GcsCommandset('TRO 2 1')
 
 def setCTO(stage, StartThreshold, StopThreshold, velocity, TriggerStep, Axis='1', Polarity=1, TriggerMode=0):  # Configure the CTO
-    stage.GcsCommandset('TRO 2 1')
-    stage.GcsCommandset('CTO 2 1 ' + str(TriggerStep))
-    stage.GcsCommandset('CTO 2 2 ' + Axis)
-    stage.GcsCommandset('CTO 2 3 ' + str(TriggerMode))
-    stage.GcsCommandset('CTO 2 8 ' + str(StartThreshold))
-    stage.GcsCommandset('CTO 2 9 ' + str(StopThreshold))
-    stage.GcsCommandset('CTO 2 10 ' + str(StartThreshold))
-    stage.GcsCommandset('VEL x ' + str(velocity))
-    stage.GcsCommandset('VEL y ' + str(velocity))
+    # sent as one message with a single round trip for the errors
+    with stage.batch():
+        stage.send('TRO 2 1')
+        stage.send('CTO 2 1 ' + str(TriggerStep))
+        stage.send('CTO 2 2 ' + Axis)
+        stage.send('CTO 2 3 ' + str(TriggerMode))
+        stage.send('CTO 2 8 ' + str(StartThreshold))
+        stage.send('CTO 2 9 ' + str(StopThreshold))
+        stage.send('CTO 2 10 ' + str(StartThreshold))
+        stage.send('VEL 1 ' + str(velocity))
+        stage.send('VEL 2 ' + str(velocity))
 
 def parse_events(events):
-    T3WRAPAROUND = 65536
-    parsed_events = []
-    oflcorrection = 0
-    truensync = 0
-    for event in events:
-        record = '{0:0{1}b}'.format(event,32)
-        channel = int(record[:4],base=2)
-        dtime = int(record[4:16], base=2)
-        nsync = int(record[16:], base=2)
-        if channel == 0xF:
-            if dtime == 0:
-                oflcorrection += T3WRAPAROUND
-            else:
-                truensync = oflcorrection + nsync
-        else:
-            truensync = oflcorrection + nsync
-        parsed_events.append([channel, dtime, nsync, truensync])
-    return parsed_events
+    '''
+    Decode the T3 records read from the picoharp FIFO.
+    Returns an array with columns channel, dtime, nsync, truensync.
+    '''
+    return decode_t3(events)
 
 def parse_T2_events(events):
-    parsed_events = []
-    T2WRAPAROUND = 210698240
-    oflcorrection=0
-    truetime=0
-    for event in events:
-        record = '{0:0{1}b}'.format(event,32)
-        channel = int(record[:4],base=2)
-        time = int(record[4:],base=2)
-        if channel == 15:
-            marker = int(record[28:32], base=2)
-            if marker == 0:
-                oflcorrection += T2WRAPAROUND
-            else:
-                truetime = oflcorrection + time
-                parsed_events.append([2,truetime])
-        else:
-            truetime = oflcorrection + time
-            parsed_events.append([channel,truetime])
-    parsed_events = np.array(parsed_events)
-    return parsed_events
+    '''
+    Decode the T2 records read from the picoharp FIFO.
+    Returns an array with columns channel, truetime, markers
+    are given channel 2 and overflows are dropped.
+    '''
+    return decode_t2(events)
 
 def snr_to_vel(scan):
     '''
@@ -115,59 +119,136 @@ def snr_to_vel(scan):
     else:
         return target_vel
 
+def quantize_vel(vel, min_vel, max_vel):
+    '''
+    Round the speed down to one of the speeds max_vel/sqrt(2)**k,
+    so that the rows of an adaptive scan share a few speeds
+    and their runways.
+    '''
+    k = np.ceil(2*np.log2(max_vel/vel) - 1e-9)
+    return float(max(max_vel * 2**(-max(k, 0)/2), min_vel))
 
-def compute_runway(stage, vel, fast=False, tol=0.0005):
+def vel_bounds(scan):
+    '''
+    Minimum and maximum speeds of an adaptive scan, in mm/s.
+    '''
+    return scan.get('min_vel', 0.0125), scan.get('max_vel', 0.5)
+
+def adaptive_vel(scan, rates, dwell_time):
     '''
+    Speed of the next row from the count rates of the last finished
+    row, that was scanned with the given dwell time. The speed gives
+    the target SNR at the brightest pixel of that row, rows where no
+    pixel stood out from the noise with an SNR of scan['detection_SNR']
+    are scanned at the maximum speed.
+
+    Parameters
+    ----------
+    scan       (dict): with dx, nr, target_SNR, and optionally
+                       min_vel, max_vel (mm/s) and detection_SNR.
+    rates      (np.array): in cps
+    dwell_time (float): in s
+
+    Returns
+    -------
+    vel (float): in mm/s
+    '''
+    min_vel, max_vel = vel_bounds(scan)
+    cr = np.nanmax(rates) if np.any(np.isfinite(rates)) else np.nan
+    nr = scan['nr']
+    if not np.isfinite(cr) or cr <= nr:
+        return max_vel
+    snr = np.sqrt(dwell_time) * (cr - nr)/np.sqrt(cr + nr)
+    if snr < scan.get('detection_SNR', 3.):
+        # only background in the last row
+        return max_vel
+    vel = scan['dx'] * ((cr - nr)/np.sqrt(cr + nr)/scan['target_SNR'])**2
+    return quantize_vel(min(max(vel, min_vel), max_vel), min_vel, max_vel)
+
+
+def measure_runway(stage, vel, tol=0.0005):
+    '''
+    Measure the runway with a test move of the stage, recording the
+    commanded and actual positions with the data recorder.
+
     Parameters
     ----------
     stage   (zialab.instruments.stage)
     vel     (float): scan speed in mm/s
-    fast    (bool): if True then previous values are used to estimate adequate runway.
     tol     (float): tolerance for error in trial motion
     Returns
     -------
     goodrunway (float): runway in mm
     '''
-    if (not fast) or (vel < 0.00125) or (vel > 0.8):
-        stage.DRT(0,1,'1')
-        span = 0.015
-        d = 4*span
-        current_x = stage.qPOS()['1']
-        original_vel = stage.qVEL()['1']
-        stage.VEL('1',vel)
-        move_and_wait(stage, 'x', current_x+d)
-        # read the data tables
-        stage.qDRR()
-        while not stage.bufstate:
-            sleep(0.1)
-            pass
-        stage.VEL('1',original_vel)
-        times = np.array(stage.bufdata[0])
-        times = times-times[0]
-        commanded = np.array(stage.bufdata[1])
-        actual = np.array(stage.bufdata[2])
-        err = np.abs(commanded-actual)
-        for idx, px in enumerate(actual):
-            # and index where the distance travel
-            # is the required one
-            idxf = np.argmin(np.abs((actual-px) - span))
-            errors_in_interval = err[idx:idxf]
-            if all(errors_in_interval < tol):
-                break
-        else:
-            raise Exception('no good runway found')
-        goodrunway = actual[idx] - current_x
-        stage.DRT(0,1,'0')
-        return goodrunway
+    stage.DRT(0,1,'1')
+    span = 0.015
+    d = 4*span
+    current_x = stage.qPOS()['1']
+    original_vel = stage.qVEL()['1']
+    stage.VEL('1',vel)
+    move_and_wait(stage, 'x', current_x+d)
+    # read the data tables
+    stage.qDRR()
+    while not stage.bufstate:
+        sleep(0.1)
+        pass
+    stage.VEL('1',original_vel)
+    times, commanded, actual = stage.bufarray
+    times = times-times[0]
+    err = np.abs(commanded-actual)
+    for idx, px in enumerate(actual):
+        # and index where the distance travel
+        # is the required one
+        idxf = np.argmin(np.abs((actual-px) - span))
+        errors_in_interval = err[idx:idxf]
+        if all(errors_in_interval < tol):
+            break
     else:
-        # interpolate using precomputed values
-        vels = np.array([0.0125, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8])
-        runways = np.array([0.0050,0.0079,0.0097,
-                            0.0112,0.0197,0.0364,0.0596])
-        return np.interp(vel,vels,runways)
+        raise Exception('no good runway found')
+    goodrunway = actual[idx] - current_x
+    stage.DRT(0,1,'0')
+    return goodrunway
 
-def linescanner(stage, pharp, linescan, verbose=False):
-    linescan['reads'] = [] # in this list the events will be collected
+def compute_runway(stage, vel, fast=False, tol=0.0005):
+    '''
+    Parameters
+    ----------
+    stage   (zialab.instruments.stage)
+    vel     (float): scan speed in mm/s
+    fast    (bool): if True then the runway is interpolated from the runway
+                    table of the stage, which is calibrated if there is none
+                    or if the stage parameters changed, if False it is measured.
+    tol     (float): tolerance for error in trial motion
+    Returns
+    -------
+    goodrunway (float): runway in mm
+    '''
+    if not fast:
+        return measure_runway(stage, vel, tol)
+    measure = lambda stage, vel: measure_runway(stage, vel, tol)
+    table = runways.runway_table(stage, measure)
+    if not table.covers(vel):
+        # extend the table instead of extrapolating
+        table.add(vel, measure(stage, vel))
+        table.save()
+    return table(vel)
+
+def recalibrate_runway(stage, vel, tol=0.0005):
+    '''
+    Measure the runway at vel again and replace it in the runway table
+    of the stage, e.g. after a linescan with jittery markers.
+    '''
+    table = runways.runway_table(stage, lambda stage, vel: measure_runway(stage, vel, tol))
+    table.add(vel, measure_runway(stage, vel, tol))
+    table.save()
+    return table(vel)
+
+def set_line_geometry(linescan):
+    '''
+    Adjust xf to a whole number of trigger steps, and set the number of
+    markers, the duration, and the start and end points of a linescan,
+    which depend on its direction.
+    '''
     linescan['xf'] = (linescan['xi'] 
             + np.ceil((linescan['xf']-linescan['xi'])
                       /linescan['dx'])*linescan['dx'])
@@ -175,57 +256,311 @@ def linescanner(stage, pharp, linescan, verbose=False):
                               /linescan['dx']))+1)
     linescan['ts'] = ((linescan['xf']-linescan['xi']+2*linescan['e'])
                       /linescan['velx'])
-    linescan['dt'] = 0.25*linescan['ts'] # how often the buffer will be read
     linescan['tph'] = 1.2*linescan['ts'] # measurement time for picoharp
-    linescan['start'] = linescan['xi'] - linescan['e']
-    linescan['end'] = linescan['xf'] + linescan['e']
     linescan['dwell_time'] = linescan['dx'] / linescan['velx']
+    if linescan.get('direction', 'forward') == 'backward':
+        linescan['start'] = linescan['xf'] + linescan['e']
+        linescan['end'] = linescan['xi'] - linescan['e']
+        linescan['first_trigger'] = linescan['xf']
+        linescan['last_trigger'] = linescan['xi']
+    else:
+        linescan['start'] = linescan['xi'] - linescan['e']
+        linescan['end'] = linescan['xf'] + linescan['e']
+        linescan['first_trigger'] = linescan['xi']
+        linescan['last_trigger'] = linescan['xf']
+    return linescan
+
+def acquire_line(stage, pharp, linescan, verbose=False):
+    '''
+    Do the motion and the acquisition of a linescan, the raw records
+    read from the picoharp are kept in linescan['records'], to be
+    decoded and binned by process_line.
+
+    If linescan['direction'] is 'backward' the line is scanned
+    from xf to xi.
+    '''
+    blocks = [] # raw records are collected here as they are read
+    set_line_geometry(linescan)
     if verbose:
         print('Scan will take about {ts} s.'.format(**linescan))
 
     # move to start at speed vsafe
     stage.VEL('1',linescan['vsafe'])
     stage.VEL('2',linescan['vsafe'])
-    move_and_wait(stage, 'x', linescan['start'])
-    move_and_wait(stage, 'y', linescan['y'])
+    move_async(stage, {'x': linescan['start'], 'y': linescan['y']}).result()
     # configure CTO and set speed
     stage.VEL('1',linescan['velx'])
-    setCTO(stage, **{'StartThreshold':linescan['xi'],
-                    'StopThreshold':linescan['xf'],
+    setCTO(stage, **{'StartThreshold':linescan['first_trigger'],
+                    'StopThreshold':linescan['last_trigger'],
                     'velocity':linescan['velx'],
                     'TriggerStep':linescan['dx']})
-    # start measurement on picoharp
+    # start measurement on picoharp and drain its FIFO in the background
     pharp.start_measurement(linescan['tph'])
+    worker = FifoWorker(pharp)
+    worker.start()
     # issue the motion command to the stage
     try:
         stage.MOV('1', linescan['end'])
     except:
         stage.MOV('1', linescan['end'])
-    # read buffer in a loop and stop when stage arrives to end
-    while True:
-        sleep(linescan['dt'])
-        buff = pharp.buffer_read()
-        if buff != None:
-            if verbose:
-                print('adding events ...')
-            linescan['reads'].extend(list(buff))
-        if stage.qONT()['1']:
-            break
-    for idx in range(10):
-        if verbose:
-            print(idx)
-        buff = pharp.buffer_read()
-        if buff != None:
-            if verbose:
-                print('adding events ...')
-            linescan['reads'].extend(list(buff))
+    # copy the records out of the ring as the worker drains them and stop when stage arrives to end
+    while not stage.qONT()['1']:
+        for block in worker.blocks(timeout=0.05):
+            blocks.append(block.copy())
+    worker.stop()
+    for block in worker.blocks():
+        blocks.append(block.copy())
     pharp.stop_measurement()
-    linescan['events'] = np.array(parse_events(linescan['reads']))
-    linescan['parsed_scan'] = np.diff(linescan['events'][linescan['events'][:,1] == 8][:,3])/linescan['dwell_time']/1000
-    linescan['x_coords'] = np.linspace(linescan['xi'],linescan['xf'],len(linescan['parsed_scan']))
+    linescan['fifo_stats'] = worker.stats
+    if worker.fifo_overrun:
+        print('FIFO overrun at y = %f, some records were lost.' % linescan['y'])
+    linescan['records'] = np.concatenate(blocks + [np.zeros(0, dtype=np.uint32)])
     TRO(stage, "off")
     return linescan
 
+def process_line(linescan):
+    '''
+    Decode the records of a linescan acquired by acquire_line,
+    and bin its photons into pixels.
+    '''
+    linescan['events'] = decode_t3(linescan['records'])
+    # count the photons between consecutive markers, repairing missed or repeated markers
+    binned = binning.bin_markers(flim.photons(linescan['events'])[:,3],
+                                 flim.marker_times(linescan['events']),
+                                 expected=linescan['N'],
+                                 dwell_time=linescan['dwell_time'],
+                                 lag=linescan.get('lag', 0.))
+    linescan['counts'] = binned['counts']
+    linescan['exposure'] = binned['exposure']
+    linescan['marker_repair'] = binned['repair']
+    # uneven markers mean that the stage was not at constant speed,
+    # the markers that were repaired are left out
+    linescan['trigger_jitter'] = runways.marker_jitter(binned['boundaries'], binned['measured'])
+    linescan['parsed_scan'] = binned['rate']/1000 # in kcps
+    # pixel x microtime histograms for lifetime maps, if asked for
+    if linescan.get('flim_bins'):
+        linescan['flim'] = flim.flim_cube(linescan['events'], boundaries=binned['boundaries'],
+                                          num_bins=linescan['flim_bins'])
+    if linescan.get('direction', 'forward') == 'backward':
+        # pixels were acquired from xf to xi
+        for key in ['counts', 'exposure', 'parsed_scan', 'flim']:
+            if key in linescan:
+                linescan[key] = linescan[key][::-1]
+    linescan['x_coords'] = np.linspace(linescan['xi'],linescan['xf'],len(linescan['parsed_scan']))
+    return linescan
+
+def linescanner(stage, pharp, linescan, verbose=False):
+    '''
+    Acquire a linescan and process it.
+    '''
+    linescan = acquire_line(stage, pharp, linescan, verbose)
+    return process_line(linescan)
+
+def row_direction(scan, idx):
+    '''
+    Direction of the row idx, odd rows go backward in serpentine scans.
+    '''
+    if scan.get('serpentine', False) and idx % 2:
+        return 'backward'
+    return 'forward'
+
+def estimate_lag(final_map, dx, velx, max_shift=10):
+    '''
+    Estimate the lag between the stage trigger and the actual position
+    of the stage from the shift between the rows of a serpentine scan.
+    A feature is seen displaced by velx*lag in the direction of the motion,
+    so consecutive rows in opposite directions are displaced by 2*velx*lag.
+
+    Parameters
+    ----------
+    final_map (np.array): rows alternating forward and backward,
+                          the backward ones already flipped.
+    dx        (float): pixel size in mm
+    velx      (float or np.array): scan speed in mm/s, of every row if an array
+    max_shift (int): in pixels
+
+    Returns
+    -------
+    lag (float): in s, to be added to the lag used for the scan.
+    '''
+    shifts = []
+    lags = np.arange(-max_shift, max_shift+1)
+    velx = np.broadcast_to(np.asarray(velx, dtype=float), (len(final_map),))
+    pair_vels = (velx[0::2][:len(final_map)//2] + velx[1::2])/2
+    for forward, backward, vel in zip(final_map[0::2], final_map[1::2], pair_vels):
+        a = np.nan_to_num(forward - np.nanmean(forward))
+        b = np.nan_to_num(backward - np.nanmean(backward))
+        xcorr = np.array([np.sum(a[max(0,k):len(a)+min(0,k)] * b[max(0,-k):len(b)-max(0,k)])
+                          for k in lags])
+        best = np.argmax(xcorr)
+        if 0 < best < len(lags)-1 and xcorr[best] > 0:
+            # refine with a parabola through the peak
+            y0, y1, y2 = xcorr[best-1:best+2]
+            denominator = y0 - 2*y1 + y2
+            offset = 0.5*(y0 - y2)/denominator if denominator else 0.
+            shifts.append((lags[best] + offset) * dx / (2 * vel))
+    if not shifts:
+        return 0.
+    return np.median(shifts)
+
+def place_row(scan, idx, linescan):
+    '''
+    Put the binned row of a processed linescan into the maps of the scan.
+    '''
+    num_cols = scan['final_map'].shape[1]
+    n = min(num_cols, len(linescan['parsed_scan']))
+    scan['final_map'][idx, :n] = linescan['parsed_scan'][:n]
+    scan['counts_map'][idx, :n] = linescan['counts'][:n]
+    scan['exposure_map'][idx, :n] = linescan['exposure'][:n]
+    if 'flim_cube' in scan:
+        scan['flim_cube'][idx, :n] = linescan['flim'][:n]
+
+def finish_row(scan, idx, linescan, store=None, preview=None):
+    '''
+    Process a linescan and put it into the maps, if there is a store
+    the row is saved and its raw records are dropped from memory, and
+    if there is a preview the row is published to it.
+    '''
+    linescan = process_line(linescan)
+    place_row(scan, idx, linescan)
+    # the histograms are in the flim cube now
+    linescan.pop('flim', None)
+    scan['row_jitter'][idx] = linescan['trigger_jitter']
+    if preview is not None:
+        preview.publish_row(idx, scan['final_map'][idx])
+    if store is not None:
+        store.write_row(idx, linescan, elapsed=time() - scan['start_time'])
+    return linescan
+
+def start_preview(scan):
+    '''
+    If scan['preview'] is True, open a live preview of the map of the
+    scan, with the rows already done, and launch its viewer.
+    '''
+    if not scan.get('preview', False):
+        return None
+    num_rows, num_cols = np.shape(scan['final_map'])
+    preview = ScanPreview(num_rows, num_cols, title=scan.get('sample_name', 'scan'),
+                          extent=(scan['xi'], scan['xi'] + num_cols*scan['dx'],
+                                  scan['yi'], scan['yi'] + num_rows*scan['dx']))
+    preview.publish(scan['final_map'])
+    preview.launch_viewer()
+    return preview
+
+def scan_rows(stage, pharp, scan, store=None, first_row=0):
+    '''
+    Do the linescans of the rows from first_row on, every row is
+    processed on a worker thread while the next one is acquired.
+    '''
+    preview = start_preview(scan)
+    try:
+        return _scan_rows(stage, pharp, scan, store, first_row, preview)
+    finally:
+        if preview is not None:
+            preview.close()
+
+def _scan_rows(stage, pharp, scan, store, first_row, preview):
+    scan['linescans'] = []
+    if 'row_velx' not in scan:
+        scan['row_velx'] = np.full(len(scan['ys']), np.nan)
+        scan['row_dwell'] = np.full(len(scan['ys']), np.nan)
+        scan['row_jitter'] = np.full(len(scan['ys']), np.nan)
+    row_runways = {scan['velx']: scan['e']}
+    recalibrated = set()
+    last_done = first_row - 1
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for idx in range(first_row, len(scan['ys'])):
+            y = scan['ys'][idx]
+            print('row %d of %d' % (idx+1, len(scan['ys'])))
+            if scan.get('adaptive', False) and last_done >= 0:
+                # the last finished row is two rows back, as the previous one is still being processed
+                velx = adaptive_vel(scan, 1000*scan['final_map'][last_done], scan['row_dwell'][last_done])
+                if velx not in row_runways:
+                    row_runways[velx] = compute_runway(stage, velx, fast=scan['fast_runway'])
+            else:
+                velx = scan['velx']
+            move_and_wait(stage, 'y',y)
+            linescan = {'velx': velx,
+                   'e': row_runways[velx],
+                   'xi': scan['xi'],
+                   'xf': scan['xf'],
+                   'dx': scan['dx'], # trigger step
+                   'vsafe': scan['vsafe'],
+                   'y': y,
+                   'nr': scan['nr'],
+                   'SNR': scan['SNR'],
+                   'direction': row_direction(scan, idx),
+                   'lag': scan.get('lag', 0.),
+                   'flim_bins': scan['flim_cube'].shape[2] if 'flim_cube' in scan else None}
+            linescan = acquire_line(stage, pharp, linescan)
+            scan['linescans'].append(linescan)
+            scan['row_velx'][idx] = velx
+            scan['row_dwell'][idx] = linescan['dwell_time']
+            # at most one row waits to be processed
+            if pending is not None:
+                pending.result()
+                last_done = idx - 1
+                jittery_vel = scan['row_velx'][last_done]
+                if (scan['fast_runway'] and jittery_vel not in recalibrated
+                    and scan['row_jitter'][last_done] > scan.get('max_jitter', runways.MAX_JITTER)):
+                    print('Uneven markers in row %d, measuring the runway at %.4f mm/s again...'
+                          % (last_done+1, jittery_vel))
+                    row_runways[jittery_vel] = recalibrate_runway(stage, jittery_vel)
+                    recalibrated.add(jittery_vel)
+            pending = executor.submit(finish_row, scan, idx, linescan, store, preview)
+            elapsed_time = time() - scan['start_time']
+            rem_time = (scan['Ny']-idx-1)*elapsed_time/(idx+1)/60.
+            print('Time remaining: %.1f min' % rem_time)
+        if pending is not None:
+            pending.result()
+    return scan
+
+def finish_scan(scan, store=None):
+    '''
+    Compute the results of a scan whose rows are all done.
+    '''
+    print("Computing final scan result...")
+    # markers are repaired to the expected number in every row, so all rows have the same size
+    if store is not None:
+        scan['marker_repairs'] = [row['marker_repair'] for row in store.manifest['rows']]
+    else:
+        scan['marker_repairs'] = [onescan['marker_repair'] for onescan in scan['linescans']]
+    if scan.get('serpentine', False):
+        scan['lag_estimate'] = scan.get('lag', 0.) + estimate_lag(scan['final_map'], scan['dx'], scan['row_velx'])
+    # lifetime maps, mean arrival times are in units of the dtime resolution
+    if 'flim_cube' in scan:
+        scan['mean_arrival_map'] = flim.mean_arrival_time(scan['flim_cube'])
+    
+    print("Tidying things up...")
+    if scan['linescans']:
+        scan['xf'] = scan['linescans'][-1]['xf'] # propagate the adjusted xf to scan
+    scan['time_taken'] = time() - scan['start_time']
+    scan['mins_taken'] = scan['time_taken']/60.
+    scan['dx_in_um'] = scan['dx']*1000
+    scan['info_title'] = '{sample_name}\nv = {velx:.2f} mm/s | SNR -> {SNR:.1f} | {mins_taken:.2f} min | dx = {dx_in_um} um'.format(**scan)
+    if store is not None:
+        store.update(**{k: scan[k] for k in ['xf', 'time_taken', 'mins_taken', 'info_title']
+                        + (['lag_estimate'] if 'lag_estimate' in scan else [])})
+    return scan
+
+def row_positions(scan):
+    '''
+    Round yf up to a whole number of trigger steps above yi, and set
+    the number of rows Ny and their positions ys. The rows go from yi
+    to yf, or if scan['grid_rows'] is True they are one trigger step
+    apart, at the centers of the rows of pixels of size dx from yi to
+    yf, like the columns are at the centers between the triggers.
+    '''
+    scan['yf'] = (scan['yi'] 
+                  + np.ceil((scan['yf']-scan['yi'])/scan['dx'] - 1e-6)*scan['dx'])
+    scan['Ny'] = int(round((scan['yf']-scan['yi'])/scan['dx']))
+    if scan.get('grid_rows', False):
+        scan['ys'] = scan['yi'] + (np.arange(scan['Ny']) + 0.5)*scan['dx']
+    else:
+        scan['ys'] = np.linspace(scan['yi'],scan['yf'],scan['Ny'])
+    return scan
+
 def scanner(stage, pharp, scan):
     '''
     Do a raster scan on a given region by performing a sequence of line scans.
@@ -235,23 +570,48 @@ def scanner(stage, pharp, scan):
     
     If a scanning speed velx is given then this speed is used,
     if not then it is computed with the target SNR according to the
-    count rate at the staring position. 
+    count rate at the staring position. If scan['adaptive'] is True
+    the speed of every row is then chosen with adaptive_vel from the
+    rates of the last finished row, between scan['min_vel'] and
+    scan['max_vel'], and the speed and dwell time of every row are
+    kept in scan['row_velx'] and scan['row_dwell'].
     
     When returning to the left margin after having scanned a row, the
-    stage returns there moving at a speed v_safe.
+    stage returns there moving at a speed v_safe. If scan['serpentine']
+    is True then odd rows are instead scanned right to left, and the
+    markers are delayed by scan['lag'] (in s) to correct for the lag
+    of the stage, the lag estimated from the offset between rows of
+    either direction is kept in scan['lag_estimate'].
     
     Every linescan begins has a runway length computed by the functtion
-    compute_runway which is a function of the scan speed.
+    compute_runway which is a function of the scan speed. With fast_runway
+    it comes from the runway table of the stage, and the runway at a
+    speed is measured again if a row at that speed has markers more
+    uneven than scan['max_jitter'].
+
+    Every row is decoded and binned on a worker thread while the next
+    row is being acquired, and scan['final_map'] is filled row by row.
+    If scan['store_path'] is given the maps are kept in a ScanStore in
+    that directory, every finished row is saved there and its raw records
+    are dropped from memory, and an interrupted scan can be continued
+    with resume. If scan['preview'] is True every finished row is also
+    published to a live preview, shown by gui/scanview.py in its own
+    process, so the scan never waits for the plotting.
+
+    The rows go from yi to yf, or with scan['grid_rows'] they are one
+    trigger step apart, see row_positions, as for the passes of a
+    multiresolution scan and the tiles of a mosaic.
+
+    If scan['flim_bins'] is given, the dtimes of the photons of every
+    pixel are also histogrammed into scan['flim_cube'], with that many
+    microtime bins, from which scan['mean_arrival_map'] is computed.
     '''
     # works consistently in a on scanning regions larger that about 20 um
-    # scans every row left to right
+    # scans every row left to right, or alternating directions if serpentine,
     # and goes from bottom to top
     assert scan['yf'] > scan['yi'], "yf must be larger than yi"
     assert scan['xf'] > scan['xi'], "xf must be larger than xi"
-    scan['yf'] = (scan['yi'] 
-                  + np.ceil((scan['yf']-scan['yi'])/scan['dx'])*scan['dx'])
-    scan['Ny'] = int(round((scan['yf']-scan['yi'])/scan['dx']))
-    scan['ys'] = np.linspace(scan['yi'],scan['yf'],scan['Ny'])
+    scan = row_positions(scan)
     if scan['cleaning_run']:
         print("Running a cleaning run ...")
         stage.VEL('1',scan['v_cleaning'])
@@ -262,101 +622,94 @@ def scanner(stage, pharp, scan):
         move_and_wait(stage, 'x', scan['xi']+2)
         move_and_wait(stage, 'y', scan['yi']-2)
         move_and_wait(stage, 'y', scan['yi']+2)
-    move_and_wait(stage, 'y', scan['yi'])
-    move_and_wait(stage, 'x', scan['xi'])
+    move_async(stage, {'x': scan['xi'], 'y': scan['yi']}).result()
     scan['start_time'] = time()
     print("Reading the countrate in the starting position...")
     scan['cr'] = pharp.get_counts()[0]
     if 'velx' not in scan.keys():
         print("Computing speed from given target SNR...")
         scan['velx'] = snr_to_vel(scan)
-    scan['SNR'] = (np.sqrt(scan['dx']/scan['velx']) 
-                   * (scan['cr']-scan['nr'])/np.sqrt(scan['cr']+scan['nr']))
+        if scan.get('adaptive', False):
+            min_vel, max_vel = vel_bounds(scan)
+            scan['velx'] = quantize_vel(min(max(scan['velx'], min_vel), max_vel), min_vel, max_vel)
+    snr = (np.sqrt(scan['dx']/scan['velx']) 
+           * (scan['cr']-scan['nr'])/np.sqrt(scan['cr']+scan['nr']))
+    scan['target_SNR'] = scan.get('SNR', snr)
+    scan['SNR'] = snr
     stage.VEL('2',scan['velx'])
     if scan['fast_runway']:
         scan['e'] = compute_runway(stage, scan['velx'], fast=True)
     else:
         scan['e'] = compute_runway(stage, scan['velx'], fast=False)
     print("Doing linescans...")
-    for idx, y in enumerate(scan['ys']):
-        print('row %d of %d' % (idx+1, len(scan['ys'])))
-        move_and_wait(stage, 'y',y)
-        linescan = {'velx': scan['velx'],
-               'e': scan['e'],
-               'xi': scan['xi'],
-               'xf': scan['xf'],
-               'dx': scan['dx'], # trigger step
-               'vsafe': scan['vsafe'],
-               'y': y,
-               'nr': scan['nr'],
-               'SNR': scan['SNR']}
-        linescan = linescanner(linescan)
-        scan['linescans'].append(linescan)
-        elapsed_time = time() - scan['start_time']
-        rem_time = (scan['Ny']-idx+1)*elapsed_time/(idx+1)/60.
-        print('Time remaining: %.1f min' % rem_time)
-    
-    print("Computing final scan result...")
-    rows = [onescan['parsed_scan'] for onescan in scan['linescans']]
-    expectedcols = [(s['N']) for s in scan['linescans']]
-    colsizes = list(map(len,rows))
-    if min(colsizes) != max(colsizes): # if all is good leave as is
-        # if not then do some interpolation to put everything in shape
-        print("Probable jitter motion detected, using heuristic parsing...")
-        colsize = np.median(colsizes)
-        x_coords = np.linspace(scan['xi'],scan['xf'],int(colsize))
-        interprows = [np.interp(x_coords,
-                                np.linspace(scan['xi'],scan['xf'],len(row)),
-                                row) for row in rows]
-        scan['final_map'] = np.array(interprows)
+    # the maps are filled row by row, on disk if there is a store
+    num_cols = int(np.ceil((scan['xf']-scan['xi'])/scan['dx'] - 1e-6))
+    flim_bins = scan.get('flim_bins')
+    if flim_bins:
+        flim.bin_width(flim_bins) # fail before scanning if it does not divide the dtimes
+    if scan.get('store_path'):
+        store = ScanStore.create(scan['store_path'], scan, scan['Ny'], num_cols, flim_bins)
+        scan.update(store.maps)
     else:
-        print("All rows good...")
-        scan['final_map'] = np.array(rows)
-    
-    print("Tidying things up...")
-    scan['xf'] = linescan['xf'] # propagate the adjusted xf to scan
-    scan['time_taken'] = time() - scan['start_time']
-    scan['mins_taken'] = scan['time_taken']/60.
-    scan['dx_in_um'] = scan['dx']*1000
-    scan['info_title'] = '{sample_name}\nv = {velx:.2f} mm/s | SNR -> {SNR:.1f} | {mins_taken:.2f} min | dx = {dx_in_um} um'.format(**scan)
-    return scan 
+        store = None
+        scan['final_map'] = np.full((scan['Ny'], num_cols), np.nan)
+        scan['counts_map'] = np.zeros((scan['Ny'], num_cols), dtype=np.int64)
+        scan['exposure_map'] = np.zeros((scan['Ny'], num_cols))
+        if flim_bins:
+            scan['flim_cube'] = np.zeros((scan['Ny'], num_cols, flim_bins), dtype=np.uint32)
+    scan = scan_rows(stage, pharp, scan, store)
+    return finish_scan(scan, store)
 
-def linescan_retry_alert(retry_state):
-    alert_msg = 'Failure detected in linescan, retrying...'
-    send_message(alert_msg)
+def resume(stage, pharp, store_path):
+    '''
+    Continue a scan started by scanner with a store_path from the
+    first row that was not finished, with the speed and runway of
+    the original scan.
+    '''
+    store = ScanStore.open(store_path)
+    scan = store.scan
+    if store.complete:
+        print("All rows are done.")
+    else:
+        print("Resuming from row %d of %d..." % (store.rows_done+1, store.num_rows))
+        stage.VEL('1',scan['vsafe'])
+        stage.VEL('2',scan['vsafe'])
+        move_async(stage, {'x': scan['xi'], 'y': scan['ys'][store.rows_done]}).result()
+        stage.VEL('2',scan['velx'])
+    # keep counting the time from where the scan was interrupted
+    scan['start_time'] = time() - store.manifest['elapsed']
+    scan['row_velx'] = np.full(store.num_rows, np.nan)
+    scan['row_dwell'] = np.full(store.num_rows, np.nan)
+    scan['row_jitter'] = np.full(store.num_rows, np.nan)
+    for idx, row in enumerate(store.manifest['rows']):
+        scan['row_velx'][idx] = row['velx']
+        scan['row_dwell'][idx] = row['dwell_time']
+        scan['row_jitter'][idx] = row['trigger_jitter']
+    scan = scan_rows(stage, pharp, scan, store, first_row=store.rows_done)
+    return finish_scan(scan, store)
 
-@retry(stop=stop_after_attempt(3),
-      after=linescan_retry_alert)
 def T2linescanner(stage, pharp, linescan, verbose=False):
-    linescan['reads'] = [] # in this list the events will be collected
-    linescan['xf'] = (linescan['xi'] 
-            + np.ceil((linescan['xf_original']-linescan['xi'])
-                      /linescan['dx'])*linescan['dx'])
-    linescan['N'] = int(round(((linescan['xf']-linescan['xi'])
-                              /linescan['dx']))+1)
-    linescan['ts'] = ((linescan['xf']-linescan['xi']+2*linescan['e'])
-                      /linescan['velx'])
-    linescan['dt'] = 0.25*linescan['ts'] # how often the buffer will be read
-    linescan['tph'] = 1.2*linescan['ts'] # measurement time for picoharp
-    linescan['start'] = linescan['xi'] - linescan['e']
-    linescan['end'] = linescan['xf'] + linescan['e']
-    linescan['dwell_time'] = linescan['dx'] / linescan['velx']
+    decoder = T2Decoder()
+    chunks = [] # decoded events are collected here as they are read
+    linescan['xf'] = linescan['xf_original']
+    set_line_geometry(linescan)
     if verbose:
         print('Scan will take about {ts} s.'.format(**linescan))
 
     # move to start at speed vsafe
     stage.VEL('1',linescan['vsafe'])
     stage.VEL('2',linescan['vsafe'])
-    move_and_wait(stage, 'x',linescan['start'])
-    move_and_wait(stage, 'y',linescan['y'])
+    move_async(stage, {'x': linescan['start'], 'y': linescan['y']}).result()
     # configure CTO and set speed
     stage.VEL('1',linescan['velx'])
-    setCTO(stage, **{'StartThreshold':linescan['xi'],
-                    'StopThreshold':linescan['xf'],
+    setCTO(stage, **{'StartThreshold':linescan['first_trigger'],
+                    'StopThreshold':linescan['last_trigger'],
                     'velocity':linescan['velx'],
                     'TriggerStep':linescan['dx']})
-    # start measurement on picoharp
+    # start measurement on picoharp and drain its FIFO in the background
     pharp.start_measurement(linescan['tph'])
+    worker = FifoWorker(pharp)
+    worker.start()
     # enable data recorder on the stage
     try:
         stage.DRT(0,1,'1')
@@ -367,46 +720,84 @@ def T2linescanner(stage, pharp, linescan, verbose=False):
         stage.MOV('1', linescan['end'])
     except:
         stage.MOV('1', linescan['end'])
-    # read buffer in a loop and stop when stage arrives to end
-    while True:
-        sleep(linescan['dt'])
-        buff = pharp.buffer_read()
-        if buff != None:
-            if verbose:
-                print('adding events ...')
-            linescan['reads'].extend(list(buff))
-        if stage.qONT()['1']:
-            break
-    for idx in range(10):
-        if verbose:
-            print(idx)
-        buff = pharp.buffer_read()
-        if buff != None:
-            if verbose:
-                print('adding events ...')
-            linescan['reads'].extend(list(buff))
+    # decode the records as the worker drains them and stop when stage arrives to end
+    while not stage.qONT()['1']:
+        for block in worker.blocks(timeout=0.05):
+            chunks.append(decoder.decode(block))
+    worker.stop()
+    for block in worker.blocks():
+        chunks.append(decoder.decode(block))
     pharp.stop_measurement()
+    linescan['fifo_stats'] = worker.stats
+    if worker.fifo_overrun:
+        print('FIFO overrun at y = %f, some records were lost.' % linescan['y'])
     # read the data tables on the stage
     stage.qDRR()
     while not stage.bufstate:
         sleep(0.1)
         pass
+    times, commanded, actual = stage.bufarray
     trajectory = {}
-    trajectory['times'] = np.array(stage.bufdata[0])
-    trajectory['times'] = trajectory['times'] - trajectory['times'][0]
-    trajectory['commanded_positions'] = np.array(stage.bufdata[1])
-    trajectory['actual_positions'] = np.array(stage.bufdata[2])
+    trajectory['times'] = times - times[0]
+    trajectory['commanded_positions'] = commanded
+    trajectory['actual_positions'] = actual
     linescan['trajectory'] = trajectory
     stage.DRT(0,1,'0')
-    linescan['events'] = np.array(parse_T2_events(linescan['reads']))
+    linescan['events'] = np.concatenate(chunks + [np.zeros((0, 2), dtype=np.int64)])
     linescan['numsteps'] = int((linescan['xf']-linescan['xi']+2*linescan['e'])/linescan['dx'])
-    linescan['bintimes'] = linescan['events'][linescan['events'][:,0] == 2][:,1]
-    linescan['events'] = linescan['events'][linescan['events'][:,0] != 2][:,1]
-    linescan['parsed_scan'], _, = np.histogram(linescan['events'], bins=linescan['bintimes'])
+    linescan['bintimes'] = linescan['events'][linescan['events'][:,0] == T2MARKER_CHANNEL][:,1]
+    linescan['events'] = linescan['events'][linescan['events'][:,0] != T2MARKER_CHANNEL][:,1]
+    # count the photons between consecutive markers, repairing missed or repeated markers
+    binned = binning.bin_markers(linescan['events'], linescan['bintimes'],
+                                 expected=linescan['N'], time_unit=T2RESOLUTION,
+                                 lag=linescan.get('lag', 0.))
+    linescan['bintimes'] = binned['boundaries']
+    linescan['counts'] = binned['counts']
+    linescan['exposure'] = binned['exposure']
+    linescan['rate'] = binned['rate']
+    linescan['marker_repair'] = binned['repair']
+    if linescan.get('direction', 'forward') == 'backward':
+        # pixels were acquired from xf to xi
+        for key in ['counts', 'exposure', 'rate']:
+            linescan[key] = linescan[key][::-1]
+    linescan['parsed_scan'] = linescan['counts']
     linescan['x_coords'] = np.linspace(linescan['xi']-linescan['e'],linescan['xf']+linescan['e'],len(linescan['parsed_scan']))
     TRO(stage, "off")
     return linescan
 
+def trajectory_row(linescan):
+    '''
+    Counts and dwell times in the pixels of a linescan done by
+    T2linescanner, every photon being placed where the data recorder
+    saw the stage when it arrived. The first marker, delayed by the
+    lag, is matched to the time at which the stage crossed the first
+    trigger in the direction of the row, so that rows scanned in either
+    direction are aligned in the same way.
+
+    Returns
+    -------
+    counts, dwell_times (np.array): from xi to xf, the dwell times in ms
+    '''
+    # in ms, as the times of the data recorder
+    clicks = linescan['events']*T2RESOLUTION*1e3
+    stage_times = linescan['trajectory']['times']
+    stage_dt = stage_times[1]-stage_times[0]
+    stage_positions = linescan['trajectory']['actual_positions']
+    linescan_marks = np.arange(linescan['xi'], linescan['xf'], linescan['dx'])
+    dwell_times, _ = np.histogram(stage_positions, bins=linescan_marks)
+    if linescan.get('direction', 'forward') == 'backward':
+        crossed = stage_positions <= linescan['first_trigger']
+    else:
+        crossed = stage_positions >= linescan['first_trigger']
+    if len(linescan['bintimes']) == 0 or not crossed.any():
+        return np.zeros(len(dwell_times), dtype=np.int64), stage_dt*dwell_times
+    # the boundaries of bin_markers are already delayed by the lag
+    first_marker = linescan['bintimes'][0]*T2RESOLUTION*1e3
+    pivot = stage_times[np.argmax(crossed)]
+    interpol_clicks = np.interp(clicks - first_marker + pivot, stage_times, stage_positions)
+    better_counts, _ = np.histogram(interpol_clicks, linescan_marks)
+    return better_counts, stage_dt*dwell_times
+
 def T2scanner_retry_alert(retry_state):
     alert_msg = 'Failure detected in T2scanner, retrying...'
     send_message(alert_msg)
@@ -425,13 +816,21 @@ def T2scanner(stage, pharp, scan):
     count rate at the staring position. 
     
     When returning to the left margin after having scanned a row, the
-    stage returns there moving at a speed v_safe.
+    stage returns there moving at a speed v_safe. If scan['serpentine']
+    is True then odd rows are instead scanned right to left, and the
+    markers are delayed by scan['lag'] (in s) to correct for the lag
+    of the stage, the lag estimated from the offset between rows of
+    either direction is kept in scan['lag_estimate'].
     
     Every linescan begins has a runway length computed by the function
     compute_runway which is a function of the scan speed.
+
+    scan['final_map'] places every photon with the trajectory recorded
+    by the stage, see trajectory_row, and scan['final_map_simple']
+    bins the photons between the markers.
     '''
     # works consistently in a on scanning regions larger that about 20 um
-    # scans every row left to right
+    # scans every row left to right, or alternating directions if serpentine,
     # and goes from bottom to top
     assert scan['yf'] > scan['yi'], "yf must be larger than yi"
     assert scan['xf'] > scan['xi'], "xf must be larger than xi"
@@ -449,8 +848,7 @@ def T2scanner(stage, pharp, scan):
         move_and_wait(stage, 'x', scan['xi']+2)
         move_and_wait(stage, 'y', scan['yi']-2)
         move_and_wait(stage, 'y', scan['yi']+2)
-    move_and_wait(stage, 'y', scan['yi'])
-    move_and_wait(stage, 'x', scan['xi'])
+    move_async(stage, {'x': scan['xi'], 'y': scan['yi']}).result()
     scan['start_time'] = time()
     print("Reading the countrate in the starting position...")
     scan['cr'] = pharp.get_counts()[0]
@@ -478,7 +876,9 @@ def T2scanner(stage, pharp, scan):
                'vsafe': scan['vsafe'],
                'y': y,
                'nr': scan['nr'],
-               'SNR': scan['SNR']}
+               'SNR': scan['SNR'],
+               'direction': row_direction(scan, idx),
+               'lag': scan.get('lag', 0.)}
         linescan = T2linescanner(stage, pharp, linescan)
         scan['linescans'].append(linescan)
         elapsed_time = time() - scan['start_time']
@@ -486,41 +886,20 @@ def T2scanner(stage, pharp, scan):
         print('Time remaining: %.1f min' % rem_time)
     
     print("Computing final scan result with simple parsing...")
+    # markers are repaired to the expected number in every row, so all rows have the same size
     rows = [onescan['parsed_scan'] for onescan in scan['linescans']]
-    expectedcols = [(s['N']) for s in scan['linescans']]
-    colsizes = list(map(len,rows))
-    if min(colsizes) != max(colsizes): # if all is good leave as is
-        # if not then do some interpolation to put everything in shape
-        print("Probable jitter motion detected, using heuristic parsing...")
-        colsize = np.median(colsizes)
-        x_coords = np.linspace(scan['xi'],scan['xf'],int(colsize))
-        interprows = [np.interp(x_coords,
-                                np.linspace(scan['xi'],scan['xf'],len(row)),
-                                row) for row in rows]
-        scan['final_map_simple'] = np.flip(np.array(interprows),axis=1)
-    else:
-        print("All rows good...")
-        scan['final_map_simple'] = np.flip(np.array(rows), axis=1)
+    scan['final_map_simple'] = np.flip(np.array(rows), axis=1)
+    scan['rate_map_simple'] = np.flip(np.array([onescan['rate'] for onescan in scan['linescans']]), axis=1)
+    if scan.get('serpentine', False):
+        scan['lag_estimate'] = scan.get('lag', 0.) + estimate_lag(scan['rate_map_simple'], scan['dx'], scan['velx'])
+    scan['marker_repairs'] = [onescan['marker_repair'] for onescan in scan['linescans']]
     
     print("Computing final scan result with improved parsing...")
     all_better_counts = []
     all_dwell_times = []
     for linescan in scan['linescans']:
-        clicks = (linescan['events'])*4./1e9
-        position_marks = (linescan['bintimes'])*4/1e9
-        position_marks = position_marks - position_marks[0]
-        stage_times =  (linescan['trajectory']['times'])
-        stage_dt = stage_times[1]-stage_times[0] # in ms
-        stage_positions = (linescan['trajectory']['actual_positions'])
-        for stage_time_pivot in stage_positions:
-            if stage_time_pivot >= linescan['xi']:
-                break
-        stage_times = stage_times - stage_time_pivot
-        interpol_clicks = np.interp(clicks, stage_times, stage_positions)
-        linescan_marks = np.arange(linescan['xi'], linescan['xf'], linescan['dx'])
-        better_counts, _ = np.histogram(interpol_clicks, linescan_marks)
-        dwell_times, _ = np.histogram(stage_positions, bins= linescan_marks)
-        all_dwell_times.append(stage_dt*dwell_times)
+        better_counts, dwell_times = trajectory_row(linescan)
+        all_dwell_times.append(dwell_times)
         all_better_counts.append(better_counts)
     all_better_counts = np.flip(np.array(all_better_counts), axis=1)
     all_dwell_times = np.flip(np.array(all_dwell_times), axis=1)
@@ -534,3 +913,54 @@ def T2scanner(stage, pharp, scan):
     scan['info_title'] = '{sample_name}\nv = {velx:.2f} mm/s | SNR -> {SNR:.1f} | {mins_taken:.2f} min | dx = {dx_in_um} um'.format(**scan)
     return scan 
 
+
+def g2_measurement(pharp, acq_time, max_lag=100e-9, bin_width=0.5e-9,
+                   resolution=4e-12, channels=(0, 1), update=None, update_every=1.):
+    '''
+    Measure the g2 between two channels of a picoharp in T2 mode,
+    correlating the photons as they are read from the FIFO.
+
+    Parameters
+    ----------
+    pharp        : picoharp, already opened in T2 mode
+    acq_time     (float): measurement time in s
+    max_lag      (float): largest delay in s
+    bin_width    (float): width of the delay bins in s
+    resolution   (float): resolution of the T2 time tags in s
+    channels     (tuple): start and stop channels
+    update       (func): optional, called as update(lags, g2, counts)
+                         every update_every seconds during the measurement,
+                         e.g. to refresh a plot for a live antibunching check.
+    update_every (float): s
+
+    Returns
+    -------
+    g2 (dict): with keys lags (s), g2, counts, num_photons,
+               and fifo_stats.
+    '''
+    decoder = T2Decoder()
+    correlator = correlation.CrossCorrelator(int(round(max_lag/resolution)),
+                                             max(1, int(round(bin_width/resolution))),
+                                             channels=channels)
+    pharp.start_measurement(acq_time)
+    worker = FifoWorker(pharp)
+    worker.start()
+    end_time = time() + acq_time
+    next_update = time() + update_every
+    while time() < end_time:
+        for block in worker.blocks(timeout=0.05):
+            correlator.add(decoder.decode(block))
+        if update is not None and time() > next_update and correlator.last_time is not None:
+            update(correlator.lags*resolution, correlator.g2(), correlator.counts)
+            next_update = time() + update_every
+    worker.stop()
+    for block in worker.blocks():
+        correlator.add(decoder.decode(block))
+    pharp.stop_measurement()
+    if worker.fifo_overrun:
+        print('FIFO overrun, some records were lost.')
+    return {'lags': correlator.lags*resolution,
+            'g2': correlator.g2() if correlator.last_time is not None else None,
+            'counts': correlator.counts,
+            'num_photons': (correlator.num_a, correlator.num_b),
+            'fifo_stats': worker.stats}
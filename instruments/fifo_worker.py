@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+Continuous readout of the PicoHarp FIFO in a background thread.
+
+The worker thread reads the FIFO as fast as the DLL hands over records
+and puts them into a preallocated ring of uint32 blocks, reading
+straight into the ring memory. A consumer takes the filled blocks out
+of the ring at its own pace.
+
+There is a single producer (the worker thread) and a single consumer,
+the producer only ever advances the head of the ring and the consumer
+only ever advances its tail, so no locks are needed.
+'''
+
+import numpy as np
+from threading import Thread, Event
+from time import sleep, time
+
+TTREADMAX = 131072
+FLAG_FIFOFULL = 0x0003
+
+def device_io(device):
+    '''
+    Return the functions to read the FIFO into an array and
+    to read the flags for either of the PicoHarp drivers.
+    '''
+    if hasattr(device, 'tttr_read_fifo_into'):
+        # zialab.instruments.pharp
+        return device.tttr_read_fifo_into, device.get_flags
+    else:
+        # zialab.instruments.picoharp
+        return device.read_fifo_into, device.get_flag
+
+class FifoWorker():
+    '''
+    Drain the FIFO of a PicoHarp in a background thread.
+
+    Usage
+    -----
+    worker = FifoWorker(pharp)
+    pharp.start_measurement(acq_time)
+    worker.start()
+    while acquiring:
+        for block in worker.blocks(timeout=0.05):
+            do_something_with(block)
+    worker.stop()
+    for block in worker.blocks():
+        do_something_with(block)
+    pharp.stop_measurement()
+
+    Every block is a view into the ring and it is given back to the
+    worker when the next one is requested, so it has to be consumed
+    (or copied) before that.
+
+    While the worker runs all calls to the device DLL should be done
+    through it, the latest flags are kept in worker.flags.
+    '''
+
+    def __init__(self, device, num_blocks=32, block_size=TTREADMAX,
+                 done=None, drain_reads=2, poll=0.001):
+        '''
+        Parameters
+        ----------
+        device      : instance of picoharp.PicoHarp300, picoharp.PH300,
+                      or pharp.PicoHarp300
+        num_blocks  (int): number of blocks in the ring
+        block_size  (int): number of records in each block
+        done        (func): optional, if given the worker stops when it
+                      returns True, e.g. when the measurement has ended.
+        drain_reads (int): number of consecutive empty reads after which
+                      a stopping worker considers the FIFO empty.
+        poll        (float): seconds to wait when there is nothing to do.
+        '''
+        self._read_into, self._get_flags = device_io(device)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.ring = np.zeros((num_blocks, block_size), dtype=np.uint32)
+        self.lengths = np.zeros(num_blocks, dtype=np.int64)
+        self.head = 0 # blocks written, only advanced by the worker
+        self.tail = 0 # blocks consumed, only advanced by the consumer
+        self._next = 0 # next block to hand over to the consumer
+        self.done = done
+        self.drain_reads = drain_reads
+        self.poll = poll
+        self.flags = 0
+        self.fifo_overrun = False
+        self.error = None
+        self.stats = {'records': 0,
+                      'blocks': 0,
+                      'max_fill': 0, # highest number of blocks waiting in the ring
+                      'stalls': 0, # times the worker found the ring full
+                      'stall_time': 0., # seconds spent waiting on the consumer
+                      'fifo_overruns': 0, # reads with the FIFOFULL flag set
+                      }
+        self._stopping = Event()
+        self._thread = None
+
+    def start(self):
+        '''
+        Start draining the FIFO.
+        '''
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Ask the worker to stop once the FIFO is empty.
+        Records still in the ring can be taken out with blocks().
+        '''
+        self._stopping.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            empty_reads = 0
+            while True:
+                if self.head - self.tail >= self.num_blocks:
+                    # the consumer is lagging behind, wait for free blocks
+                    self.stats['stalls'] += 1
+                    stall_start = time()
+                    while self.head - self.tail >= self.num_blocks:
+                        sleep(self.poll)
+                    self.stats['stall_time'] += time() - stall_start
+                idx = self.head % self.num_blocks
+                num_records = self._read_into(self.ring[idx])
+                flags = self._get_flags()
+                if flags is None:
+                    # picoharp.get_flag returns None when PH_GetFlags fails
+                    raise RuntimeError('Could not read the flags of the PicoHarp, '
+                                       'PH_GetFlags failed.')
+                self.flags = flags
+                if self.flags & FLAG_FIFOFULL:
+                    self.fifo_overrun = True
+                    self.stats['fifo_overruns'] += 1
+                if num_records > 0:
+                    empty_reads = 0
+                    self.lengths[idx] = num_records
+                    self.head += 1 # hands over the block to the consumer
+                    self.stats['records'] += num_records
+                    self.stats['blocks'] += 1
+                    self.stats['max_fill'] = max(self.stats['max_fill'],
+                                                 self.head - self.tail)
+                elif (self._stopping.is_set()
+                      or (self.done is not None and self.done())):
+                    empty_reads += 1
+                    if empty_reads >= self.drain_reads:
+                        break
+                else:
+                    sleep(self.poll)
+        except Exception as e:
+            self.error = e
+
+    def _release(self):
+        # give back the block that was handed over last
+        self.tail = self._next
+
+    def blocks(self, timeout=None):
+        '''
+        Yield the filled blocks as arrays of records.
+
+        Parameters
+        ----------
+        timeout (float): if None, blocks are yielded until the worker
+                has stopped and the ring is empty. If given, the blocks
+                that are in the ring at the time of the call are yielded,
+                waiting at most timeout seconds for one to arrive.
+        '''
+        self._release()
+        if timeout is None:
+            while True:
+                if self._next < self.head:
+                    yield self._take()
+                elif self.is_alive():
+                    sleep(self.poll)
+                elif self._next >= self.head:
+                    break
+        else:
+            maxtime = time() + timeout
+            while self._next == self.head and self.is_alive() and time() < maxtime:
+                sleep(self.poll)
+            last = self.head
+            while self._next < last:
+                yield self._take()
+        self._raise()
+
+    def _take(self):
+        self._release()
+        idx = self._next % self.num_blocks
+        self._next += 1
+        return self.ring[idx, :self.lengths[idx]]
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
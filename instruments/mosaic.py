@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+'''
+Mosaics of confocal scans, for regions larger than a single scan.
+
+The region is split into overlapping tiles on the pixel grid of the
+mosaic, the tiles are scanned with confocal.scanner in the order that
+makes the stage path between them short, and every tile is registered
+against what is already in the mosaic in their overlap, by FFT cross
+correlation, before it is placed.
+
+The mosaic is kept in a PyramidFile, a directory with a JSON header
+and one memory-mapped .npy file per level, each level having half
+the pixels of the previous one, so that any region of any level can
+be read without loading the whole mosaic.
+
+Usage
+-----
+scan = {'xi': 0., 'xf': 1., 'yi': 0., 'yf': 1., 'dx': 0.001,
+        'tile_size': 0.05, 'overlap': 0.005, 'pyramid_path': 'flake_07', ...}
+pyramid = mosaic_scanner(stage, pharp, scan)
+image = pyramid.read_region(0.2, 0.3, 0.4, 0.5, level=1)
+'''
+
+import os
+import json
+import numpy as np
+from time import time
+from zialab.instruments import confocal
+from zialab.instruments.multires import pixel_centers
+
+HEADER = 'pyramid.json'
+
+def plan_tiles(region, dx, tile_size, overlap):
+    '''
+    Split region = (xi, xf, yi, yf) into square tiles of size
+    tile_size that overlap by overlap, all in mm, with their edges
+    on the pixel grid of size dx that starts at (xi, yi). The last
+    tiles of every row and column end at the edge of the region,
+    xf and yf rounded up to the grid, overlapping the previous ones
+    by more, and tiles larger than the region are cut to it.
+
+    Returns
+    -------
+    tiles (list): of dicts with xi, xf, yi, yf, and the row and
+                  col of the tile in the mosaic.
+    '''
+    xi, xf, yi, yf = region
+    tile_pixels = int(round(tile_size / dx))
+    step_pixels = tile_pixels - int(round(overlap / dx))
+    if step_pixels <= 0:
+        raise ValueError('The overlap must be smaller than the tiles.')
+    def starts(length):
+        # first pixel and number of pixels of the tiles along one axis
+        num_pixels = int(np.ceil(length / dx - 1e-6))
+        size = min(tile_pixels, num_pixels)
+        num = max(int(np.ceil((num_pixels - size) / step_pixels)) + 1, 1)
+        return [min(k * step_pixels, num_pixels - size) for k in range(num)], size
+    starts_x, size_x = starts(xf - xi)
+    starts_y, size_y = starts(yf - yi)
+    tiles = []
+    for row, start_y in enumerate(starts_y):
+        for col, start_x in enumerate(starts_x):
+            tiles.append({'row': row, 'col': col,
+                          'xi': xi + start_x * dx,
+                          'xf': xi + (start_x + size_x) * dx,
+                          'yi': yi + start_y * dx,
+                          'yf': yi + (start_y + size_y) * dx})
+    return tiles
+
+def _path_length(points, order):
+    return np.sum(np.linalg.norm(np.diff(points[order], axis=0), axis=1))
+
+def tile_order(centers, start=None):
+    '''
+    Order in which to visit the centers of the tiles for a short
+    stage path, nearest neighbours from the start, improved with 2-opt.
+
+    Parameters
+    ----------
+    centers (np.array): of shape (num_tiles, 2), in mm
+    start   (tuple): stage position, the first tile is the
+                     closest one to it, if None the first one.
+
+    Returns
+    -------
+    order (np.array): indices of the tiles
+    '''
+    centers = np.asarray(centers, dtype=float)
+    num = len(centers)
+    distances = np.linalg.norm(centers[:, None, :] - centers[None, :, :], axis=2)
+    current = 0 if start is None else int(np.argmin(np.linalg.norm(centers - start, axis=1)))
+    order = [current]
+    visited = np.zeros(num, dtype=bool)
+    visited[current] = True
+    for _ in range(num - 1):
+        remaining = np.where(visited, np.inf, distances[current])
+        current = int(np.argmin(remaining))
+        order.append(current)
+        visited[current] = True
+    order = np.array(order)
+    # 2-opt, reversing the stretches that make the open path shorter
+    improved = True
+    while improved and num > 3:
+        improved = False
+        for i in range(1, num - 1):
+            a, b = order[i - 1], order[i]
+            c = order[i + 1:]
+            d = np.append(order[i + 2:], -1)
+            # gain of reversing order[i:j+1] for every j > i
+            old = distances[a, b] + np.where(d >= 0, distances[c, np.maximum(d, 0)], 0)
+            new = distances[a, c] + np.where(d >= 0, distances[b, np.maximum(d, 0)], 0)
+            gains = old - new
+            j = int(np.argmax(gains))
+            if gains[j] > 1e-12:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1]
+                improved = True
+    return order
+
+def register(reference, image, max_shift=5, min_overlap=16, min_correlation=0.5):
+    '''
+    Shift of image with respect to reference, both of the same shape
+    and with nan where there is no data, from the peak of their FFT
+    cross correlation, refined to a fraction of a pixel with a parabola.
+    Only the shifts that keep at least half of the overlap are
+    considered, and if the correlation coefficient at the peak is
+    below min_correlation, e.g. in an overlap with only background,
+    no shift is found.
+
+    Parameters
+    ----------
+    reference, image (np.array): 2D
+    max_shift        (int): largest shift considered, in pixels
+    min_overlap      (int): if fewer pixels have data in both
+                            no shift is found.
+    min_correlation  (float)
+
+    Returns
+    -------
+    shift (tuple): (rows, cols), image[i, j] matches reference[i - rows, j - cols]
+    '''
+    both = np.isfinite(reference) & np.isfinite(image)
+    if both.sum() < min_overlap:
+        return (0., 0.)
+    a = np.where(np.isfinite(reference), reference - np.mean(reference[both]), 0.)
+    b = np.where(np.isfinite(image), image - np.mean(image[both]), 0.)
+    # zero padding avoids the wrap around of the circular correlation
+    shape = [s + max_shift for s in a.shape]
+    correlation = np.fft.irfft2(np.conj(np.fft.rfft2(a, shape)) * np.fft.rfft2(b, shape), shape)
+    # normalized by the number of pixels with data in both at every shift
+    overlap = np.fft.irfft2(np.conj(np.fft.rfft2(np.isfinite(reference).astype(float), shape))
+                            * np.fft.rfft2(np.isfinite(image).astype(float), shape), shape)
+    enough = overlap > max(min_overlap, both.sum() / 2) - 0.5
+    correlation = np.where(enough, correlation / np.maximum(overlap, 1), 0.)
+    lags_rows = np.r_[0:max_shift + 1, -max_shift:0]
+    lags_cols = np.r_[0:max_shift + 1, -max_shift:0]
+    window = correlation[np.ix_(lags_rows % shape[0], lags_cols % shape[1])]
+    if not np.any(window > 0):
+        return (0., 0.)
+    i, j = np.unravel_index(np.argmax(window), window.shape)
+    if window[i, j] < min_correlation * np.std(reference[both]) * np.std(image[both]):
+        return (0., 0.)
+    shift = []
+    for lags, k, values in [(lags_rows, i, window[:, j]), (lags_cols, j, window[i, :])]:
+        offset = 0.
+        neighbours = [np.flatnonzero(lags == lags[k] - 1), np.flatnonzero(lags == lags[k] + 1)]
+        if len(neighbours[0]) and len(neighbours[1]):
+            y0, y1, y2 = values[neighbours[0][0]], values[k], values[neighbours[1][0]]
+            denominator = y0 - 2 * y1 + y2
+            if denominator < 0:
+                offset = 0.5 * (y0 - y2) / denominator
+        shift.append(float(lags[k] + offset))
+    return tuple(shift)
+
+class PyramidFile():
+    '''
+    A mosaic and its downsampled levels, each one a memory-mapped .npy
+    file in a directory, with a header that gives the stage coordinates.
+    '''
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(os.path.join(path, HEADER)) as f:
+            self.header = json.load(f)
+        self.mode = mode
+        self.levels = [np.lib.format.open_memmap(self._level_file(k), mode=mode)
+                       for k in range(self.header['num_levels'])]
+
+    def _level_file(self, level):
+        return os.path.join(self.path, 'level_%d.npy' % level)
+
+    @classmethod
+    def create(cls, path, shape, dx, origin, tile_size=512, metadata=None):
+        '''
+        Create an empty mosaic, all nan.
+
+        Parameters
+        ----------
+        path      (str): directory
+        shape     (tuple): rows and columns of the full resolution level
+        dx        (float): pixel size in mm
+        origin    (tuple): stage coordinates of the corner of pixel (0, 0), mm
+        tile_size (int): pixels of the tiles in which the levels are built and read
+        metadata  (dict): anything else for the header, JSON serializable
+        '''
+        os.makedirs(path, exist_ok=True)
+        level = np.lib.format.open_memmap(os.path.join(path, 'level_0.npy'), mode='w+',
+                                          dtype=np.float32, shape=tuple(shape))
+        level[:] = np.nan
+        level.flush()
+        del level
+        header = {'dx': dx, 'x0': origin[0], 'y0': origin[1],
+                  'shape': list(shape), 'num_levels': 1,
+                  'tile_size': tile_size, 'metadata': metadata or {}}
+        with open(os.path.join(path, HEADER), 'w') as f:
+            json.dump(header, f, indent=1)
+        return cls(path, mode='r+')
+
+    def _save_header(self):
+        with open(os.path.join(self.path, HEADER), 'w') as f:
+            json.dump(self.header, f, indent=1)
+
+    def level_dx(self, level):
+        return self.header['dx'] * 2**level
+
+    def indices(self, x, y, level=0):
+        '''
+        Row and column of the pixel of a level that contains the stage position (x, y).
+        '''
+        dx = self.level_dx(level)
+        return (int(np.floor((y - self.header['y0']) / dx)),
+                int(np.floor((x - self.header['x0']) / dx)))
+
+    def read_region(self, xi, xf, yi, yf, level=0):
+        '''
+        The pixels of a level in the region of the stage, only
+        those are read from disk.
+        '''
+        ri, ci = self.indices(xi, yi, level)
+        rf, cf = self.indices(xf, yf, level)
+        return np.array(self.levels[level][max(ri, 0):rf + 1, max(ci, 0):cf + 1])
+
+    def build_levels(self):
+        '''
+        Compute the downsampled levels, each pixel being the mean of the
+        2x2 pixels with data of the previous level, until a level fits
+        in one tile. The levels are computed in blocks of rows.
+        '''
+        for k in range(1, self.header['num_levels']):
+            os.remove(self._level_file(k))
+        self.levels = self.levels[:1]
+        block = 2 * self.header['tile_size']
+        while max(self.levels[-1].shape) > self.header['tile_size']:
+            previous = self.levels[-1]
+            shape = ((previous.shape[0] + 1) // 2, (previous.shape[1] + 1) // 2)
+            level = np.lib.format.open_memmap(self._level_file(len(self.levels)), mode='w+',
+                                              dtype=np.float32, shape=shape)
+            for start in range(0, previous.shape[0], block):
+                rows = np.array(previous[start:start + block])
+                if rows.shape[0] % 2 or rows.shape[1] % 2:
+                    rows = np.pad(rows, ((0, rows.shape[0] % 2), (0, rows.shape[1] % 2)),
+                                  constant_values=np.nan)
+                quads = rows.reshape(rows.shape[0] // 2, 2, rows.shape[1] // 2, 2)
+                counts = np.isfinite(quads).sum(axis=(1, 3))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    level[start // 2:start // 2 + quads.shape[0]] = (
+                        np.nansum(quads, axis=(1, 3)) / counts)
+            level.flush()
+            self.levels.append(level)
+        self.header['num_levels'] = len(self.levels)
+        self._save_header()
+
+    def flush(self):
+        for level in self.levels:
+            level.flush()
+
+    def close(self):
+        if self.mode != 'r':
+            self.flush()
+        self.levels = []
+
+def place_tile(pyramid, scan, shift=(0., 0.)):
+    '''
+    Put the map of a tile into the full resolution level, moved by
+    shift (rows, cols) in pixels, only where the mosaic has no data yet.
+    '''
+    level = pyramid.levels[0]
+    xs, ys = pixel_centers(scan)
+    dx = pyramid.header['dx']
+    cols = np.floor((xs - pyramid.header['x0']) / dx + round(shift[1])).astype(int)
+    rows = np.floor((ys - pyramid.header['y0']) / dx + 1e-6 + round(shift[0])).astype(int)
+    inside_rows = (rows >= 0) & (rows < level.shape[0])
+    inside_cols = (cols >= 0) & (cols < level.shape[1])
+    if not inside_rows.any() or not inside_cols.any():
+        return
+    block = np.ix_(rows[inside_rows], cols[inside_cols])
+    tile = np.asarray(scan['final_map'])[inside_rows][:, inside_cols]
+    current = level[block]
+    level[block] = np.where(np.isfinite(current), current, tile)
+
+def tile_patch(pyramid, scan):
+    '''
+    The pixels of the mosaic at the nominal place of a tile,
+    of the same shape as its map.
+    '''
+    level = pyramid.levels[0]
+    xs, ys = pixel_centers(scan)
+    dx = pyramid.header['dx']
+    cols = np.floor((xs - pyramid.header['x0']) / dx).astype(int)
+    rows = np.floor((ys - pyramid.header['y0']) / dx + 1e-6).astype(int)
+    patch = np.full(np.shape(scan['final_map']), np.nan)
+    inside_rows = (rows >= 0) & (rows < level.shape[0])
+    inside_cols = (cols >= 0) & (cols < level.shape[1])
+    patch[np.ix_(inside_rows, inside_cols)] = level[np.ix_(rows[inside_rows], cols[inside_cols])]
+    return patch
+
+def mosaic_scanner(stage, pharp, scan):
+    '''
+    Scan a large region as a mosaic of tiles.
+
+    scan has the same entries as for confocal.scanner, and
+    pyramid_path (str): directory of the PyramidFile
+    tile_size    (float): in mm, 0.05 by default
+    overlap      (float): in mm, 0.005 by default
+    max_shift    (int): largest correction of the position of a tile, in pixels, 5 by default
+
+    If there is a store_path, every tile gets its own store in it.
+
+    Returns
+    -------
+    pyramid (PyramidFile): with all levels built, its header has the
+                           tiles and the shifts that were applied.
+    '''
+    start_time = time()
+    params = dict(scan)
+    region = (scan['xi'], scan['xf'], scan['yi'], scan['yf'])
+    dx = scan['dx']
+    tiles = plan_tiles(region, dx, scan.get('tile_size', 0.05), scan.get('overlap', 0.005))
+    position = stage.qPOS()
+    centers = np.array([[(t['xi'] + t['xf']) / 2, (t['yi'] + t['yf']) / 2] for t in tiles])
+    order = tile_order(centers, start=(position['1'], position['2']))
+    extent_x = max(t['xf'] for t in tiles) - region[0]
+    extent_y = max(t['yf'] for t in tiles) - region[2]
+    shape = (int(round(extent_y / dx)), int(round(extent_x / dx)))
+    pyramid = PyramidFile.create(scan['pyramid_path'], shape, dx, (region[0], region[2]),
+                                 metadata={'sample_name': scan.get('sample_name', '')})
+    for num, idx in enumerate(order):
+        tile = tiles[idx]
+        print("Scanning tile %d of %d (row %d, col %d)..." % (num + 1, len(tiles), tile['row'], tile['col']))
+        # the rows of the tiles at the centers of the pixels of the mosaic
+        tile_scan = dict(params, xi=tile['xi'], xf=tile['xf'], yi=tile['yi'], yf=tile['yf'],
+                         grid_rows=True)
+        tile_scan['cleaning_run'] = params.get('cleaning_run', False) and num == 0
+        if params.get('store_path'):
+            tile_scan['store_path'] = os.path.join(params['store_path'],
+                                                   'tile_%03d_%03d' % (tile['row'], tile['col']))
+        tile_scan = confocal.scanner(stage, pharp, tile_scan)
+        # the first tile is the reference for the rest
+        shift = (0., 0.)
+        if num > 0:
+            shift = register(tile_patch(pyramid, tile_scan), np.asarray(tile_scan['final_map']),
+                             max_shift=scan.get('max_shift', 5))
+            shift = (-shift[0], -shift[1])
+        place_tile(pyramid, tile_scan, shift)
+        tile['shift'] = list(shift)
+        tile['order'] = num
+        pyramid.flush()
+    print("Building the pyramid...")
+    pyramid.header['metadata']['tiles'] = tiles
+    pyramid.header['metadata']['time_taken'] = time() - start_time
+    pyramid.build_levels()
+    return pyramid
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+'''
+Coarse-to-fine confocal scans.
+
+A region is first scanned with a coarse trigger step, the candidate
+emitters are found in the coarse map as the pixels that stand out of
+the background, and only the regions of interest around them are then
+scanned with the fine trigger step. Every pass is a scan done by
+confocal.scanner.
+
+All passes are put into a pyramid, a list of levels, one per trigger
+step, each level being a map of the whole region in which the pixels
+that were not scanned are nan. The pixel (i, j) of a level with
+origin (x0, y0) and pixel size dx has its center at the stage
+coordinates (x0 + (j + 0.5) dx, y0 + (i + 0.5) dx).
+
+Usage
+-----
+scan = {'xi': 0., 'xf': 0.1, 'yi': 0., 'yf': 0.1,
+        'dx': 0.0005, 'coarse_dx': 0.002, ...}
+pyramid = multires_scanner(stage, pharp, scan)
+'''
+
+import os
+import numpy as np
+from time import time
+from scipy import ndimage
+from zialab.instruments import confocal
+from zialab.analysis.localization import background_level
+
+def pixel_centers(scan):
+    '''
+    Stage coordinates of the centers of the pixels of a scan done
+    by confocal.scanner, the columns are taken from the trigger
+    step and the rows from scan['ys'].
+
+    Returns
+    -------
+    xs, ys (np.array): in mm
+    '''
+    num_rows, num_cols = np.shape(scan['final_map'])
+    xs = scan['xi'] + (np.arange(num_cols) + 0.5) * scan['dx']
+    ys = np.asarray(scan['ys'])[:num_rows]
+    return xs, ys
+
+def merge_rois(rois):
+    '''
+    Merge overlapping regions of interest (xi, xf, yi, yf)
+    until none overlap.
+    '''
+    rois = [list(roi) for roi in rois]
+    merged = True
+    while merged:
+        merged = False
+        for a in range(len(rois)):
+            for b in range(a + 1, len(rois)):
+                ra, rb = rois[a], rois[b]
+                if ra[0] <= rb[1] and rb[0] <= ra[1] and ra[2] <= rb[3] and rb[2] <= ra[3]:
+                    rois[a] = [min(ra[0], rb[0]), max(ra[1], rb[1]),
+                               min(ra[2], rb[2]), max(ra[3], rb[3])]
+                    del rois[b]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(roi) for roi in rois]
+
+def detect_rois(final_map, xs, ys, nsigma=5., pad=0.002, min_size=0.01, min_pixels=1):
+    '''
+    Regions of interest around the pixels of a coarse map that are
+    nsigma above the background, connected pixels make one region.
+
+    Parameters
+    ----------
+    final_map  (np.array): coarse map
+    xs, ys     (np.array): stage coordinates of the columns and rows, in mm
+    nsigma     (float): threshold above the background in robust standard deviations
+    pad        (float): margin around every group of pixels, in mm
+    min_size   (float): regions are enlarged to at least this size, in mm
+    min_pixels (int): smaller groups of pixels are ignored
+
+    Returns
+    -------
+    rois (list): of (xi, xf, yi, yf) in mm, with overlapping regions merged.
+    '''
+    background, noise = background_level(final_map)
+    candidates = np.nan_to_num(final_map, nan=background) > background + nsigma * noise
+    labels, num_labels = ndimage.label(candidates)
+    if num_labels == 0:
+        return []
+    sizes = np.bincount(labels.ravel(), minlength=num_labels + 1)[1:]
+    rois = []
+    for size, (rows, cols) in zip(sizes, ndimage.find_objects(labels)):
+        if size < min_pixels:
+            continue
+        xi, xf = xs[cols.start] - pad, xs[cols.stop - 1] + pad
+        yi, yf = ys[rows.start] - pad, ys[rows.stop - 1] + pad
+        # small regions grow around their center
+        xc, yc = (xi + xf) / 2, (yi + yf) / 2
+        half_x, half_y = max(xf - xi, min_size) / 2, max(yf - yi, min_size) / 2
+        rois.append((xc - half_x, xc + half_x, yc - half_y, yc + half_y))
+    return merge_rois(rois)
+
+def snap_roi(roi, origin, dx):
+    '''
+    Enlarge a region of interest (xi, xf, yi, yf) to the grid of pixels
+    of size dx that starts at origin = (x0, y0), so that the pixels of
+    its scan fall on the pixels of the level.
+    '''
+    xi, xf, yi, yf = roi
+    x0, y0 = origin
+    return (x0 + np.floor((xi - x0) / dx + 1e-6) * dx,
+            x0 + np.ceil((xf - x0) / dx - 1e-6) * dx,
+            y0 + np.floor((yi - y0) / dx + 1e-6) * dx,
+            y0 + np.ceil((yf - y0) / dx - 1e-6) * dx)
+
+def empty_level(region, dx):
+    '''
+    A level of the pyramid that covers region = (xi, xf, yi, yf)
+    with pixels of size dx, all nan.
+    '''
+    xi, xf, yi, yf = region
+    shape = (int(np.ceil((yf - yi) / dx)), int(np.ceil((xf - xi) / dx)))
+    return {'dx': dx, 'x0': xi, 'y0': yi,
+            'map': np.full(shape, np.nan), 'scans': []}
+
+def level_coords(level):
+    '''
+    Stage coordinates of the centers of the columns and rows of a level.
+    '''
+    num_rows, num_cols = level['map'].shape
+    return (level['x0'] + (np.arange(num_cols) + 0.5) * level['dx'],
+            level['y0'] + (np.arange(num_rows) + 0.5) * level['dx'])
+
+def place_scan(level, scan):
+    '''
+    Put the map of a scan into the level, every pixel going to the
+    pixel of the level that contains its center.
+    '''
+    xs, ys = pixel_centers(scan)
+    # rows are at the positions of the lines, which may fall on the edges of the pixels
+    cols = np.floor((xs - level['x0']) / level['dx']).astype(int)
+    rows = np.floor((ys - level['y0']) / level['dx'] + 1e-6).astype(int)
+    num_rows, num_cols = level['map'].shape
+    inside_cols = (cols >= 0) & (cols < num_cols)
+    inside_rows = (rows >= 0) & (rows < num_rows)
+    final_map = np.asarray(scan['final_map'])[inside_rows][:, inside_cols]
+    level['map'][np.ix_(rows[inside_rows], cols[inside_cols])] = final_map
+    level['scans'].append(scan)
+
+def _pass(params, store_name, **changes):
+    # a scan for one pass, with its own store if the multiresolution scan has one,
+    # and its rows at the centers of the pixels of the levels
+    scan = dict(params)
+    scan.update(changes)
+    scan['grid_rows'] = True
+    if params.get('store_path'):
+        scan['store_path'] = os.path.join(params['store_path'], store_name)
+    return scan
+
+def multires_scanner(stage, pharp, scan):
+    '''
+    Scan the region with the trigger step scan['coarse_dx'], find the
+    candidate emitters, and scan the regions around them with the
+    trigger step scan['dx'].
+
+    scan has the same entries as for confocal.scanner, and optionally
+    coarse_dx   (float): in mm, 5 times dx by default
+    coarse_velx (float): in mm/s, if not given and there is a velx then
+                         velx*coarse_dx/dx, which keeps the dwell time.
+    nsigma      (float): threshold for the candidates, see detect_rois
+    roi_pad     (float): margin around the candidates, in mm
+    roi_size    (float): smallest size of a region of interest, in mm
+
+    Returns
+    -------
+    pyramid (dict): with keys
+                    region (tuple): xi, xf, yi, yf
+                    levels (list): coarse and fine levels, see empty_level
+                    rois (list): regions of interest of the fine scans
+                    time_taken (float): in s
+    '''
+    start_time = time()
+    params = dict(scan)
+    region = (scan['xi'], scan['xf'], scan['yi'], scan['yf'])
+    coarse_dx = scan.get('coarse_dx', 5 * scan['dx'])
+    coarse_changes = {'dx': coarse_dx}
+    if 'coarse_velx' in scan:
+        coarse_changes['velx'] = scan['coarse_velx']
+    elif 'velx' in scan:
+        coarse_changes['velx'] = scan['velx'] * coarse_dx / scan['dx']
+    print("Doing the coarse scan...")
+    coarse = confocal.scanner(stage, pharp, _pass(params, 'coarse', **coarse_changes))
+    coarse_level = empty_level(region, coarse_dx)
+    place_scan(coarse_level, coarse)
+    xs, ys = pixel_centers(coarse)
+    rois = detect_rois(np.asarray(coarse['final_map']), xs, ys,
+                       nsigma=scan.get('nsigma', 5.),
+                       pad=scan.get('roi_pad', 2 * coarse_dx),
+                       min_size=scan.get('roi_size', 0.01))
+    rois = merge_rois([snap_roi(roi, (region[0], region[2]), scan['dx']) for roi in rois])
+    print("Found %d regions of interest." % len(rois))
+    fine_level = empty_level(region, scan['dx'])
+    for idx, (xi, xf, yi, yf) in enumerate(rois):
+        print("Scanning region %d of %d..." % (idx + 1, len(rois)))
+        fine = confocal.scanner(stage, pharp,
+                                _pass(params, 'roi_%02d' % idx, xi=xi, xf=xf, yi=yi, yf=yf,
+                                      cleaning_run=False))
+        place_scan(fine_level, fine)
+    return {'region': region,
+            'levels': [coarse_level, fine_level],
+            'rois': rois,
+            'time_taken': time() - start_time}
@@ -666,6 +666,23 @@ class PicoHarp300():
 
         return (buffer, actual_num_counts)
 
+    def tttr_read_fifo_into(self, buffer):
+        """ Read out the buffer of the FIFO straight into a given array.
+
+        @param numpy.array buffer: uint32 array where the TTTR records are
+                                   stored, at most TTREADMAX long.
+
+        @return int: how many TTTR records were actually read out.
+
+        Same as tttr_read_fifo, but the records go into memory that is
+        allocated once by the caller, see zialab.instruments.fifo_worker.
+        """
+        actual_num_counts = ctypes.c_int32()
+        self.check(self._dll.PH_ReadFiFo(self._deviceID,
+                                         buffer.ctypes.data_as(ctypes.POINTER(ctypes.c_uint32)),
+                                         len(buffer), ctypes.byref(actual_num_counts)))
+        return actual_num_counts.value
+
     def tttr_set_marker_edges(self, me0, me1, me2, me3):
         """ Set the marker edges
 
@@ -5,9 +5,11 @@
 import sys
 import ctypes
 from ctypes import *
-import struct
 import numpy as np
-from time import sleep
+from zialab.instruments.fifo_worker import FifoWorker
+from zialab.instruments.tttr import decode_t2, decode_t3, T2MARKER_CHANNEL
+from zialab.instruments.tttrfile import open_writer, read_records
+from zialab.analysis import correlation, localization
 
 class PH300():
     ph = ctypes.CDLL("phlib64.dll")
@@ -28,7 +30,6 @@ class PH300():
     CFDLevel1 = 150 # you can change this (in mV)
     ###############################################
     # Variables to store information read from DLLs
-    buffer = (ctypes.c_uint * TTREADMAX)()
     hwSerial = ctypes.create_string_buffer(b"", 8)
     hwPartno = ctypes.create_string_buffer(b"", 8)
     hwVersion = ctypes.create_string_buffer(b"", 8)
@@ -48,6 +49,9 @@ class PH300():
         self.fullname = 'PicoQuant - PicoHarp 300'
         self.manual_fname = './zialab/man/' + self.fullname + '.pdf'
         self.platform = sys.platform
+        # the FIFO is read straight into this array
+        self.buffer = np.zeros(self.TTREADMAX, dtype=np.uint32)
+        self.mode = 'T3'
 
     def open(self,mode='T3'):
         '''
@@ -61,6 +65,7 @@ class PH300():
                 print('PicoHarp300:\nPicoharp device found with device index of %d.' % (self.device[0]))
             else:
                 pass
+        self.mode = mode
         if self.ph.PH_Initialize(self.device[0],int(mode[1]))==0:
             self.ph.PH_Calibrate(self.device[0])
             print('Picoharp successfully intialized in T%d mode.\n' % int(mode[1]))
@@ -120,21 +125,50 @@ class PH300():
             else:
                 pass
 
+    def read_fifo_into(self, out):
+        '''
+        Read the FIFO straight into the given uint32 numpy array
+        and return the number of records that were read.
+        '''
+        self.ph.PH_ReadFiFo(self.device[0],
+                            out.ctypes.data_as(POINTER(c_uint)),
+                            len(out),
+                            byref(self.nactual))
+        return self.nactual.value
+
     def read_fifo(self, num_records=TTREADMAX):
         '''
         read the buffer and return a numpy array with its data
         '''
-        buffer = np.zeros(num_records, dtype=np.uint32)
-        actual_num_records = ctypes.c_int32()
-        self._dll.PH_ReadFiFo(self.device[0], buffer.ctypes.data,
-                            num_records, ctypes.byref(actual_num_records))
-        return (buffer, actual_num_records)
+        num_records = self.read_fifo_into(self.buffer[:num_records])
+        return self.buffer[:num_records]
+
+    def tttr_header(self):
+        '''
+        Settings of the measurement to be kept in the header of .tttr files.
+        '''
+        if self.mode == 'T3':
+            self.ph.PH_GetResolution(self.device[0], byref(self.resolution))
+            self.ph.PH_GetCountRate(self.device[0], 0, byref(self.countRate0))
+            resolution = self.resolution.value*1e-12
+            sync_rate = self.countRate0.value
+        else:
+            resolution = 4e-12
+            sync_rate = None
+        return {'mode': self.mode,
+                'resolution': resolution,
+                'sync_rate': sync_rate,
+                'marker_config': None,
+                'sync_divider': self.syncDivider,
+                'binning': self.binning}
 
     def read_buffer(self,output_file,number_of_markers_expected):
         '''
-        read the data/events recorded and stored in the buffer and write the results to an output file.
+        read the data/events recorded and stored in the buffer and write the results to an output file,
+        in the .tttr format of zialab.instruments.tttrfile,
+        or as a PicoQuant .ptu file if output_file ends in .ptu.
         '''
-        with open(output_file,'wb+') as outputfile:
+        with open_writer(output_file, **self.tttr_header()) as writer:
             read_values=0
             counter=0
             while read_values<number_of_markers_expected and counter<5:
@@ -143,13 +177,11 @@ class PH300():
                 if self.flags.value == 48:# or flags.value == 8:
                     break
 
-                self.ph.PH_ReadFiFo(self.device[0], byref(self.buffer), self.TTREADMAX, byref(self.nactual))
-
-                read_values=self.nactual.value
+                read_values = self.read_fifo_into(self.buffer)
                 counter+=1
 
-                if self.nactual.value > 0:
-                    outputfile.write((ctypes.c_uint*self.nactual.value)(*self.buffer[0:self.nactual.value]))
+                if read_values > 0:
+                    writer.write(self.buffer[:read_values])
 
 class PicoHarp300():
     ph = ctypes.CDLL("phlib64.dll")
@@ -170,7 +202,6 @@ class PicoHarp300():
     CFDLevel1 = 150 # you can change this (in mV)
     ###############################################
     # Variables to store information read from DLLs
-    buffer = (ctypes.c_uint * TTREADMAX)()
     hwSerial = ctypes.create_string_buffer(b"", 8)
     hwPartno = ctypes.create_string_buffer(b"", 8)
     hwVersion = ctypes.create_string_buffer(b"", 8)
@@ -190,6 +221,9 @@ class PicoHarp300():
         self.fullname = 'PicoQuant - PicoHarp 300'
         self.manual_fname = './zialab/man/' + self.fullname + '.pdf'
         self.platform = sys.platform
+        # the FIFO is read straight into this array
+        self.buffer = np.zeros(self.TTREADMAX, dtype=np.uint32)
+        self.mode = 'T3'
 
     def open(self,mode='T3'):
         '''
@@ -204,6 +238,7 @@ class PicoHarp300():
                 print('Initializing...')
             else:
                 pass
+        self.mode = mode
         if self.ph.PH_Initialize(self.device[0],int(mode[1]))==0:
             self.ph.PH_Calibrate(self.device[0])
             print('Picoharp successfully intialized in T%d mode.\n' % int(mode[1]))
@@ -272,46 +307,79 @@ class PicoHarp300():
             else:
                 pass
 
+    def read_fifo_into(self, out):
+        '''
+        Read the FIFO straight into the given uint32 numpy array,
+        (through its ctypes pointer, so no copies are made) and
+        return the number of records that were read.
+        '''
+        self.ph.PH_ReadFiFo(self.device[0],
+                        out.ctypes.data_as(POINTER(c_uint)),
+                        len(out),
+                        byref(self.nactual))
+        return self.nactual.value
+
     def buffer_read(self):
+        '''
+        Read the FIFO into the preallocated buffer and return a view
+        on the records that were read, or None if there were none.
+        The view is overwritten by the next read, so it has to be
+        consumed (or copied) before reading again.
+        '''
         # read flags
         self.ph.PH_GetFlags(self.device[0], byref(self.flags))
         if self.flags.value == 48:
             # print("Flag 48")
             return None
-        self.ph.PH_ReadFiFo(self.device[0],
-                        byref(self.buffer),
-                        self.TTREADMAX,
-                        byref(self.nactual))
-        if self.nactual.value > 0:
-            return (ctypes.c_uint*self.nactual.value)(*self.buffer[0:self.nactual.value])
+        num_records = self.read_fifo_into(self.buffer)
+        if num_records > 0:
+            return self.buffer[:num_records]
         else:
             return None
 
-    def read_buffer(self,output_file):
+    def measurement_done(self):
         '''
-        read the data/events recorded and stored in the buffer and write the results to an output file.
+        Return True if the acquisition time of the measurement has ended.
         '''
-        with open(output_file,'wb+') as outputfile:
-            sentinel = 0
-            while True:
-                self.ph.PH_GetFlags(self.device[0], byref(self.flags))
-                if self.flags.value == 48:
-                    print("flag 48")
-                    break
-                if sentinel >= 2:
-                    print("flag 60 break")
-                    break
-                if self.flags.value == 60:
-                    sentinel = sentinel + 1
-                read_val = self.ph.PH_ReadFiFo(self.device[0],
-                                byref(self.buffer),
-                                self.TTREADMAX,
-                                byref(self.nactual))
-                print(self.flags.value, self.nactual.value, read_val)
-                sleep(0.5)
-                if self.nactual.value > 0:
-                    print("writing")
-                    outputfile.write((ctypes.c_uint*self.nactual.value)(*self.buffer[0:self.nactual.value]))
+        self.ph.PH_CTCStatus(self.device[0], byref(self.ctcDone))
+        return self.ctcDone.value > 0
+
+    def tttr_header(self):
+        '''
+        Settings of the measurement to be kept in the header of .tttr files.
+        '''
+        if self.mode == 'T3':
+            self.ph.PH_GetResolution(self.device[0], byref(self.resolution))
+            self.ph.PH_GetCountRate(self.device[0], 0, byref(self.countRate0))
+            resolution = self.resolution.value*1e-12
+            sync_rate = self.countRate0.value
+        else:
+            resolution = 4e-12
+            sync_rate = None
+        return {'mode': self.mode,
+                'resolution': resolution,
+                'sync_rate': sync_rate,
+                'marker_config': None,
+                'sync_divider': self.syncDivider,
+                'binning': self.binning}
+
+    def read_buffer(self,output_file):
+        '''
+        read the data/events recorded and stored in the buffer and write the results to an output file,
+        in the .tttr format of zialab.instruments.tttrfile,
+        or as a PicoQuant .ptu file if output_file ends in .ptu.
+        The FIFO is drained by a FifoWorker until the measurement ends,
+        the statistics of the worker are returned.
+        '''
+        header = self.tttr_header()
+        worker = FifoWorker(self, done=self.measurement_done)
+        worker.start()
+        with open_writer(output_file, **header) as writer:
+            for block in worker.blocks():
+                writer.write(block)
+        if worker.fifo_overrun:
+            print("FIFO overrun, some records were lost.")
+        return worker.stats
 
     # def read_buffer(self,output_file,number_of_markers_expected):
     #     '''
@@ -350,41 +418,36 @@ class TTTR_Functions():
         Input : T2 file.
         Output: Time differences (in ns) between consecutive channels only if chanel 0 gets a count and channel 1 gets another count right after.
         '''
-        inputfile = open(inputfile,'rb')
-        T2WRAPAROUND = 210698240
-        oflcorrection=0
-        truetime=0
-        data=[]
-        while True:
-            try:
-                recordData = "{0:0{1}b}".format(struct.unpack("<I", inputfile.read(4))[0], 32)
-            except:
-                print('\nData parsing complete.')
-                break
-            channel = int(recordData[0:4], base=2)
-            time = int(recordData[4:32], base=2)
-            if channel == 0xF:
-                markers = int(recordData[28:32], base=2)
-                if markers == 0:
-                    oflcorrection += T2WRAPAROUND
-                else:
-                    truetime = oflcorrection + time
-            else:
-                truetime = oflcorrection + time
-                data.append([channel,truetime])
-        T2_data=[]
-        for i in range(len(data)-1):
-            #original time tags have units of 4 picoseconds(default bin width specified in manual).
-            if data[i]==0:
-                if data[i+1]==1:
-                    T2_data.append((data[i+1][1]-data[i][1])*(4e-3))
+        events = decode_t2(read_records(inputfile))
+        events = events[events[:,0] != T2MARKER_CHANNEL]
+        channel = events[:,0]
+        starts = (channel[:-1] == 0) & (channel[1:] == 1)
+        #original time tags have units of 4 picoseconds(default bin width specified in manual).
+        T2_data = np.diff(events[:,1])[starts]*(4e-3)
+        print('\nData parsing complete.')
         return T2_data
 
+    # correlation between channel 0 and channel 1 of a T2 file, in nanoseconds.
+    def T2_correlation(self,inputfile,max_lag=100,bin_width=1,normalize=False):
+        '''
+        Input : T2 file, largest delay and bin width in ns.
+        Output: Centers of the delay bins (in ns), and the histogram of the delays between all
+        pairs of counts in channel 0 and channel 1, normalized to g2 if normalize is True.
+        '''
+        events = decode_t2(read_records(inputfile))
+        events = events[events[:,0] != T2MARKER_CHANNEL]
+        # time tags have units of 4 picoseconds
+        lags, g2 = correlation.g2(events,
+                                  max_lag=int(round(max_lag/4e-3)),
+                                  bin_width=max(1, int(round(bin_width/4e-3))),
+                                  normalize=normalize)
+        return lags*(4e-3), g2
+
 
     def T3_parsing(self, inputfile):
         '''
         Input:  T3 mode file read from the buffer
-        Output: Photon counts between consecutive marker events.
+        Output: array with rows counter, channel, dtime, nsync, truensync for every record.
         '''
         # PicoHarp T3 Format (for analysis and interpretation):
         # The bit allocation in the record for the 32bit event is, starting
@@ -398,41 +461,11 @@ class TTTR_Functions():
         #
         #     If it is zero, the record marks an overflow.
         #     If it is >=1 the individual bits are external markers.
-        T3WRAPAROUND = 65536
-        oflcorrection=0
-        truensync=0
-        T3_data=[]
-        dlen=0
-        data=[]
-        counter = 0
-        with open(inputfile,'rb+') as inputfile:
-            while True:
-                try:
-                    recordData = "{0:0{1}b}".format(struct.unpack("<I", inputfile.read(4))[0], 32)
-                except:
-                    print("wups")
-                    break
-                channel = int(recordData[0:4], base=2)
-                dtime = int(recordData[4:16], base=2)
-                nsync = int(recordData[16:32], base=2)
-                if channel == 0xF:
-                    if dtime == 0:
-                        oflcorrection += T3WRAPAROUND
-                    else:
-                        truensync = oflcorrection + nsync
-                else:
-                    truensync = oflcorrection + nsync
-                    dlen += 1
-                print(counter,channel, dtime, nsync, truensync)
-                counter = counter+1
-                data.append([counter,channel, dtime, nsync, truensync])
-                # if channel == 15:
-                    # print(counter,channel, dtime, nsync, truensync)
-                    # data.append(truensync)
-                    # data.append([counter,channel, dtime, nsync, truensync])
-            # for i in range(len(data)-1):
-            #     T3_data.append(data[i+1]-data[i])
-        inputfile.close()
+        # the records are memory mapped, from a .tttr file or a file of bare records,
+        # and decoded all at once.
+        events = decode_t3(read_records(inputfile))
+        counter = np.arange(1, len(events)+1)
+        data = np.column_stack((counter, events))
         return data
 
 # Functions to run error-proof confocal scans by automating both the picoharp and the stage.
@@ -669,25 +702,29 @@ class Confocal_Functions():
 
     def find_emitters(self,confocal_data,number_of_emitters=1):
         '''
-        an algorithm that finds a number of brightest pixels in a heat map
-        (biggest value elements in a n-dimensional array) and turn that relative
-        location on the map and the absolute position on the stage.
+        Find the brightest emitters in a heat map and their positions on
+        the stage. The emitters are the local maxima above the background,
+        whose positions are fitted with 2D Gaussians to a fraction of a
+        pixel, see zialab.analysis.localization. If there are none the
+        brightest pixel is used.
         '''
-        np_confocal_data=np.array(confocal_data)
+        np_confocal_data=np.array(confocal_data,dtype=float)
         number_of_rows=np_confocal_data.shape[0]
         number_of_columns=np_confocal_data.shape[1]
-        flattened=np_confocal_data.flatten()
-        sorted=flattened.argsort()[-number_of_emitters:]
-        row_index=[]
-        column_index=[]
+        xs=self.x_start+self.trigger_step*np.arange(number_of_columns)
+        ys=self.y_start+self.trigger_step*np.arange(number_of_rows)
+        emitters=localization.localize(np_confocal_data,xs,ys)
+        good=np.flatnonzero(emitters['ok'])[:number_of_emitters]
+        if len(good)==0:
+            row,column=np.unravel_index(np.nanargmax(np_confocal_data),np_confocal_data.shape)
+            print("\n No emitter found, using the brightest pixel.")
+            return [[xs[column],ys[row]]]
         emitter_locations=[]
-        for i in range(1,number_of_emitters+1):
-            remainder=sorted[-i]%number_of_columns
-            row_index.append((sorted[-i]-remainder)/number_of_columns)
-            column_index.append(remainder)
-            emitter_locations.append([column_index[i-1]*self.trigger_step+self.x_start,row_index[i-1]*self.trigger_step+self.y_start])
-            print("\n No.%d brightest spot on image: [%.1f,%.1f]" % (i,column_index[i-1]*self.trigger_step*1000,row_index[i-1]*self.trigger_step*1000))
-            print("\n No.%d brightest spot on stage: [%.4f,%.4f]" % (i,column_index[i-1]*self.trigger_step+self.x_start,row_index[i-1]*self.trigger_step+self.y_start))
+        for i,k in enumerate(good):
+            x,y=emitters['x'][k],emitters['y'][k]
+            emitter_locations.append([x,y])
+            print("\n No.%d brightest spot on image: [%.2f,%.2f] +- [%.2f,%.2f]" % (i+1,(x-self.x_start)*1000,(y-self.y_start)*1000,emitters['x_err'][k]*1000,emitters['y_err'][k]*1000))
+            print("\n No.%d brightest spot on stage: [%.4f,%.4f]" % (i+1,x,y))
         return emitter_locations
 
     def emitter_confocal_scan(self):
@@ -763,16 +800,21 @@ class Confocal_Functions():
                 else:
                     base_rate=new_rate
 
-    def g2_scan(self,acq_time,counts=4,range=[0,100],bins=100):
+    def g2_scan(self,acq_time,counts=4,range=[-100,100],bins=200):
         '''
-        Acquire T2 data and make the g2 plot given plot paramters like range and number of bins.
+        Acquire T2 data and make the g2 plot given plot paramters like range (in ns) and number of bins.
         '''
+        import matplotlib.pyplot as plt
         output_file="C:\\Users\\lab_pc_i\\Desktop\\Yang\\hBN\\Lee's Sample\\%s\\T2_data\\AutoCorrelation-%d.out" % (self.sample_region)
         picoharp.start_measurement(acq_time)
         picoharp.read_buffer(output_file,number_of_markers_expected=self.TTREADMAX)
-        T2_data=self.TTTR_functions.T2_parsing(output_file)
-        plt.hist(T2_data,range=[0,100],bins=100)
+        max_lag = max(abs(range[0]),abs(range[1]))
+        lags, g2 = self.TTTR_functions.T2_correlation(output_file,max_lag=max_lag,
+                                                      bin_width=(range[1]-range[0])/bins)
+        inrange = (lags >= range[0]) & (lags <= range[1])
+        lags, g2 = lags[inrange], g2[inrange]
+        plt.step(lags,g2,where='mid')
         plt.title("AcquisitionTime=%s Counts=%d kcps" % (acq_time,counts))
         plt.xlabel("time(ns)")
         plt.ylabel("Counts")
-        return T2_data
+        return lags, g2
@@ -569,7 +569,8 @@ class Datarecorder(object):
         @param offset : Start point in the table as integer, starts with index 1, overwrites self.offset.
         @param numvalues : Number of points to be read per table as integer, overwrites self.numvalues.
         @param verbose : If True print a line that shows how many values have been read out already.
-        @return : Tuple of (header, data), see qDRR command.
+        @return : Tuple of (header, data), see qDRR command, data is a 2-dimensional numpy array
+        with one row per record table.
         """
         if not self.rectables:
             raise SystemError('rectables are not set')
@@ -580,7 +581,7 @@ class Datarecorder(object):
                 sleep(0.05)
         if verbose:
             print(('\r%s\r' % (' ' * 20)), end='')
-        data = self._gcs.bufdata
+        data = self._gcs.bufarray
         return header, data
 
     def getdata(self, timeout=0, offset=None, numvalues=None):
@@ -588,7 +589,8 @@ class Datarecorder(object):
         @param timeout : Timeout in seconds, is disabled by default.
         @param offset : Start point in the table as integer, starts with index 1, overwrites self.offset.
         @param numvalues : Number of points to be read per table as integer, overwrites self.numvalues.
-        @return : Tuple of (header, data), see qDRR command.
+        @return : Tuple of (header, data), see qDRR command, data is a 2-dimensional numpy array
+        with one row per record table.
         """
         self.wait(timeout)
         self._header, self._data = self.read(offset, numvalues)
@@ -603,7 +605,7 @@ class Datarecorder(object):
 
     @property
     def data(self):
-        """Return data from last controller readout."""
+        """Return data from last controller readout as 2-dimensional numpy array, one row per record table."""
         if self._data is None:
             self.getdata()
         return self._data
@@ -691,6 +691,13 @@ class GCSCommands(object):
         """
         return self.__msgs.bufdata
 
+    @property
+    def bufarray(self):
+        """Get buffered data as 2-dimensional float64 numpy array, one row per column of the answer.
+        Use "while self.bufstate is not True" and then call self.bufarray to get the data.
+        """
+        return self.__msgs.bufarray
+
     def GcsCommandset(self, tosend):
         """Send 'tosend' to device, there will not be any check for error.
         @param tosend : String to send to device, with or without trailing linefeed.
@@ -710,6 +717,16 @@ class GCSCommands(object):
         checksize((1,), tosend)
         self.__msgs.send(tosend)
 
+    def batch(self):
+        """Context manager that sends the commands within it to the device as one message and
+        checks their errors once at the end, raising GCSError for the first command that failed.
+        Example: with pidevice.batch():
+                     pidevice.SVO(1, True)
+                     pidevice.VEL(1, 0.5)
+        """
+        debug('GCSCommands.batch()')
+        return self.__msgs.batch()
+
     def ReadGCSCommand(self, tosend):
         """Send 'tosend' to device, read answer, there will not be any check for error.
         @param tosend : String to send to device.
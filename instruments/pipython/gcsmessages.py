@@ -2,15 +2,29 @@
 # -*- coding: utf-8 -*-
 """Process messages between GCSCommands and an interface."""
 
+from contextlib import contextmanager
 from logging import debug, error
 from threading import RLock, Thread
+import re
 import sys
 from time import time
+import warnings
+import numpy as np
 from zialab.instruments.pipython import gcserror
 from zialab.instruments.pipython.gcserror import GCSError  # prevents cyclic import
 
 __signature__ = 0x55fbdd592d43ddeedcf7575b964faaf5
 
+# a LF without a preceeding SPACE ends a GCS answer
+ENDOFANSWER = re.compile(r'(?<! )\n')
+ENDOFANSWERBYTES = re.compile(br'(?<! )\n')
+# a LF or CR without a preceeding SPACE, the character before is part of the match
+LFNOSPACE = re.compile(r'[^ ][\n\r]')
+# initial number of rows of the data buffer if the number of values is not known
+BUFFERROWS = 1024
+# number of characters of a qDRR answer that are collected before they are converted
+BLOCKCHARS = 65536
+
 
 def eol(rcvbuf):
     """Return True if 'rcvbuf' is complete in terms of GCS syntax.
@@ -38,8 +52,11 @@ class GCSMessages(object):
         debug('create an instance of GCSMessages(interface=%s)', interface)
         self._lock = RLock()
         self._interface = interface
-        self._databuffer = {'size': 0, 'index': 0, 'lastindex': 0, 'lastupdate': None, 'data': [], 'error': None}
+        self._databuffer = {'size': 0, 'index': 0, 'lastindex': 0, 'lastupdate': None, 'data': np.zeros((0, 0)),
+                            'rows': 0, 'error': None}
         self._stopthread = False
+        self._batch = None
+        self._rcvbuf = bytearray()
         self.errcheck = True
         self.embederr = False
 
@@ -92,20 +109,71 @@ class GCSMessages(object):
     def bufdata(self):
         """Get buffered data as 2-dimensional list of float values."""
         debug('GCSMessages.bufdata: %d datasets', self._databuffer['index'])
-        return self._databuffer['data']
+        return self.bufarray.tolist()
+
+    @property
+    def bufarray(self):
+        """Get buffered data as 2-dimensional float64 numpy array, one row per column of the answer."""
+        debug('GCSMessages.bufarray: %d datasets', self._databuffer['rows'])
+        return self._databuffer['data'][:self._databuffer['rows']].T
 
     def send(self, tosend):
         """Send 'tosend' to device and check for error.
+        Within a batch 'tosend' is queued and sent when the batch ends.
         @param tosend : String to send to device, with or without trailing linefeed.
         """
-        if self.embederr and self.errcheck:
-            if len(tosend) > 1 and not tosend.endswith('\n'):
-                tosend += '\n'
-            tosend += 'ERR?\n'
         with self._lock:
+            if self._batch is not None:
+                self._batch.append((tosend, self.errcheck))
+                return
+            if self.embederr and self.errcheck:
+                if len(tosend) > 1 and not tosend.endswith('\n'):
+                    tosend += '\n'
+                tosend += 'ERR?\n'
             self._send(tosend)
             self._checkerror(senderr=not self.embederr)
 
+    @contextmanager
+    def batch(self):
+        """Queue the commands sent within the context and send them to the device as one message
+        when it ends, every command followed by "ERR?" if error checking is on, then read all
+        error answers. Raises GCSError for the first command that failed. A read within the batch
+        sends the queued commands first. If the context raises, the queued commands are dropped.
+        Other threads wait until the batch is sent. Nested batches are sent with the outermost one.
+        """
+        with self._lock:
+            if self._batch is not None:
+                yield
+                return
+            self._batch = []
+            try:
+                yield
+            except:  # No exception type(s) specified pylint: disable=W0702
+                self._batch = None
+                raise
+            self._sendbatch()
+
+    def _sendbatch(self):
+        """Send the queued commands as one message and check the errors of each of them."""
+        commands, self._batch = self._batch, None
+        if not commands:
+            return
+        tosend = ''
+        for command, errcheck in commands:
+            if len(command) > 1 and not command.endswith('\n'):
+                command += '\n'
+            tosend += command + ('ERR?\n' if errcheck else '')
+        debug('GCSMessages: send batch of %d commands', len(commands))
+        self._send(tosend)
+        failed = None
+        for command, errcheck in commands:
+            if errcheck:
+                exc = self._readerror()
+                if exc and failed is None:
+                    failed = GCSError(exc, '@ GCSMessages.batch, command %r' % command.strip())
+        if failed:
+            raise failed  # Raising NoneType while only classes or instances are allowed pylint: disable=E0702
+
     def read(self, tosend, gcsdata=0):
         """Send 'tosend' to device, read answer and check for error.
         @param tosend : String to send to device.
@@ -115,9 +183,14 @@ class GCSMessages(object):
         if gcsdata is not None:
             gcsdata = None if gcsdata < 0 else gcsdata
         stopon = None
+        with self._lock:
+            if self._batch:
+                self._sendbatch()
+                self._batch = []
         if gcsdata != 0:
             stopon = '# END_HEADER'
-            self._databuffer['data'] = []
+            self._databuffer['data'] = np.zeros((0, 0))
+            self._databuffer['rows'] = 0
             self._databuffer['index'] = 0
             self._databuffer['error'] = None
         with self._lock:
@@ -153,33 +226,63 @@ class GCSMessages(object):
 
     def _read(self, stopon):
         """Read answer from device until this ends with linefeed with no preceeding space.
+        The answer is collected as bytes and only the newly received bytes are searched
+        for the end of the answer and for 'stopon', so reading takes linear time.
+        Without 'stopon' the bytes after the first complete answer are kept for the next read.
         @param stopon: Addditional uppercase string that stops reading, too.
         @return : Received data as string.
         """
-        rcvbuf = u''
+        rcvbuf, self._rcvbuf = self._rcvbuf, bytearray()
+        stopon = stopon.encode('cp1252') if stopon else None
         timeout = time() + self.timeout / 1000.
-        while not eol(rcvbuf):
+        searched = 0  # bytes of rcvbuf that were already searched
+        while True:
+            if stopon:
+                # cp1252 has one byte per character, so the last two bytes tell the end of the answer
+                if eol(rcvbuf[-2:].decode('cp1252', errors='replace')):
+                    break
+                # 'stopon' may begin in the bytes searched before
+                if rcvbuf[max(0, searched - len(stopon) + 1):].upper().find(stopon) >= 0:
+                    break
+            else:
+                end = self._answerend(rcvbuf, searched)
+                if end:
+                    # answers that came after this one, e.g. of a batch, are kept for the next read
+                    self._rcvbuf = rcvbuf[end:]
+                    del rcvbuf[end:]
+                    break
+            searched = len(rcvbuf)
             received = self._interface.read()
             if received:
-                rcvbuf += received.decode('cp1252', errors='replace')
+                rcvbuf += received
                 timeout = time() + self.timeout / 1000.
-            if time() > timeout:
+            elif time() > timeout:
                 raise GCSError(gcserror.E_7_COM_TIMEOUT, '@ GCSMessages._read')
-            if stopon and stopon in rcvbuf.upper():
-                break
-        self._check_no_eol(rcvbuf)
-        return rcvbuf
+        answer = rcvbuf.decode('cp1252', errors='replace')
+        self._check_no_eol(answer)
+        return answer
+
+    @staticmethod
+    def _answerend(rcvbuf, searched):
+        """Return the length of the first complete answer in 'rcvbuf' or 0, see eol().
+        @param rcvbuf : Received data as bytearray.
+        @param searched : Number of bytes in 'rcvbuf' that cannot end an answer.
+        """
+        if len(rcvbuf) == 1:
+            return 1 if rcvbuf[0] < 32 else 0
+        match = ENDOFANSWERBYTES.search(rcvbuf, searched)
+        return match.end() if match else 0
 
     @staticmethod
     def _check_no_eol(answer):
         """Check that 'answer' does not contain a LF without a preceeding SPACE except at the end.
         @param answer : Answer to verify as string.
         """
-        for i, char in enumerate(answer[:-1]):
-            if char == '\n' or char == '\r':
-                if i > 0 and answer[i - 1] != ' ':
-                    msg = '@ GCSMessages._check_no_eol: LF/CR at %r' % answer[max(0, i - 10):min(i + 10, len(answer))]
-                    raise GCSError(gcserror.E_1004_PI_UNEXPECTED_RESPONSE, msg)
+        match = LFNOSPACE.search(answer, 0, len(answer) - 1)
+        if match:
+            i = match.start() + 1
+            msg = '@ GCSMessages._check_no_eol: LF/CR at %r' % answer[max(0, i - 10):min(i + 10, len(answer))]
+            raise GCSError(gcserror.E_1004_PI_UNEXPECTED_RESPONSE, msg)
 
     def _readgcsdata(self, strbuf):
         """Start a background task to read out GCS data and save it in the instance.
@@ -188,7 +291,10 @@ class GCSMessages(object):
         if not eol(strbuf):
             strbuf += self._read(stopon=' \n')
         numcolumns = len(strbuf.split('\n')[0].split())
-        self._databuffer['data'] = [[] for _ in range(numcolumns)]
+        size = self._databuffer['size']
+        numrows = size if size and size is not True else BUFFERROWS
+        self._databuffer['data'] = np.empty((numrows, numcolumns))
+        self._databuffer['rows'] = 0
         debug('GCSMessages: start background task to query GCS data')
         self._stopthread = False
         thread = Thread(target=self._fillbuffer, args=(strbuf, lambda: self._stopthread))
@@ -196,43 +302,106 @@ class GCSMessages(object):
 
     def _fillbuffer(self, answer, stop):
         """Read answers and save them as float values into the data buffer.
+        The received chunks are collected until they have at least BLOCKCHARS characters or the
+        answer is complete, then the complete lines are converted at once, see _convertblock.
         An answerline with invalid data (non-number, missing column) will be skipped and error flag is set.
         @param answer : String of already readout answer.
         @param stop : Callback function that stops the loop if True.
         """
         with self._lock:
+            chunks, numchars = [answer], len(answer)
+            last = self._answerendin('', answer)
             while True:
-                lines = answer.splitlines(True)  # keep line endings
-                answer = ''
-                for line in lines:
-                    if '\n' not in line:
-                        answer = line
-                        break
-                    self._convertfloats(line)
-                    if self._endofdata(line):
-                        debug('GCSMessages: end background task to query GCS data')
-                        if not self._databuffer['error']:
-                            self._databuffer['error'] = self._checkerror(doraise=False)
-                        if not self._databuffer['error']:
-                            self._databuffer['size'] = True
-                        return
+                if last or numchars >= BLOCKCHARS:
+                    answer = ''.join(chunks)
+                    if last:
+                        block, answer = answer[:len(answer) - len(chunks[-1]) + last], ''
+                    else:
+                        splitpos = answer.rfind('\n') + 1
+                        block, answer = answer[:splitpos], answer[splitpos:]
+                    chunks, numchars = [answer], len(answer)
+                    if block:
+                        self._convertblock(block)
+                        self._endofdata(block[block.rfind('\n', 0, -1) + 1:])
+                if last:
+                    debug('GCSMessages: end background task to query GCS data')
+                    if not self._databuffer['error']:
+                        self._databuffer['error'] = self._checkerror(doraise=False)
+                    if not self._databuffer['error']:
+                        self._databuffer['size'] = True
+                    return
                 try:
-                    answer += self._read(stopon=' \n')
+                    received = self._read(stopon=' \n')
                 except:  # No exception type(s) specified pylint: disable=W0702
                     exc = GCSError(gcserror.E_1090_PI_GCS_DATA_READ_ERROR, sys.exc_info()[1])
                     self._databuffer['error'] = exc
                     error('GCSMessages: end background task with GCSError: %s', exc)
                     self._databuffer['size'] = True
                     return
+                last = self._answerendin(chunks[-1][-1:], received)
+                chunks.append(received)
+                numchars += len(received)
                 if stop():
                     error('GCSMessages: stop background task to query GCS data')
                     return
 
+    @staticmethod
+    def _answerendin(previous, received):
+        """Return the end of the answer in 'received' or 0, only the new chunk is searched.
+        @param previous : Character received before 'received' or empty string.
+        @param received : Newly received part of the answer as string.
+        @return : Number of characters of 'received' up to and including the end of the answer.
+        """
+        last = ENDOFANSWER.search(previous + received, len(previous))
+        return last.end() - len(previous) if last else 0
+
+    def _convertblock(self, block):
+        """Convert the complete lines in 'block' to float and append them to 'self._databuffer'.
+        The number of items is validated for all lines at once and the block is then parsed with a
+        single call of np.fromstring. If a line has a wrong number of items or an item is not a number
+        the lines are converted one by one with _convertfloats.
+        @param block : Lines of qDRR answer with data values as string, ending with a line feed.
+        """
+        numcolumns = self._databuffer['data'].shape[1]
+        chars = np.frombuffer(block.encode('cp1252', errors='replace'), dtype=np.uint8)
+        linefeeds = chars == ord('\n')
+        numlines = int(np.count_nonzero(linefeeds))
+        blank = linefeeds | (chars == ord(' ')) | (chars == ord('\t')) | (chars == ord('\r'))
+        itemstart = ~blank & np.concatenate(([True], blank[:-1]))
+        lineindex = np.cumsum(linefeeds) - linefeeds
+        numitems = np.bincount(lineindex[itemstart], minlength=numlines)
+        values = None
+        if np.all(numitems == numcolumns):
+            with warnings.catch_warnings():
+                # np.fromstring warns and stops at the first item that is not a number
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(block, sep=' ')
+            if values.size != numlines * numcolumns:
+                values = None
+        if values is None:
+            for line in block.splitlines(True):
+                self._convertfloats(line)
+            return
+        self._appendrows(values.reshape(numlines, numcolumns))
+        self._databuffer['index'] += numlines
+
+    def _appendrows(self, values):
+        """Copy the rows in 'values' into the data buffer, which grows if it is full.
+        @param values : 2-dimensional numpy array with one row per answer line.
+        """
+        data, rows = self._databuffer['data'], self._databuffer['rows']
+        if rows + len(values) > len(data):
+            grown = np.empty((max(2 * len(data), rows + len(values)), data.shape[1]))
+            grown[:rows] = data[:rows]
+            self._databuffer['data'] = data = grown
+        data[rows:rows + len(values)] = values
+        self._databuffer['rows'] = rows + len(values)
+
     def _convertfloats(self, line):
         """Convert items in 'line' to float and append them to 'self._databuffer'.
         @param line : One line in qDRR answer with data values as string.
         """
-        numcolumns = len(self._databuffer['data'])
+        numcolumns = self._databuffer['data'].shape[1]
         msg = 'cannot convert to float: %r' % line
         try:
             values = [float(x) for x in line.split()]
@@ -244,8 +413,7 @@ class GCSMessages(object):
             self._databuffer['error'] = exc
             error('GCSMessages: GCSError: %s', exc)
         else:
-            for i in range(numcolumns):
-                self._databuffer['data'][i].append(values[i])
+            self._appendrows(np.array([values]))
         self._databuffer['index'] += 1
 
     def _endofdata(self, line):
@@ -275,6 +443,15 @@ class GCSMessages(object):
             return 0
         if senderr:
             self._send('ERR?\n')
+        exc = self._readerror()
+        if exc and doraise:
+            raise exc  # Raising NoneType while only classes or instances are allowed pylint: disable=E0702
+        return exc
+
+    def _readerror(self):
+        """Read the answer to "ERR?" from the device.
+        @return : The GCS exception if an error occured else None.
+        """
         answer = self._read(stopon=None)
         exc = None
         try:
@@ -284,6 +461,4 @@ class GCSMessages(object):
         else:
             if err:
                 exc = GCSError(err)
-        if exc and doraise:
-            raise exc  # Raising NoneType while only classes or instances are allowed pylint: disable=E0702
         return exc
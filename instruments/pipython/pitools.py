@@ -2,10 +2,15 @@
 # -*- coding: utf-8 -*-
 """Collection of helpers for using a PI device."""
 
+import asyncio
 from collections import OrderedDict
 from io import open  # Redefining built-in 'open' pylint: disable=W0622
 from logging import debug, info, warning
+from threading import Lock, Thread
 from time import sleep, time
+import warnings
+
+import numpy as np
 
 from zialab.instruments.pipython import GCSError, gcserror
 from zialab.instruments.pipython.gcscommands import getgcsheader, getitemsvaluestuple
@@ -13,6 +18,16 @@ from zialab.instruments.pipython.piparams import applyconfig
 
 __signature__ = 0xb88ce55451588a0561a537d9c4467bbf
 
+# shortest delay between polls in seconds, used once a motion is expected to be done
+MINPOLLDELAY = 0.005
+
+# lines of a GCSArray file that are formatted at once
+GCSARRAYROWS = 100000
+# binary GCSArray files, see savegcsbinary()
+BINARYSUFFIX = '.bin'
+BINARYMAGIC = '# GCSARRAY BINARY \n'
+BINARYALIGN = 64
+
 
 class DeviceStartup(object):  # Too many instance attributes pylint: disable=R0902
     """Provide a "ready to use" PI device."""
@@ -724,57 +739,299 @@ def movetomiddle(pidevice, axes=None):
     pidevice.MOV(targets)
 
 
-def savegcsarray(filepath, header, data):
-    """Save data recorder output to a GCSArray file.
+def movetime(pidevice, targets):
+    """Return the expected time in seconds until all axes reach 'targets', from the distance and
+    the velocity of every axis, and the acceleration ramps if qACC is supported.
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param targets : Dictionary of {axis: target}.
+    @return : Time in seconds as float.
+    """
+    positions = pidevice.qPOS()
+    velocities = pidevice.qVEL()
+    hasacc = pidevice.HasqACC() if hasattr(pidevice, 'HasqACC') else hasattr(pidevice, 'qACC')
+    accelerations = pidevice.qACC() if hasacc else {}
+    duration = 0.
+    for axis, target in targets.items():
+        distance = abs(float(target) - float(positions[axis]))
+        velocity = float(velocities[axis])
+        if velocity <= 0:
+            continue
+        acc = float(accelerations.get(axis, 0))
+        if acc <= 0:
+            duration = max(duration, distance / velocity)
+        elif distance > velocity**2 / acc:
+            duration = max(duration, distance / velocity + velocity / acc)
+        else:  # the axis never reaches its velocity
+            duration = max(duration, 2 * (distance / acc) ** 0.5)
+    return duration
+
+
+async def _inthread(func, *args):
+    """Call the blocking 'func' with 'args' in a worker thread and return its result."""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+# Too many arguments pylint: disable=R0913
+async def asyncwaiton(condition, timeout=60, predelay=0, postdelay=0, polldelay=0.1, expected=0, name='asyncwaiton'):
+    """Wait until 'condition' returns True, without blocking the event loop. 'condition' is called
+    in a worker thread, so waiters for several axes and controllers poll concurrently. The delay
+    between polls is half the time left until 'expected', at most 'polldelay' and at least
+    MINPOLLDELAY, so polls come often when the motion is about to end.
+    @param condition : Function without arguments that returns True when the wait is over.
+    @param timeout : Timeout in seconds as float, defaults to 60 seconds.
+    @param predelay : Time in seconds as float until querying any state from controller.
+    @param postdelay : Additional delay time in seconds as float after reaching desired state.
+    @param polldelay : Longest delay time between polls in seconds as float.
+    @param expected : Expected time in seconds as float until 'condition' is True, see movetime().
+    @param name : Name used in the timeout message.
+    """
+    starttime = time()
+    maxtime = starttime + timeout
+    await asyncio.sleep(predelay)
+    while not await _inthread(condition):
+        if time() > maxtime:
+            raise SystemError('%s() timed out after %.1f seconds' % (name, timeout))
+        timeleft = starttime + expected - time()
+        await asyncio.sleep(min(polldelay, max(MINPOLLDELAY, timeleft / 2.)))
+    await asyncio.sleep(postdelay)
+
+
+async def asyncwaitonready(pidevice, timeout=60, predelay=0, polldelay=0.1):
+    """Wait until controller is on "ready" state and finally query controller error, see waitonready().
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param timeout : Timeout in seconds as float, defaults to 60 seconds.
+    @param predelay : Time in seconds as float until querying any state from controller.
+    @param polldelay : Delay time between polls in seconds as float.
+    """
+    if not pidevice.HasIsControllerReady():
+        await asyncio.sleep(predelay)
+        return
+    await asyncwaiton(pidevice.IsControllerReady, timeout=timeout, predelay=predelay, polldelay=polldelay,
+                      name='asyncwaitonready')
+    await _inthread(pidevice.checkerror)
+
+
+# Too many arguments pylint: disable=R0913
+async def asyncwaitontarget(pidevice, axes=None, timeout=60, predelay=0, postdelay=0, polldelay=0.1, expected=0):
+    """Wait until all closedloop 'axes' are on target, see waitontarget().
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param axes : Axes to wait for as string or list/tuple, or None to wait for all axes.
+    @param timeout : Timeout in seconds as float, defaults to 60 seconds.
+    @param predelay : Time in seconds as float until querying any state from controller.
+    @param postdelay : Additional delay time in seconds as float after reaching desired state.
+    @param polldelay : Longest delay time between polls in seconds as float.
+    @param expected : Expected time in seconds as float until the axes are on target, see movetime().
+    """
+    axes = getaxeslist(pidevice, axes)
+    if not axes:
+        return
+    await asyncwaitonready(pidevice, timeout=timeout, predelay=predelay)
+    servo = await _inthread(pidevice.qSVO, axes)
+    axes = [x for x in axes if servo[x]]
+    await asyncwaiton(lambda: all(list(pidevice.qONT(axes).values())), timeout=timeout, postdelay=postdelay,
+                      polldelay=polldelay, expected=expected, name='asyncwaitontarget')
+
+
+# Too many arguments pylint: disable=R0913
+async def asyncwaitonreferencing(pidevice, axes=None, timeout=180, predelay=0, postdelay=0, polldelay=0.1):
+    """Wait until referencing of 'axes' is finished or timeout, see waitonreferencing().
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param axes : Axis or list/tuple of axes to wait for motion to finish or None for all axes.
+    @param timeout : Timeout in seconds as float for trajectory and motion, defaults to 180 seconds.
+    @param predelay : Time in seconds as float until querying any state from controller.
+    @param postdelay : Additional delay time in seconds as float after reaching desired state.
+    @param polldelay : Delay time between polls in seconds as float.
+    """
+    axes = getaxeslist(pidevice, axes)
+    if not axes:
+        return
+    await asyncwaitontarget(pidevice, axes=axes, timeout=timeout, predelay=predelay)
+    if pidevice.devname in ('C-843',):
+        pidevice.errcheck = False
+    try:
+        await asyncwaiton(lambda: all(list(pidevice.qFRF(axes).values())), timeout=timeout, postdelay=postdelay,
+                          polldelay=polldelay, name='asyncwaitonreferencing')
+    except SystemError:
+        await _inthread(stopall, pidevice)
+        raise
+    if pidevice.devname in ('C-843',):
+        pidevice.errcheck = True
+
+
+# Too many arguments pylint: disable=R0913
+async def asyncwaitonwavegen(pidevice, wavegens=None, timeout=60, predelay=0, postdelay=0, polldelay=0.1):
+    """Wait until all 'wavegens' are finished, see waitonwavegen().
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param wavegens : Integer convertible or list/tuple of them or None.
+    @param timeout : Timeout in seconds as float, defaults to 60 seconds.
+    @param predelay : Time in seconds as float until querying any state from controller.
+    @param postdelay : Additional delay time in seconds as float after reaching desired state.
+    @param polldelay : Delay time between polls in seconds as float.
+    """
+    await asyncwaitonready(pidevice, timeout=timeout, predelay=predelay)
+    await asyncwaiton(lambda: not any(list(pidevice.IsGeneratorRunning(wavegens).values())), timeout=timeout,
+                      postdelay=postdelay, polldelay=polldelay, name='asyncwaitonwavegen')
+
+
+async def asyncmoveandwait(pidevice, axes, values=None, timeout=120):
+    """Call MOV with 'axes' and 'values' and wait for motion to finish, polling more often when
+    the motion is expected to end, see movetime().
+    @type pidevice : pipython.gcscommands.GCSCommands
+    @param axes : Dictionary of axis:target or list/tuple of axes or axis.
+    @param values : Optional list of values or value.
+    @param timeout : Seconds as float until SystemError is raised.
+    """
+    targets = dict(zip(*getitemsvaluestuple(axes, values)))
+    expected = await _inthread(movetime, pidevice, targets)
+    await _inthread(pidevice.MOV, axes, values)
+    await asyncwaitontarget(pidevice, axes=list(targets.keys()), timeout=timeout, expected=expected)
+
+
+_EVENTLOOP = {'loop': None, 'lock': Lock()}
+
+
+def eventloop():
+    """Return the event loop that runs the waiters started with waitfuture(), it runs in a
+    daemon thread that is started on the first call.
+    @return : Instance of asyncio.AbstractEventLoop.
+    """
+    with _EVENTLOOP['lock']:
+        if _EVENTLOOP['loop'] is None:
+            loop = asyncio.new_event_loop()
+            thread = Thread(target=loop.run_forever, name='pitools.eventloop', daemon=True)
+            thread.start()
+            _EVENTLOOP['loop'] = loop
+        return _EVENTLOOP['loop']
+
+
+def waitfuture(coroutine):
+    """Run 'coroutine', e.g. asyncmoveandwait(), on eventloop() and return at once, so that waits
+    on several devices overlap. Call result() of the returned future to wait for the end.
+    @param coroutine : Awaitable of the asyncwaiton... functions.
+    @return : Instance of concurrent.futures.Future.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, eventloop())
+
+
+def _gcsarraydata(data):
+    """Return 'data' as two dimensional float64 NumPy array with one row per column of the file.
+    @param data : One or two dimensional list of floats or NumPy array.
+    """
+    data = np.asarray(data, dtype=float)
+    if data.ndim < 2:  # data must be multi dimensional
+        data = data.reshape(1, -1)
+    return data
+
+
+def _gcsarrayheader(header, data):
+    """Return 'header' or the default GCSArray header for 'data' as text.
+    @param header : Header information from qDRR() as dictionary or None.
+    @param data : Two dimensional NumPy array, see _gcsarraydata().
+    @return : Tuple (header, headerstr).
+    """
+    if header is None:
+        header = OrderedDict([('VERSION', 1), ('TYPE', 1), ('SEPARATOR', 32), ('DIM', data.shape[0]),
+                              ('NDATA', data.shape[1])])
+    headerstr = ''.join('# %s = %s \n' % (key, value) for key, value in header.items())
+    return header, headerstr + '# \n# END_HEADER \n'
+
+
+def savegcsarray(filepath, header, data, binary=False):
+    """Save data recorder output to a GCSArray file. The values are formatted for blocks of
+    GCSARRAYROWS lines at once.
     @param filepath : Full path to target file as string.
     @param header : Header information from qDRR() as dictionary or None.
     @param data : Datarecorder data as one or two dimensional list of floats or NumPy array.
+    @param binary : If True also save the data to the binary file 'filepath' + BINARYSUFFIX,
+    see savegcsbinary().
     """
     debug('save %r', filepath)
-    try:
-        data = data.tolist()  # convert numpy array to list
-    except AttributeError:
-        pass  # data already is a list
-    if not isinstance(data[0], list):  # data must be multi dimensional
-        data = [data]
-    if header is None:
-        header = OrderedDict([('VERSION', 1), ('TYPE', 1), ('SEPARATOR', 32), ('DIM', len(data)),
-                              ('NDATA', len(data[0]))])
+    data = _gcsarraydata(data)
+    header, out = _gcsarrayheader(header, data)
     sep = chr(header['SEPARATOR'])
-    out = ''
-    for key, value in header.items():
-        out += '# %s = %s \n' % (key, value)
-    out += '# \n# END_HEADER \n'
-    for values in map(list, zip(*data)):  # transpose data
-        out += sep.join(['%f' % value for value in values]) + ' \n'
-    out = out[:-2] + '\n'
-    piwrite(filepath, out)
+    numcolumns, numrows = data.shape
+    linefmt = sep.join(['%f'] * numcolumns) + ' \n'
+    with open(filepath, 'w', encoding='utf-8', newline='\n') as fobj:
+        for first in range(0, numrows, GCSARRAYROWS):
+            block = data[:, first:first + GCSARRAYROWS]
+            fobj.write(out)
+            out = (linefmt * block.shape[1]) % tuple(block.T.ravel())
+        fobj.write(out[:-2] + '\n')
+    if binary:
+        savegcsbinary(filepath + BINARYSUFFIX, header, data)
 
 
 def readgcsarray(filepath):
-    """Read a GCSArray file and return header and data.
+    """Read a GCSArray file and return header and data. The data are always read from the text
+    file, use readgcsbinary() to memory map the binary file saved next to it.
     @param filepath : Full path to file as string.
     @return header : Header information from qDRR() as dictionary.
-    @return data : Datarecorder data as two columns list of floats.
+    @return data : Datarecorder data as two dimensional float64 NumPy array, one row per column.
     """
     debug('read %r', filepath)
-    headerstr, datastr = [], []
+    headerstr = []
     with open(filepath, 'r', encoding='utf-8', newline='\n') as fobj:
-        for line in fobj:
-            if line.startswith('#'):
-                headerstr.append(line)
-            else:
-                datastr.append(line)
-    header = getgcsheader('\n'.join(headerstr))
-    sep = chr(header['SEPARATOR'])
-    numcolumns = header['DIM']
-    data = [[] for _ in range(numcolumns)]
-    for line in datastr:
-        if not line.strip():
-            continue
-        values = [float(x) for x in line.strip().split(sep)]
-        for i in range(numcolumns):
-            data[i].append(values[i])
+        while True:
+            datapos = fobj.tell()
+            line = fobj.readline()
+            if not line.startswith('#'):
+                break
+            headerstr.append(line)
+        header = getgcsheader(''.join(headerstr))
+        sep = chr(header['SEPARATOR'])
+        numcolumns = header['DIM']
+        fobj.seek(datapos)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)  # file without data
+            data = np.loadtxt(fobj, delimiter=None if sep.isspace() else sep, comments='#',
+                              usecols=range(numcolumns), ndmin=2)
+    return header, data.reshape(-1, numcolumns).T
+
+
+def savegcsbinary(filepath, header, data):
+    """Save data recorder output to a binary GCSArray file: the GCSArray header, preceeded by
+    BINARYMAGIC and padded with spaces to a multiple of BINARYALIGN bytes, followed by the data
+    as little endian float64 values, one column of the data after the other.
+    @param filepath : Full path to target file as string.
+    @param header : Header information from qDRR() as dictionary or None.
+    @param data : Datarecorder data as one or two dimensional list of floats or NumPy array.
+    """
+    debug('save %r', filepath)
+    data = _gcsarraydata(data)
+    header, headerstr = _gcsarrayheader(header, data)
+    headerstr = '%s# SHAPE = %d %d \n%s' % (BINARYMAGIC, data.shape[0], data.shape[1], headerstr)
+    headerstr = headerstr.encode('utf-8')
+    headerstr += b' ' * (-len(headerstr) % BINARYALIGN)
+    with open(filepath, 'wb') as fobj:
+        fobj.write(headerstr)
+        fobj.write(np.ascontiguousarray(data, dtype='<f8').tobytes())
+
+
+def readgcsbinary(filepath, mmap=True):
+    """Read a binary GCSArray file, see savegcsbinary().
+    @param filepath : Full path to file as string.
+    @param mmap : If True the data are memory mapped read only, else read into memory.
+    @return header : Header information from qDRR() as dictionary.
+    @return data : Datarecorder data as two dimensional float64 NumPy array, one row per column.
+    """
+    debug('read %r', filepath)
+    with open(filepath, 'rb') as fobj:
+        if fobj.readline().decode('utf-8') != BINARYMAGIC:
+            raise ValueError('%r is not a binary GCSArray file' % filepath)
+        lines = []
+        while not lines or 'END_HEADER' not in lines[-1]:
+            line = fobj.readline().decode('utf-8')
+            if not line:
+                raise ValueError('%r has no END_HEADER' % filepath)
+            lines.append(line)
+        offset = fobj.tell()
+    offset += -offset % BINARYALIGN
+    header = getgcsheader(''.join(lines))
+    shape = tuple(int(x) for x in str(header.pop('SHAPE')).split())
+    if mmap:
+        data = np.memmap(filepath, dtype='<f8', mode='r', offset=offset, shape=shape)
+    else:
+        data = np.fromfile(filepath, dtype='<f8', offset=offset).reshape(shape)
     return header, data
 
 
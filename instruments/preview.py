@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+'''
+Live preview of confocal scans.
+
+The scan publishes every finished row to an image in shared memory,
+which a viewer in another process (gui/scanview.py) reads. Next to the
+image there is a version number for every row, so the viewer only
+copies and draws the rows that changed since it last looked. Publishing
+a row is a copy into memory, the scan never waits for the viewer.
+
+The shared memory has a header of HEADER_SIZE int64, the number of
+rows and columns, a flag set when the scan is done and a flag set by
+the viewer once it has attached, followed by the int64 versions of the
+rows and the float64 image. The memory is only released when the viewer
+has attached, or gave up, so that short scans do not vanish before
+their viewer is up.
+
+Usage
+-----
+preview = ScanPreview(num_rows, num_cols, title='flake 7')
+preview.launch_viewer()
+preview.publish_row(idx, scan['final_map'][idx])
+preview.close()
+'''
+
+import os
+import sys
+import subprocess
+import numpy as np
+from time import sleep, time
+from multiprocessing import shared_memory
+
+HEADER_SIZE = 4 # rows, cols, done, attached
+ATTACH_TIMEOUT = 30. # s, longest wait for the viewer to attach when closing
+VIEWER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gui', 'scanview.py')
+
+def _views(buffer, num_rows, num_cols):
+    header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=buffer)
+    versions = np.ndarray((num_rows,), dtype=np.int64, buffer=buffer, offset=8*HEADER_SIZE)
+    image = np.ndarray((num_rows, num_cols), dtype=np.float64, buffer=buffer,
+                       offset=8*(HEADER_SIZE + num_rows))
+    return header, versions, image
+
+def attach(name):
+    '''
+    Attach to the shared memory of a preview by its name.
+
+    Returns
+    -------
+    shm                     (SharedMemory): keep it open while the views are used
+    header, versions, image (np.array)
+    '''
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 the resource tracker of this process would
+        # remove the memory when it exits, which is the job of the scan
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    num_rows, num_cols = np.ndarray((2,), dtype=np.int64, buffer=shm.buf)
+    views = _views(shm.buf, int(num_rows), int(num_cols))
+    views[0][3] = 1 # the scan may release the memory now
+    return (shm,) + views
+
+class ScanPreview():
+    '''
+    The publishing side of the live preview of a scan.
+    '''
+
+    def __init__(self, num_rows, num_cols, title='scan', extent=None):
+        '''
+        Parameters
+        ----------
+        num_rows, num_cols (int): of the map
+        title              (str): of the viewer window
+        extent             (tuple): xi, xf, yi, yf of the map in mm, for the axes of the viewer
+        '''
+        self.title = title
+        self.extent = extent
+        size = 8 * (HEADER_SIZE + num_rows + num_rows * num_cols)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.header, self.versions, self.image = _views(self.shm.buf, num_rows, num_cols)
+        self.header[:] = [num_rows, num_cols, 0, 0]
+        self.versions[:] = 0
+        self.image[:] = np.nan
+        self.viewer = None
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def launch_viewer(self):
+        '''
+        Start gui/scanview.py in its own process, looking at this preview.
+        '''
+        command = [sys.executable, VIEWER, self.name, '--title', self.title]
+        if self.extent is not None:
+            command += ['--extent'] + ['%r' % float(e) for e in self.extent]
+        self.viewer = subprocess.Popen(command)
+        return self.viewer
+
+    def publish_row(self, idx, row):
+        '''
+        Copy a finished row to the preview.
+        '''
+        n = min(len(row), self.image.shape[1])
+        self.image[idx, :n] = row[:n]
+        self.versions[idx] += 1
+
+    def publish(self, image):
+        '''
+        Copy all the rows of an image, e.g. the rows already done when a scan is resumed.
+        '''
+        for idx, row in enumerate(image):
+            self.publish_row(idx, row)
+
+    def close(self, timeout=ATTACH_TIMEOUT):
+        '''
+        Tell the viewer that the scan is done and release the shared
+        memory, the viewer keeps showing the last image. If the viewer
+        was launched but has not attached yet, wait for it at most
+        timeout seconds, or until its process has ended.
+        '''
+        if self.shm is None:
+            return
+        self.header[2] = 1
+        start = time()
+        while (self.viewer is not None and not self.header[3]
+               and self.viewer.poll() is None and time() - start < timeout):
+            sleep(0.05)
+        del self.header, self.versions, self.image
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.shm = None
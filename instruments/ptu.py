@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+'''
+Reading and writing of the PicoQuant .ptu (TTTR records) and .phu
+(histograms) files.
+
+Both start with a magic string and a version, followed by a list of
+tags, each one being a 32 byte identifier, a 4 byte index, a 4 byte
+type and an 8 byte value, which for strings and arrays is the length
+of the data that follows the tag. The list ends with the tag
+Header_End, after which come the records or the histograms.
+
+Only the PicoHarp 300 record types are supported, their records
+have the same format as those read from the FIFO, so they are
+decoded with zialab.instruments.tttr. The records are memory mapped
+and decoded in chunks, so that files of any size can be histogrammed
+with bounded memory.
+'''
+
+import os
+import struct
+import numpy as np
+from datetime import datetime
+from zialab.instruments.tttr import T2Decoder, T3Decoder
+
+PTU_MAGIC = b'PQTTTR\x00\x00'
+PHU_MAGIC = b'PQHISTO\x00'
+VERSION = b'1.0.00\x00\x00'
+CHUNK_SIZE = 1048576 # records decoded at once
+
+# tag types
+tyEmpty8 = 0xFFFF0008
+tyBool8 = 0x00000008
+tyInt8 = 0x10000008
+tyBitSet64 = 0x11000008
+tyColor8 = 0x12000008
+tyFloat8 = 0x20000008
+tyTDateTime = 0x21000008
+tyFloat8Array = 0x2001FFFF
+tyAnsiString = 0x4001FFFF
+tyWideString = 0x4002FFFF
+tyBinaryBlob = 0xFFFFFFFF
+
+# record types
+rtPicoHarpT3 = 0x00010303
+rtPicoHarpT2 = 0x00010203
+RECORD_MODES = {rtPicoHarpT2: 'T2', rtPicoHarpT3: 'T3'}
+
+def _tdatetime(days):
+    # TDateTime counts days since 1899-12-30
+    return (days - 25569) * 86400
+
+def _to_tdatetime(timestamp):
+    return timestamp / 86400 + 25569
+
+def _tag_key(ident, idx):
+    return ident if idx == -1 else '%s(%d)' % (ident, idx)
+
+def read_tags(f):
+    '''
+    Read the tags of an open .ptu or .phu file.
+
+    Returns
+    -------
+    magic  (bytes): PTU_MAGIC or PHU_MAGIC
+    tags   (dict): values by tag name, the name of
+                   indexed tags is followed by (idx).
+    offset (int): where the data starts
+    '''
+    magic = f.read(8)
+    if magic not in (PTU_MAGIC, PHU_MAGIC):
+        raise ValueError('Not a PicoQuant .ptu or .phu file.')
+    f.read(8) # version
+    tags = {}
+    while True:
+        ident, idx, typ, raw = struct.unpack('<32siI8s', f.read(48))
+        ident = ident.split(b'\x00')[0].decode('ascii')
+        if typ in (tyEmpty8, tyBool8, tyInt8, tyBitSet64, tyColor8):
+            value = struct.unpack('<q', raw)[0]
+            if typ == tyBool8:
+                value = bool(value)
+            elif typ == tyEmpty8:
+                value = None
+        elif typ == tyFloat8:
+            value = struct.unpack('<d', raw)[0]
+        elif typ == tyTDateTime:
+            value = _tdatetime(struct.unpack('<d', raw)[0])
+        else:
+            length = struct.unpack('<q', raw)[0]
+            data = f.read(length)
+            if typ == tyFloat8Array:
+                value = np.frombuffer(data, dtype='<f8')
+            elif typ == tyAnsiString:
+                value = data.split(b'\x00')[0].decode('latin-1')
+            elif typ == tyWideString:
+                value = data.decode('utf-16-le').split('\x00')[0]
+            elif typ == tyBinaryBlob:
+                value = data
+            else:
+                raise ValueError('Unknown tag type %x of %s.' % (typ, ident))
+        if ident == 'Header_End':
+            break
+        tags[_tag_key(ident, idx)] = value
+    return magic, tags, f.tell()
+
+class PTUFile():
+    '''
+    Read a .ptu file with PicoHarp 300 T2 or T3 records.
+    The records are memory mapped and decoded on demand.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, self.tags, self.offset = read_tags(f)
+        if magic != PTU_MAGIC:
+            raise ValueError('%s is not a .ptu file.' % path)
+        rectype = self.tags['TTResultFormat_TTTRRecType']
+        if rectype not in RECORD_MODES:
+            raise ValueError('Record type %x is not supported, '
+                             'only PicoHarp 300 T2 and T3.' % rectype)
+        self.mode = RECORD_MODES[rectype]
+        self.num_records = int(self.tags['TTResult_NumberOfRecords'])
+        # the time unit of the records, dtime in T3 and the time tags in T2
+        self.resolution = self.tags.get('MeasDesc_Resolution')
+        # the time unit of truensync in T3
+        self.global_resolution = self.tags.get('MeasDesc_GlobalResolution')
+        self.sync_rate = self.tags.get('TTResult_SyncRate')
+        available = (os.path.getsize(path) - self.offset) // 4
+        self.num_records = min(self.num_records, available)
+        if self.num_records:
+            self.records = np.memmap(path, dtype='<u4', mode='r',
+                                     offset=self.offset, shape=(self.num_records,))
+        else:
+            self.records = np.zeros(0, dtype='<u4')
+
+    def __len__(self):
+        return self.num_records
+
+    def decoder(self):
+        return T3Decoder() if self.mode == 'T3' else T2Decoder()
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        '''
+        Yield the decoded records, chunk_size records at a time.
+        '''
+        decoder = self.decoder()
+        for start in range(0, self.num_records, chunk_size):
+            yield decoder.decode(self.records[start:start + chunk_size])
+
+    def read(self):
+        '''
+        Decode all records at once.
+        '''
+        return self.decoder().decode(self.records)
+
+    def histogram(self, channel=None, num_bins=4096, chunk_size=CHUNK_SIZE):
+        '''
+        Histogram of the dtimes of a T3 file, the TCSPC histogram,
+        computed chunk by chunk.
+
+        Parameters
+        ----------
+        channel  (int): if None, photons in all channels are counted
+        num_bins (int): 4096 for all dtimes of the PicoHarp
+        '''
+        if self.mode != 'T3':
+            raise ValueError('Only T3 files have dtimes.')
+        counts = np.zeros(num_bins, dtype=np.int64)
+        for events in self.chunks(chunk_size):
+            photons = (events[:, 0] != 0xF) if channel is None else (events[:, 0] == channel)
+            counts += np.bincount(events[photons, 1], minlength=num_bins)[:num_bins]
+        return counts
+
+    def to_tttr(self, path, chunk_size=CHUNK_SIZE):
+        '''
+        Convert to a .tttr file of zialab.instruments.tttrfile.
+        '''
+        from zialab.instruments.tttrfile import TTTRWriter
+        with TTTRWriter(path, mode=self.mode, resolution=self.resolution,
+                        sync_rate=self.sync_rate) as writer:
+            for start in range(0, self.num_records, chunk_size):
+                writer.write(self.records[start:start + chunk_size])
+
+    def close(self):
+        self.records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_phu(path):
+    '''
+    Read the histograms of a .phu file.
+
+    Returns
+    -------
+    tags       (dict)
+    histograms (list): memory mapped uint32 arrays, one per curve
+    '''
+    with open(path, 'rb') as f:
+        magic, tags, offset = read_tags(f)
+    if magic != PHU_MAGIC:
+        raise ValueError('%s is not a .phu file.' % path)
+    histograms = []
+    for i in range(int(tags['HistoResult_NumberOfCurves'])):
+        histograms.append(np.memmap(path, dtype='<u4', mode='r',
+                                    offset=tags['HistResDscr_DataOffset(%d)' % i],
+                                    shape=(int(tags['HistResDscr_HistogramBins(%d)' % i]),)))
+    return tags, histograms
+
+def _pack_tag(ident, value, idx=-1, typ=None):
+    if typ is None:
+        if isinstance(value, bool):
+            typ = tyBool8
+        elif isinstance(value, (int, np.integer)):
+            typ = tyInt8
+        elif isinstance(value, (float, np.floating)):
+            typ = tyFloat8
+        elif isinstance(value, str):
+            typ = tyAnsiString
+        elif value is None:
+            typ = tyEmpty8
+        else:
+            raise ValueError('Cannot write tag %s of type %s.' % (ident, type(value)))
+    head = struct.pack('<32siI', ident.encode('ascii'), idx, typ)
+    if typ in (tyEmpty8, tyBool8, tyInt8, tyBitSet64, tyColor8):
+        return head + struct.pack('<q', int(value or 0))
+    elif typ == tyFloat8:
+        return head + struct.pack('<d', value)
+    elif typ == tyTDateTime:
+        return head + struct.pack('<d', _to_tdatetime(value))
+    elif typ == tyAnsiString:
+        # strings are null terminated and padded to multiples of 8 bytes
+        data = value.encode('latin-1') + b'\x00'
+        data = data.ljust(-(-len(data) // 8) * 8, b'\x00')
+        return head + struct.pack('<q', len(data)) + data
+    else:
+        raise ValueError('Cannot write tags of type %x.' % typ)
+
+class PTUWriter():
+    '''
+    Write PicoHarp 300 records to a .ptu file, that can be
+    opened with the PicoQuant software. The number of
+    records is filled in when the writer is closed.
+
+    Takes the same arguments as tttrfile.TTTRWriter, so that
+    either can be used in the acquisition.
+    '''
+
+    def __init__(self, path, mode='T3', resolution=None, sync_rate=None,
+                 marker_config=None, comment='', **metadata):
+        '''
+        Parameters
+        ----------
+        path       (str)
+        mode       (str): 'T2' or 'T3'
+        resolution (float): in s, of dtime in T3 and of the time tags in T2
+        sync_rate  (float): in Hz
+        comment    (str)
+        metadata   : more ints, floats, or strings to be kept as tags.
+        '''
+        if mode not in ('T2', 'T3'):
+            raise ValueError('mode must be T2 or T3.')
+        if resolution is None:
+            resolution = 4e-12
+        self.path = path
+        self.num_records = 0
+        self._file = open(path, 'wb')
+        self._file.write(PTU_MAGIC + VERSION)
+        tags = [_pack_tag('File_Comment', comment),
+                _pack_tag('File_CreatingTime', datetime.now().timestamp(), typ=tyTDateTime),
+                _pack_tag('HW_Type', 'PicoHarp'),
+                _pack_tag('Measurement_Mode', int(mode[1])),
+                _pack_tag('Measurement_SubMode', 1 if mode == 'T3' else 0),
+                _pack_tag('TTResultFormat_TTTRRecType',
+                          rtPicoHarpT3 if mode == 'T3' else rtPicoHarpT2),
+                _pack_tag('TTResultFormat_BitsPerRecord', 32),
+                _pack_tag('MeasDesc_Resolution', float(resolution)),
+                _pack_tag('MeasDesc_GlobalResolution',
+                          1 / sync_rate if (mode == 'T3' and sync_rate) else float(resolution)),
+                _pack_tag('TTResult_SyncRate', int(sync_rate or 0))]
+        for key, value in metadata.items():
+            if isinstance(value, (bool, int, float, str, np.integer, np.floating)):
+                tags.append(_pack_tag('ZiaLab_' + key, value))
+        self._file.write(b''.join(tags))
+        # remember where the number of records goes
+        self._num_records_pos = self._file.tell() + 40
+        self._file.write(_pack_tag('TTResult_NumberOfRecords', 0))
+        self._file.write(_pack_tag('Header_End', None))
+
+    def write(self, records):
+        '''
+        Append a block of uint32 records.
+        '''
+        records = np.asarray(records, dtype='<u4')
+        records.tofile(self._file)
+        self.num_records += len(records)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.seek(self._num_records_pos)
+            self._file.write(struct.pack('<q', self.num_records))
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+'''
+Calibration of the runways of the PI stage, the distance the stage
+needs to reach a constant speed, so that the markers of a linescan
+come evenly spaced.
+
+The runways are measured once for a set of speeds and kept in a table
+for every stage, by serial number, together with the acceleration and
+deceleration of the stage when it was calibrated. The runway at any
+speed is interpolated from the table, and beyond the calibrated speeds
+it is extrapolated with a fit to
+
+    runway = lag * vel + vel**2 / (2 * acc)
+
+The table is calibrated again when the acceleration or deceleration
+of the stage change, and single speeds are measured again when a
+linescan comes with jittery markers.
+
+Usage
+-----
+table = runway_table(stage, measure)
+e = table(vel)
+'''
+
+import os
+import json
+import numpy as np
+
+RUNWAYS_DIR = os.path.join(os.path.expanduser('~'), '.zialab', 'runways')
+CALIBRATION_VELS = np.array([0.0125, 0.025, 0.05, 0.1, 0.2, 0.4, 0.8]) # in mm/s
+MAX_JITTER = 0.2 # largest relative deviation of the intervals between markers
+
+def stage_serial(stage):
+    '''
+    Serial number of the stage controller from its *IDN? answer,
+    e.g. (c)2015 Physik Instrumente (PI) GmbH & Co. KG, C-867, 0115500000, 1.2.3.0
+    '''
+    fields = [field.strip() for field in stage.qIDN().split(',')]
+    if len(fields) >= 3:
+        return fields[-2]
+    return '_'.join(fields)
+
+def stage_parameters(stage, axis='1'):
+    '''
+    The settings of the stage that the runways depend on.
+    '''
+    return {'acc': float(stage.qACC()[axis]),
+            'dec': float(stage.qDEC()[axis])}
+
+class RunwayTable():
+    '''
+    Runways of a stage at a set of speeds.
+    '''
+
+    def __init__(self, serial, vels, runways, parameters):
+        '''
+        Parameters
+        ----------
+        serial     (str): of the stage controller
+        vels       (np.array): speeds in mm/s
+        runways    (np.array): runways in mm
+        parameters (dict): as given by stage_parameters
+        '''
+        self.serial = serial
+        order = np.argsort(vels)
+        self.vels = np.asarray(vels, dtype=float)[order]
+        self.runways = np.asarray(runways, dtype=float)[order]
+        self.parameters = dict(parameters)
+        self._fit()
+
+    def _fit(self):
+        # least squares fit of runway = lag * vel + vel**2 / (2 * acc)
+        design = np.column_stack([self.vels, self.vels**2])
+        self.coefficients = np.linalg.lstsq(design, self.runways, rcond=None)[0]
+
+    def __call__(self, vel):
+        '''
+        Runway in mm at the speed vel, in mm/s.
+        '''
+        if self.vels[0] <= vel <= self.vels[-1]:
+            return float(np.interp(vel, self.vels, self.runways))
+        return float(max(self.coefficients[0]*vel + self.coefficients[1]*vel**2, 0.))
+
+    def covers(self, vel):
+        '''
+        True if vel is within the calibrated speeds.
+        '''
+        return bool(self.vels[0] <= vel <= self.vels[-1])
+
+    def add(self, vel, runway):
+        '''
+        Add or replace the runway at the speed vel.
+        '''
+        keep = ~np.isclose(self.vels, vel)
+        self.__init__(self.serial, np.append(self.vels[keep], vel),
+                      np.append(self.runways[keep], runway), self.parameters)
+
+    def matches(self, parameters, rtol=1e-3):
+        '''
+        True if the table was calibrated with these stage parameters.
+        '''
+        return all(key in self.parameters
+                   and np.isclose(self.parameters[key], value, rtol=rtol)
+                   for key, value in parameters.items())
+
+    @staticmethod
+    def path(serial, directory=None):
+        directory = RUNWAYS_DIR if directory is None else directory
+        return os.path.join(directory, '%s.json' % serial)
+
+    def save(self, directory=None):
+        directory = RUNWAYS_DIR if directory is None else directory
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path(self.serial, directory), 'w') as f:
+            json.dump({'serial': self.serial,
+                       'vels': self.vels.tolist(),
+                       'runways': self.runways.tolist(),
+                       'parameters': self.parameters}, f, indent=1)
+
+    @classmethod
+    def load(cls, serial, directory=None):
+        '''
+        The table of the stage, None if it has not been calibrated.
+        '''
+        path = cls.path(serial, directory)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            table = json.load(f)
+        return cls(table['serial'], table['vels'], table['runways'], table['parameters'])
+
+def calibrate(stage, measure, vels=CALIBRATION_VELS, directory=None):
+    '''
+    Measure the runways of the stage at the speeds vels and save the table.
+
+    Parameters
+    ----------
+    stage     : the PI stage
+    measure   (function): measure(stage, vel) gives the runway in mm,
+                          e.g. confocal.measure_runway
+    vels      (np.array): in mm/s
+    directory (str): where the tables are kept, RUNWAYS_DIR by default
+
+    Returns
+    -------
+    table (RunwayTable)
+    '''
+    runways = [measure(stage, vel) for vel in vels]
+    table = RunwayTable(stage_serial(stage), vels, runways, stage_parameters(stage))
+    table.save(directory)
+    return table
+
+def runway_table(stage, measure, directory=None, recalibrate=False):
+    '''
+    The saved table of the stage, calibrated first if there is none,
+    if the stage parameters changed, or if recalibrate is True.
+    '''
+    table = None if recalibrate else RunwayTable.load(stage_serial(stage), directory)
+    if table is None or not table.matches(stage_parameters(stage)):
+        print("Calibrating runways...")
+        table = calibrate(stage, measure, directory=directory)
+    return table
+
+def marker_jitter(markers, measured=None):
+    '''
+    Largest relative deviation of the intervals between
+    consecutive markers from their median.
+
+    If measured is given, e.g. by binning.bin_markers, only the
+    intervals between two measured markers are considered, so that
+    missed or repeated markers that were repaired do not count.
+    '''
+    intervals = np.diff(markers).astype(float)
+    if measured is not None:
+        measured = np.asarray(measured, dtype=bool)
+        intervals = intervals[measured[:-1] & measured[1:]]
+    if len(intervals) < 2:
+        return 0.
+    median = np.median(intervals)
+    if median <= 0:
+        return np.inf
+    return float(np.max(np.abs(intervals/median - 1)))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+'''
+An on-disk store for confocal scans, written row by row as the
+rows are finished, so that a scan that is interrupted can be resumed
+from the last finished row and its memory use does not grow with
+the number of photons.
+
+A store is a directory with
+    manifest.json    : the parameters of the scan and its progress
+    final_map.npy    : rates in kcps
+    counts_map.npy   : photons per pixel
+    exposure_map.npy : exposure per pixel in s
+    flim_cube.npy    : pixel x microtime histograms, if the scan has flim_bins
+    rows/            : the raw records of every row, compressed
+
+The maps are .npy files memory mapped for writing, and the manifest
+is replaced atomically after every row, so that whatever is in the
+manifest is on disk.
+
+Usage
+-----
+store = ScanStore.create('scan_01', scan, num_rows, num_cols)
+store.write_row(idx, linescan)
+...
+store = ScanStore.open('scan_01')
+store.rows_done
+'''
+
+import os
+import json
+import numpy as np
+
+MANIFEST = 'manifest.json'
+MAPS = {'final_map': (np.float64, np.nan),
+        'counts_map': (np.int64, 0),
+        'exposure_map': (np.float64, 0.)}
+
+def _jsonable(scan):
+    '''
+    The entries of scan that can be kept in the manifest,
+    scalars, strings, and one dimensional arrays.
+    '''
+    kept = {}
+    for key, value in scan.items():
+        if isinstance(value, np.ndarray):
+            if value.ndim <= 1:
+                kept[key] = value.tolist()
+        elif isinstance(value, np.generic):
+            kept[key] = value.item()
+        elif isinstance(value, (bool, int, float, str, type(None))):
+            kept[key] = value
+        elif isinstance(value, (list, tuple)) and all(
+                isinstance(v, (bool, int, float, str)) for v in value):
+            kept[key] = list(value)
+    return kept
+
+def _to_python(value):
+    if isinstance(value, dict):
+        return {k: _to_python(v) for k, v in value.items()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+class ScanStore():
+    '''
+    The maps, raw records and progress of a scan in a directory.
+    '''
+
+    def __init__(self, path, manifest, mode='r+'):
+        self.path = path
+        self.manifest = manifest
+        names = list(MAPS) + (['flim_cube'] if manifest.get('flim_bins') else [])
+        self.maps = {name: np.lib.format.open_memmap(self._file(name + '.npy'), mode=mode)
+                     for name in names}
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @classmethod
+    def create(cls, path, scan, num_rows, num_cols, flim_bins=None):
+        '''
+        Create the store of a new scan.
+
+        Parameters
+        ----------
+        path      (str): directory of the store, must not have a manifest
+        scan      (dict): parameters of the scan, those that are not
+                          arrays of more than one dimension are kept.
+        num_rows  (int)
+        num_cols  (int)
+        flim_bins (int): microtime bins of the flim cube, if None there is none
+        '''
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            raise ValueError('%s already has a scan, resume it or use another path.' % path)
+        os.makedirs(os.path.join(path, 'rows'), exist_ok=True)
+        shape = (num_rows, num_cols)
+        for name, (dtype, fill) in MAPS.items():
+            array = np.lib.format.open_memmap(os.path.join(path, name + '.npy'),
+                                              mode='w+', dtype=dtype, shape=shape)
+            array[:] = fill
+            array.flush()
+            del array
+        if flim_bins:
+            np.lib.format.open_memmap(os.path.join(path, 'flim_cube.npy'), mode='w+',
+                                      dtype=np.uint32, shape=shape + (flim_bins,)).flush()
+        manifest = {'scan': _jsonable(scan),
+                    'shape': list(shape),
+                    'flim_bins': flim_bins,
+                    'rows_done': 0,
+                    'rows': [],
+                    'elapsed': 0.}
+        store = cls(path, manifest)
+        store._save_manifest()
+        return store
+
+    @classmethod
+    def open(cls, path, mode='r+'):
+        '''
+        Open the store of an existing scan.
+        '''
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        return cls(path, manifest, mode)
+
+    def _save_manifest(self):
+        tmp = self._file(MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self._file(MANIFEST))
+
+    @property
+    def rows_done(self):
+        '''
+        Number of rows finished, rows are finished in order.
+        '''
+        return self.manifest['rows_done']
+
+    @property
+    def num_rows(self):
+        return self.manifest['shape'][0]
+
+    @property
+    def complete(self):
+        return self.rows_done >= self.num_rows
+
+    @property
+    def scan(self):
+        '''
+        The scan as it was given to create, with the maps memory mapped.
+        '''
+        scan = dict(self.manifest['scan'])
+        if 'ys' in scan:
+            scan['ys'] = np.array(scan['ys'])
+        scan.update(self.maps)
+        return scan
+
+    def write_row(self, idx, linescan, elapsed=None):
+        '''
+        Save the raw records of a processed linescan and mark it as
+        finished, its pixels must already be in the maps. The records
+        and events are then dropped from the linescan.
+        '''
+        if idx != self.rows_done:
+            raise ValueError('Row %d finished before row %d.' % (idx, self.rows_done))
+        if 'records' in linescan:
+            np.savez_compressed(self._file(os.path.join('rows', 'row_%05d.npz' % idx)),
+                                records=linescan['records'])
+        for array in self.maps.values():
+            array.flush()
+        self.manifest['rows'].append({'y': float(linescan['y']),
+                                      'xf': float(linescan['xf']),
+                                      'direction': linescan.get('direction', 'forward'),
+                                      'velx': float(linescan['velx']),
+                                      'dwell_time': float(linescan['dwell_time']),
+                                      'trigger_jitter': float(linescan.get('trigger_jitter', np.nan)),
+                                      'marker_repair': _to_python(linescan.get('marker_repair')),
+                                      'fifo_stats': _to_python(linescan.get('fifo_stats'))})
+        self.manifest['rows_done'] = idx + 1
+        if elapsed is not None:
+            self.manifest['elapsed'] = elapsed
+        self._save_manifest()
+        linescan.pop('records', None)
+        linescan.pop('events', None)
+
+    def records(self, idx):
+        '''
+        The raw records of row idx.
+        '''
+        with np.load(self._file(os.path.join('rows', 'row_%05d.npz' % idx))) as row:
+            return row['records']
+
+    def update(self, **entries):
+        '''
+        Add entries, such as results, to the scan in the manifest.
+        '''
+        self.manifest['scan'].update(_jsonable(entries))
+        self._save_manifest()
+
+    def close(self):
+        for array in self.maps.values():
+            array.flush()
+        self.maps = {}
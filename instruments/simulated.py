@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+
+'''
+Simulated PicoHarp 300 and PI stage, to run and benchmark the
+confocal scans of zialab.instruments.confocal without hardware.
+
+The stage follows trapezoidal velocity profiles, lagging behind them
+while it accelerates and settling after, and, when its trigger output
+is configured with CTO and enabled with TRO, sends a marker every
+trigger step. The PicoHarp produces Poisson streams of
+T2 or T3 records, with overflows and the stage markers, with the
+count rate given by a synthetic map of emitters at the position
+of the stage.
+
+Both run on a shared SimClock, which can run faster than real time.
+
+Usage
+-----
+clock = SimClock(speedup=1.)
+sample = EmitterMap.random(num_emitters=20, region=(-0.05, 0.05, -0.05, 0.05))
+stage = SimulatedStage(clock)
+pharp = SimulatedPicoHarp300(stage, sample, clock)
+pharp.open('T3')
+scan = scanner(stage, pharp, scan)
+'''
+
+import contextlib
+import numpy as np
+from time import time
+from zialab.instruments.tttr import encode_t2, encode_t3, T2RESOLUTION
+from zialab.instruments.fifo_worker import FifoWorker
+from zialab.instruments.tttrfile import open_writer
+
+class SimClock():
+    '''
+    Time seen by the simulated instruments, in s, running speedup
+    times faster than the wall clock.
+    '''
+
+    def __init__(self, speedup=1.):
+        self.speedup = speedup
+        self._wall_start = time()
+
+    def now(self):
+        return (time() - self._wall_start) * self.speedup
+
+class EmitterMap():
+    '''
+    Count rate on a sample with Gaussian emitters on a uniform background.
+    '''
+
+    def __init__(self, positions, brightness=50000., sigma=0.0003,
+                 background=2000., lifetime=3e-9):
+        '''
+        Parameters
+        ----------
+        positions  (np.array): (N, 2) positions of the emitters in mm
+        brightness (float or np.array): peak count rate of the emitters in Hz
+        sigma      (float): width of the point spread function in mm
+        background (float): count rate away from the emitters in Hz
+        lifetime   (float): of the emitters in s
+        '''
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.brightness = np.broadcast_to(np.asarray(brightness, dtype=float),
+                                          (len(self.positions),))
+        self.sigma = sigma
+        self.background = background
+        self.lifetime = lifetime
+
+    @classmethod
+    def random(cls, num_emitters, region, seed=None, **kwargs):
+        '''
+        Emitters at random positions in region = (xmin, xmax, ymin, ymax).
+        '''
+        rng = np.random.default_rng(seed)
+        positions = np.column_stack((rng.uniform(region[0], region[1], num_emitters),
+                                     rng.uniform(region[2], region[3], num_emitters)))
+        return cls(positions, **kwargs)
+
+    def signal(self, x, y):
+        '''
+        Count rate from the emitters at the positions x, y.
+        '''
+        x = np.asarray(x, dtype=float)[..., None]
+        y = np.asarray(y, dtype=float)[..., None]
+        r2 = (x - self.positions[:, 0])**2 + (y - self.positions[:, 1])**2
+        return (self.brightness * np.exp(-r2 / (2 * self.sigma**2))).sum(axis=-1)
+
+    def rate(self, x, y):
+        '''
+        Total count rate at the positions x, y.
+        '''
+        return self.signal(x, y) + self.background
+
+class _Motion():
+    '''
+    Trapezoidal motion of one axis.
+    '''
+
+    def __init__(self, start, target, t0, vel, acc):
+        self.start = start
+        self.target = target
+        self.t0 = t0
+        distance = abs(target - start)
+        self.sign = 1. if target >= start else -1.
+        self.t_acc = vel / acc
+        if distance < vel * self.t_acc:
+            # never reaches full speed
+            self.t_acc = np.sqrt(distance / acc)
+            vel = acc * self.t_acc
+        self.vel = vel
+        self.acc = acc
+        self.t_const = (distance - vel * self.t_acc) / vel if vel > 0 else 0.
+        self.duration = 2 * self.t_acc + self.t_const
+
+    def position(self, t):
+        tau = np.clip(np.asarray(t, dtype=float) - self.t0, 0, self.duration)
+        t1 = self.t_acc
+        t2 = self.t_acc + self.t_const
+        d1 = 0.5 * self.acc * t1**2
+        dist = np.where(tau < t1, 0.5 * self.acc * tau**2,
+               np.where(tau < t2, d1 + self.vel * (tau - t1),
+                        d1 + self.vel * self.t_const
+                        + self.vel * (tau - t2) - 0.5 * self.acc * (tau - t2)**2))
+        return self.start + self.sign * dist
+
+    def tracking_error(self, t, tracking, settle_time):
+        '''
+        Error of a servo that follows the motion, -tracking times the
+        acceleration filtered with the time constant settle_time, so
+        that it vanishes at constant speed and decays after every
+        change of the acceleration.
+        '''
+        tau = np.asarray(t, dtype=float) - self.t0
+        error = np.zeros(np.shape(tau))
+        if self.duration == 0 or not tracking:
+            return error
+        # the acceleration steps by +acc, -acc, -acc, +acc at these times
+        steps = ((0., 1.), (self.t_acc, -1.), (self.t_acc + self.t_const, -1.),
+                 (self.duration, 1.))
+        for start, step in steps:
+            after = np.clip(tau - start, 0, None)
+            error -= np.where(tau > start, step * (1 - np.exp(-after / settle_time)), 0.)
+        return self.sign * tracking * self.acc * error
+
+class SimulatedStage():
+    '''
+    A simulated PI stage that answers the GCS commands used by
+    zialab.instruments.confocal: MOV, VEL, qPOS, qVEL, qONT,
+    TRO and CTO through GcsCommandset or send, DRT and qDRR,
+    and batch, whose commands are simply done right away.
+
+    The commanded position follows the velocity profile with a delay
+    lag, the actual position follows the commanded one with an error
+    while the stage accelerates, which settles once it moves at constant
+    speed, so that scans need a runway. Markers are sent when the actual
+    position crosses the trigger positions.
+    '''
+
+    AXES = ('1', '2')
+    AXIS_NAMES = {'1': '1', '2': '2', 'x': '1', 'y': '2'}
+
+    def __init__(self, clock=None, vel=1., acc=10., lag=0.001,
+                 position=(0., 0.), drr_period=0.001, noise=0., serial=0,
+                 tracking=5e-4, settle_time=0.02):
+        '''
+        Parameters
+        ----------
+        clock      (SimClock)
+        vel        (float): initial speed of both axes, mm/s
+        acc        (float): acceleration, mm/s^2
+        lag        (float): delay of the actual position, s
+        position   (tuple): initial position, mm
+        drr_period (float): sampling period of the data recorder, s
+        noise      (float): rms noise of the actual position, mm
+        serial     (int): serial number given by qIDN
+        tracking   (float): error of the actual position per acceleration, s^2
+        settle_time (float): time constant with which the error settles, s
+        '''
+        self.clock = SimClock() if clock is None else clock
+        self.acc = acc
+        self.lag = lag
+        self.drr_period = drr_period
+        self.noise = noise
+        self.serial = serial
+        self.tracking = tracking
+        self.settle_time = settle_time
+        self.vel = {axis: vel for axis in self.AXES}
+        now = self.clock.now()
+        self.motions = {axis: _Motion(p, p, now, vel, acc)
+                        for axis, p in zip(self.AXES, position)}
+        self.cto = {'1': 0.001, '2': '1', '3': 0, '8': 0., '9': 0., '10': 0.}
+        self.tro = {'1': False, '2': False}
+        self._markers = []
+        self._drr_start = None
+        self.bufstate = False
+        self.bufarray = np.zeros((3, 0))
+
+    def _axis(self, axis):
+        return self.AXIS_NAMES[str(axis)]
+
+    def commanded(self, axis, t):
+        return self.motions[self._axis(axis)].position(np.asarray(t) - self.lag)
+
+    def _path(self, motion, t):
+        # actual position of a motion, before the lag
+        return motion.position(t) + motion.tracking_error(t, self.tracking, self.settle_time)
+
+    def actual(self, axis, t):
+        position = self._path(self.motions[self._axis(axis)], np.asarray(t) - self.lag)
+        if self.noise:
+            position = position + np.random.normal(0, self.noise, np.shape(position))
+        return position
+
+    def positions(self, t):
+        '''
+        Actual x and y positions at the times t.
+        '''
+        return self.actual('1', t), self.actual('2', t)
+
+    def MOV(self, axis, position):
+        axis = self._axis(axis)
+        now = self.clock.now()
+        start = float(self.motions[axis].position(now))
+        motion = _Motion(start, float(position), now, self.vel[axis], self.acc)
+        self.motions[axis] = motion
+        if self.tro['2'] and self._axis(self.cto['2']) == axis:
+            # the list is only replaced here, as the picoharp reads it from the FIFO thread
+            self._markers = self._markers[-7:] + [self._trigger_times(motion)]
+
+    def _trigger_times(self, motion):
+        # positions from the start threshold to the stop threshold every trigger step
+        step = abs(float(self.cto['1']))
+        first, last = float(self.cto['8']), float(self.cto['9'])
+        num = int(np.floor(abs(last - first) / step + 1e-6)) + 1
+        targets = first + np.sign(last - first) * step * np.arange(num)
+        lo, hi = sorted((motion.start, motion.target))
+        targets = targets[(targets >= lo) & (targets <= hi)]
+        if motion.duration == 0 or len(targets) == 0:
+            return np.zeros(0)
+        tau = np.linspace(0, motion.duration + 10 * self.settle_time, 20001)
+        # first crossings, the stage may overshoot while it settles
+        path = np.maximum.accumulate(self._path(motion, motion.t0 + tau) * motion.sign)
+        return motion.t0 + self.lag + np.interp(targets * motion.sign, path, tau)
+
+    def marker_times(self, t0, t1):
+        '''
+        Times in [t0, t1) at which markers were sent.
+        '''
+        markers = self._markers
+        if not markers:
+            return np.zeros(0)
+        markers = np.concatenate(markers)
+        return np.sort(markers[(markers >= t0) & (markers < t1)])
+
+    def VEL(self, axis, vel):
+        self.vel[self._axis(axis)] = float(vel)
+
+    def qVEL(self):
+        return dict(self.vel)
+
+    def qACC(self):
+        return {axis: self.acc for axis in self.AXES}
+
+    def qDEC(self):
+        return {axis: self.acc for axis in self.AXES}
+
+    def qIDN(self):
+        return 'Simulated PI stage, C-867, SIM%05d, 0.0\n' % self.serial
+
+    def qPOS(self):
+        now = self.clock.now()
+        return {axis: float(self.actual(axis, now)) for axis in self.AXES}
+
+    def qONT(self):
+        now = self.clock.now() - self.lag
+        return {axis: bool(now >= m.t0 + m.duration) for axis, m in self.motions.items()}
+
+    def GcsCommandset(self, command):
+        words = command.split()
+        if words[0] == 'TRO':
+            self.tro[words[1]] = bool(int(words[2]))
+        elif words[0] == 'CTO':
+            self.cto[words[2]] = words[3] if words[2] == '2' else float(words[3])
+        elif words[0] == 'VEL':
+            self.VEL(words[1], float(words[2]))
+
+    def send(self, command):
+        for line in command.splitlines():
+            self.GcsCommandset(line)
+
+    def batch(self):
+        return contextlib.nullcontext()
+
+    def DRT(self, table, source, value):
+        if str(value) == '1':
+            self._drr_start = self.clock.now()
+        else:
+            self._drr_start = None
+        self.bufstate = False
+
+    def qDRR(self):
+        '''
+        Fill bufarray with the times, and the commanded and actual
+        positions of axis 1 since the data recorder was enabled.
+        '''
+        start = self.clock.now() if self._drr_start is None else self._drr_start
+        times = np.arange(start, self.clock.now(), self.drr_period)
+        self.bufarray = np.array([times, self.commanded('1', times),
+                                  self.actual('1', times)])
+        self.bufstate = True
+
+    @property
+    def bufdata(self):
+        return self.bufarray.tolist()
+
+class SimulatedPicoHarp300():
+    '''
+    A simulated picoharp.PicoHarp300 in T2 or T3 mode.
+
+    Photons arrive as a Poisson process with the rate of the sample at
+    the position of the stage, in T3 their dtimes are exponentially
+    distributed with the lifetime of the emitters (uniform for the
+    background), in T2 they are split evenly between channels 0 and 1.
+    Stage markers come in as special records with the marker bits
+    given by marker.
+    '''
+
+    TTREADMAX = 131072
+    FLAG_FIFOFULL = 0x0003
+
+    def __init__(self, stage, sample, clock=None, sync_rate=20e6,
+                 resolution=4e-12, binning=2, marker=8, step=5e-5,
+                 irf=0.5e-9, seed=None):
+        '''
+        Parameters
+        ----------
+        stage      (SimulatedStage): gives the position and the markers
+        sample     (EmitterMap)
+        clock      (SimClock): by default the clock of the stage
+        sync_rate  (float): laser repetition rate in Hz, T3 only
+        resolution (float): base resolution in s
+        binning    (int): T3 resolution is resolution * 2**binning
+        marker     (int): marker bits of the stage markers
+        step       (float): time step of the rate updates, in s
+        irf        (float): delay of the excitation in s, T3 only
+        '''
+        self.stage = stage
+        self.sample = sample
+        self.clock = stage.clock if clock is None else clock
+        self.sync_rate = sync_rate
+        self.base_resolution = resolution
+        self.binning = binning
+        self.marker = marker
+        self.step = step
+        self.irf = irf
+        self.rng = np.random.default_rng(seed)
+        self.mode = 'T3'
+        self.buffer = np.zeros(self.TTREADMAX, dtype=np.uint32)
+        self._running = False
+        self._pending = np.zeros(0, dtype=np.uint32)
+        self._stop_time = 0.
+
+    @property
+    def resolution(self):
+        if self.mode == 'T3':
+            return self.base_resolution * 2**self.binning
+        return T2RESOLUTION
+
+    def open(self, mode='T3'):
+        self.mode = mode
+
+    def close(self):
+        self._running = False
+
+    def start_measurement(self, acq_time):
+        self._start = self.clock.now()
+        self._stop_time = self._start + acq_time
+        self._generated = self._start
+        self._wraps = 0
+        self._pending = np.zeros(0, dtype=np.uint32)
+        self._running = True
+
+    def stop_measurement(self):
+        self._running = False
+        self._pending = np.zeros(0, dtype=np.uint32)
+
+    def measurement_done(self):
+        return self.clock.now() >= self._stop_time
+
+    def get_flag(self):
+        return 0
+
+    def get_counts(self, channel_0=True, channel_1=True):
+        x, y = self.stage.positions(self.clock.now())
+        rate = int(self.rng.poisson(self.sample.rate(x, y)))
+        if channel_0 and channel_1:
+            return rate, rate
+        elif channel_0:
+            return rate
+        elif channel_1:
+            return rate
+
+    def tttr_header(self):
+        return {'mode': self.mode,
+                'resolution': self.resolution,
+                'sync_rate': self.sync_rate if self.mode == 'T3' else None,
+                'marker_config': None,
+                'simulated': True}
+
+    def _generate(self, t0, t1):
+        # photons and markers from t0 to t1, encoded as records
+        steps = np.arange(t0, t1, self.step)
+        if len(steps) == 0:
+            return np.zeros(0, dtype=np.uint32)
+        widths = np.minimum(steps + self.step, t1) - steps
+        x, y = self.stage.positions(steps + widths / 2)
+        signal = self.sample.signal(x, y)
+        rate = signal + self.sample.background
+        counts = self.rng.poisson(rate * widths)
+        owner = np.repeat(np.arange(len(steps)), counts)
+        times = steps[owner] + self.rng.random(len(owner)) * widths[owner]
+        markers = self.stage.marker_times(t0, t1)
+        times = np.concatenate((times, markers))
+        is_marker = np.concatenate((np.zeros(len(owner), dtype=bool),
+                                    np.ones(len(markers), dtype=bool)))
+        owner = np.concatenate((owner, np.zeros(len(markers), dtype=np.int64)))
+        order = np.argsort(times, kind='stable')
+        times, is_marker, owner = times[order] - self._start, is_marker[order], owner[order]
+        if self.mode == 'T3':
+            from_emitter = self.rng.random(len(times)) < (signal / rate)[owner]
+            delay = np.where(from_emitter,
+                             self.irf + self.rng.exponential(self.sample.lifetime, len(times)),
+                             self.rng.random(len(times)) / self.sync_rate)
+            dtime = np.minimum((delay / self.resolution).astype(np.int64), 4095)
+            channel = np.where(is_marker, 0xF, 1)
+            dtime = np.where(is_marker, self.marker, dtime)
+            truensync = (times * self.sync_rate).astype(np.int64)
+            records, self._wraps = encode_t3(channel, dtime, truensync, self._wraps)
+        else:
+            channel = np.where(is_marker, 0xF, self.rng.integers(0, 2, len(times)))
+            truetime = (times / T2RESOLUTION).astype(np.int64)
+            records, self._wraps = encode_t2(channel, truetime, self.marker & 0xF, self._wraps)
+        return records
+
+    def read_fifo_into(self, out):
+        '''
+        Put the records generated since the last read into out
+        and return the number of records.
+        '''
+        if not self._running:
+            return 0
+        if len(self._pending) == 0:
+            now = min(self.clock.now(), self._stop_time)
+            if now > self._generated:
+                self._pending = self._generate(self._generated, now)
+                self._generated = now
+        num_records = min(len(out), len(self._pending))
+        out[:num_records] = self._pending[:num_records]
+        self._pending = self._pending[num_records:]
+        return num_records
+
+    def buffer_read(self):
+        num_records = self.read_fifo_into(self.buffer)
+        if num_records > 0:
+            return self.buffer[:num_records]
+        else:
+            return None
+
+    def read_buffer(self, output_file):
+        '''
+        Write the records of the measurement to a .tttr or .ptu file.
+        '''
+        header = self.tttr_header()
+        worker = FifoWorker(self, done=self.measurement_done)
+        worker.start()
+        with open_writer(output_file, **header) as writer:
+            for block in worker.blocks():
+                writer.write(block)
+        return worker.stats
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+'''
+Vectorized decoding of the time-tagged time-resolved (TTTR) records
+produced by the PicoHarp 300 in T2 and T3 mode.
+
+Records are taken as uint32 numpy arrays, as they come out of the FIFO,
+and they are decoded with bit masks and shifts instead of going
+through their binary string representation.
+'''
+
+import numpy as np
+
+T2WRAPAROUND = 210698240
+T3WRAPAROUND = 65536
+T2MARKER_CHANNEL = 2 # channel label given to markers in decoded T2 data
+T2RESOLUTION = 4e-12 # s, time unit of the T2 time tags
+
+def decode_t3(records, oflcorrection=0, truensync=0):
+    '''
+    Decode PicoHarp T3 records.
+
+    The bit allocation in the record for the 32bit event is, starting
+    from the MSB:
+          channel:     4 bit
+          dtime:      12 bit
+          nsync:      16 bit
+    The channel code 15 (all bits ones) marks a special record.
+    Special records can be overflows or external markers. To
+    differentiate this, dtime must be checked:
+        If it is zero, the record marks an overflow.
+        If it is >=1 the individual bits are external markers.
+
+    Overflow records keep the truensync of the last record
+    that preceded them.
+
+    Parameters
+    ----------
+    records (np.array): uint32 records as read from the FIFO.
+    oflcorrection (int): overflow correction accumulated in previous records.
+    truensync (int): truensync of the last record previously decoded.
+
+    Returns
+    -------
+    events (np.array): int64 array of shape (N, 4) whose
+    columns are channel, dtime, nsync, and truensync.
+    '''
+    return _decode_t3(records, oflcorrection, truensync)[0]
+
+def _decode_t3(records, oflcorrection, truensync):
+    records = np.asarray(records, dtype=np.uint32)
+    channel = (records >> 28).astype(np.int64)
+    dtime = ((records >> 16) & 0xFFF).astype(np.int64)
+    nsync = (records & 0xFFFF).astype(np.int64)
+    overflows = (channel == 0xF) & (dtime == 0)
+    wraps = np.cumsum(overflows)
+    truensyncs = oflcorrection + wraps * T3WRAPAROUND + nsync
+    # overflows carry over the truensync of the last non-overflow record
+    last = np.where(overflows, 0, np.arange(1, len(records) + 1))
+    np.maximum.accumulate(last, out=last)
+    truensyncs = np.where(last > 0, truensyncs[last - 1], truensync)
+    if len(records):
+        oflcorrection += int(wraps[-1]) * T3WRAPAROUND
+    events = np.column_stack((channel, dtime, nsync, truensyncs))
+    return events, oflcorrection
+
+def decode_t2(records, oflcorrection=0):
+    '''
+    Decode PicoHarp T2 records.
+
+    The bit allocation in the record for the 32bit event is, starting
+    from the MSB:
+          channel:     4 bit
+          time:       28 bit
+    The channel code 15 marks a special record, if its lowest 4 bits
+    are zero then it is an overflow, if not it is a marker. Markers
+    are labeled with channel T2MARKER_CHANNEL and overflows are dropped.
+
+    Parameters
+    ----------
+    records (np.array): uint32 records as read from the FIFO.
+    oflcorrection (int): overflow correction accumulated in previous records.
+
+    Returns
+    -------
+    events (np.array): int64 array of shape (N, 2) whose
+    columns are channel and truetime.
+    '''
+    return _decode_t2(records, oflcorrection)[0]
+
+def _decode_t2(records, oflcorrection):
+    records = np.asarray(records, dtype=np.uint32)
+    channel = (records >> 28).astype(np.int64)
+    time = (records & 0x0FFFFFFF).astype(np.int64)
+    special = (channel == 0xF)
+    overflows = special & ((records & 0xF) == 0)
+    wraps = np.cumsum(overflows)
+    truetime = oflcorrection + wraps * T2WRAPAROUND + time
+    channel[special] = T2MARKER_CHANNEL
+    keep = ~overflows
+    if len(records):
+        oflcorrection += int(wraps[-1]) * T2WRAPAROUND
+    events = np.column_stack((channel[keep], truetime[keep]))
+    return events, oflcorrection
+
+class T3Decoder():
+    '''
+    Decode a stream of T3 records that arrives in chunks, as it is
+    read from the FIFO. The overflow correction and the truensync of
+    the last record are kept between calls, so that decoding chunk
+    by chunk gives the same result as decoding all records at once.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the state, the next chunk is taken as the start of a stream.
+        '''
+        self.oflcorrection = 0
+        self.truensync = 0
+        self.num_records = 0
+
+    def decode(self, records):
+        '''
+        Decode one chunk of records, see decode_t3.
+        '''
+        events, self.oflcorrection = _decode_t3(records,
+                                                self.oflcorrection,
+                                                self.truensync)
+        if len(events):
+            self.truensync = int(events[-1, 3])
+        self.num_records += len(events)
+        return events
+
+class T2Decoder():
+    '''
+    Decode a stream of T2 records that arrives in chunks, as it is
+    read from the FIFO. The overflow correction and the time of
+    the last event are kept between calls.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the state, the next chunk is taken as the start of a stream.
+        '''
+        self.oflcorrection = 0
+        self.truetime = 0
+        self.num_records = 0
+
+    def decode(self, records):
+        '''
+        Decode one chunk of records, see decode_t2.
+        '''
+        records = np.asarray(records, dtype=np.uint32)
+        events, self.oflcorrection = _decode_t2(records, self.oflcorrection)
+        if len(events):
+            self.truetime = int(events[-1, 1])
+        self.num_records += len(records)
+        return events
+
+def encode_t3(channel, dtime, truensync, wraps=0):
+    '''
+    Encode events as PicoHarp T3 records, the inverse of decode_t3.
+    Overflow records are inserted whenever truensync wraps around.
+
+    Parameters
+    ----------
+    channel   (np.array): 15 for markers
+    dtime     (np.array): the marker bits for markers
+    truensync (np.array): sorted
+    wraps     (int): overflows already in the stream before these events
+
+    Returns
+    -------
+    records (np.array): uint32
+    wraps   (int): overflows in the stream after these events
+    '''
+    truensync = np.asarray(truensync, dtype=np.int64)
+    event_wraps = truensync // T3WRAPAROUND
+    words = ((np.asarray(channel, dtype=np.uint32) << 28)
+             | (np.asarray(dtime, dtype=np.uint32) << 16)
+             | (truensync % T3WRAPAROUND).astype(np.uint32))
+    return _insert_overflows(words, event_wraps, wraps)
+
+def encode_t2(channel, truetime, markers=1, wraps=0):
+    '''
+    Encode events as PicoHarp T2 records, the inverse of decode_t2.
+    Overflow records are inserted whenever truetime wraps around.
+
+    Parameters
+    ----------
+    channel  (np.array): 15 for markers
+    truetime (np.array): sorted
+    markers  (int or np.array): marker bits of the markers, they take
+                                the lowest 4 bits of their time.
+    wraps    (int): overflows already in the stream before these events
+
+    Returns
+    -------
+    records (np.array): uint32
+    wraps   (int): overflows in the stream after these events
+    '''
+    channel = np.asarray(channel, dtype=np.uint32)
+    truetime = np.asarray(truetime, dtype=np.int64)
+    event_wraps = truetime // T2WRAPAROUND
+    time = (truetime % T2WRAPAROUND).astype(np.uint32)
+    special = (channel == 0xF)
+    time[special] = (time[special] & ~np.uint32(0xF)) | (np.asarray(markers, dtype=np.uint32) & 0xF)
+    words = (channel << 28) | time
+    return _insert_overflows(words, event_wraps, wraps)
+
+def _insert_overflows(words, event_wraps, wraps):
+    num_overflows = np.diff(np.concatenate(([wraps], event_wraps)))
+    positions = np.arange(len(words)) + np.cumsum(num_overflows)
+    records = np.full(len(words) + int(num_overflows.sum()), 0xF0000000, dtype=np.uint32)
+    records[positions] = words
+    if len(words):
+        wraps = int(event_wraps[-1])
+    return records, wraps
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+'''
+A memory-mapped, chunk-indexed container for raw TTTR records.
+
+A .tttr file has a fixed-size header, a JSON dictionary with
+the mode, resolution, sync rate and marker configuration of the
+measurement, followed by the raw uint32 records as they came
+out of the FIFO. The records are split into chunks of a fixed
+number of records, and a sidecar index (path + '.idx.npz') keeps
+for every chunk the state of the decoder at its start and the time
+of its first event, and for every marker its record and time.
+
+With the index a reader can np.memmap the records and decode
+any time window or range of markers, starting from the chunk that
+contains it, without going through the rest of the file.
+
+Usage
+-----
+with TTTRWriter('scan.tttr', mode='T3', resolution=4e-12) as writer:
+    for block in worker.blocks():
+        writer.write(block)
+
+with TTTRFile('scan.tttr') as tttr:
+    events = tttr.window(t0, t1)
+    row = tttr.between_markers(10, 11)
+'''
+
+import os
+import json
+import numpy as np
+from zialab.instruments.tttr import T2Decoder, T3Decoder
+from zialab.instruments.ptu import PTUFile, PTUWriter, PTU_MAGIC
+
+MAGIC = b'ZTTTR001'
+HEADER_SIZE = 4096
+CHUNK_SIZE = 1048576 # records per chunk
+INDEX_SUFFIX = '.idx.npz'
+
+def _decoder(mode):
+    if mode == 'T3':
+        return T3Decoder()
+    elif mode == 'T2':
+        return T2Decoder()
+    else:
+        raise ValueError('mode must be T2 or T3.')
+
+def _last_time(decoder):
+    if isinstance(decoder, T3Decoder):
+        return decoder.truensync
+    return decoder.truetime
+
+def _set_state(decoder, oflcorrection, last_time):
+    decoder.oflcorrection = int(oflcorrection)
+    if isinstance(decoder, T3Decoder):
+        decoder.truensync = int(last_time)
+    else:
+        decoder.truetime = int(last_time)
+
+def event_times(events, mode):
+    '''
+    The time column of decoded events, truensync in T3 and truetime in T2.
+    '''
+    return events[:, 3] if mode == 'T3' else events[:, 1]
+
+def read_header(path):
+    '''
+    Read the header of a .tttr file, return None if the
+    file does not start with the .tttr magic bytes.
+    '''
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if not raw.startswith(MAGIC):
+        return None
+    return json.loads(raw[len(MAGIC):].decode('utf-8').rstrip('\x00 '))
+
+class _Indexer():
+    '''
+    Keep the decoder state and the index while records are appended.
+    '''
+
+    def __init__(self, mode, chunk_size):
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.decoder = _decoder(mode)
+        self.num_records = 0
+        self.chunk_oflcorrection = []
+        self.chunk_last_time = []
+        self.chunk_start_time = []
+        self.chunk_num_markers = []
+        self.marker_record = []
+        self.marker_time = []
+        self.marker_bits = []
+
+    def add(self, records):
+        '''
+        Index the records, split at the chunk boundaries.
+        '''
+        while len(records):
+            room = self.chunk_size - self.num_records % self.chunk_size
+            piece, records = records[:room], records[room:]
+            new_chunk = (self.num_records % self.chunk_size == 0)
+            if new_chunk:
+                self.chunk_oflcorrection.append(self.decoder.oflcorrection)
+                self.chunk_last_time.append(_last_time(self.decoder))
+                self.chunk_num_markers.append(0)
+            events = self.decoder.decode(piece)
+            if new_chunk:
+                # a chunk without events starts where the previous one ended
+                self.chunk_start_time.append(int(event_times(events, self.mode)[0])
+                                             if len(events) else self.chunk_last_time[-1])
+            self._add_markers(piece, events)
+            self.num_records += len(piece)
+
+    def _add_markers(self, piece, events):
+        special = (piece >> 28) == 0xF
+        if self.mode == 'T3':
+            bits = (piece >> 16) & 0xFFF
+            is_marker = special & (bits != 0)
+            times = events[is_marker, 3]
+        else:
+            bits = piece & 0xF
+            overflow = special & (bits == 0)
+            is_marker = special & ~overflow
+            times = events[is_marker[~overflow], 1]
+        positions = np.flatnonzero(is_marker)
+        self.marker_record.append(positions + self.num_records)
+        self.marker_time.append(times)
+        self.marker_bits.append(bits[is_marker].astype(np.int64))
+        self.chunk_num_markers[-1] += len(positions)
+
+    def save(self, path):
+        empty = [np.zeros(0, dtype=np.int64)]
+        np.savez(path + INDEX_SUFFIX,
+                 num_records=self.num_records,
+                 chunk_size=self.chunk_size,
+                 chunk_oflcorrection=np.array(self.chunk_oflcorrection, dtype=np.int64),
+                 chunk_last_time=np.array(self.chunk_last_time, dtype=np.int64),
+                 chunk_start_time=np.array(self.chunk_start_time, dtype=np.int64),
+                 chunk_num_markers=np.array(self.chunk_num_markers, dtype=np.int64),
+                 marker_record=np.concatenate(self.marker_record + empty).astype(np.int64),
+                 marker_time=np.concatenate(self.marker_time + empty).astype(np.int64),
+                 marker_bits=np.concatenate(self.marker_bits + empty).astype(np.int64))
+
+class TTTRWriter():
+    '''
+    Write raw TTTR records to a .tttr file, indexing them on the fly.
+    The index is saved when the writer is closed.
+    '''
+
+    def __init__(self, path, mode='T3', resolution=None, sync_rate=None,
+                 marker_config=None, chunk_size=CHUNK_SIZE, **metadata):
+        '''
+        Parameters
+        ----------
+        path          (str): name of the .tttr file
+        mode          (str): 'T2' or 'T3'
+        resolution    (float): in s, of dtime in T3 and of the time tags in T2
+        sync_rate     (float): in Hz
+        marker_config (dict): e.g. the marker edges and what each marker means
+        chunk_size    (int): records per chunk of the index
+        metadata      : anything else to be kept in the header, must be JSON serializable.
+        '''
+        self.path = path
+        self.header = {'mode': mode,
+                       'resolution': resolution,
+                       'sync_rate': sync_rate,
+                       'marker_config': marker_config,
+                       'chunk_size': chunk_size,
+                       'record_dtype': '<u4'}
+        self.header.update(metadata)
+        raw = MAGIC + json.dumps(self.header).encode('utf-8')
+        if len(raw) > HEADER_SIZE:
+            raise ValueError('Header is longer than %d bytes.' % HEADER_SIZE)
+        self._indexer = _Indexer(mode, chunk_size)
+        self._file = open(path, 'wb')
+        self._file.write(raw.ljust(HEADER_SIZE, b' '))
+
+    def write(self, records):
+        '''
+        Append a block of uint32 records.
+        '''
+        records = np.asarray(records, dtype=np.uint32)
+        self._indexer.add(records)
+        records.astype('<u4', copy=False).tofile(self._file)
+
+    @property
+    def num_records(self):
+        return self._indexer.num_records
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            self._indexer.save(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def open_writer(path, **header):
+    '''
+    A PTUWriter if path ends in .ptu, a TTTRWriter otherwise,
+    header are the arguments of either.
+    '''
+    if path.lower().endswith('.ptu'):
+        return PTUWriter(path, **header)
+    return TTTRWriter(path, **header)
+
+def build_index(path, block_size=CHUNK_SIZE):
+    '''
+    (Re)build the index of a .tttr file, e.g. if the writer
+    was not closed properly.
+    '''
+    header = read_header(path)
+    if header is None:
+        raise ValueError('%s is not a .tttr file.' % path)
+    indexer = _Indexer(header['mode'], header['chunk_size'])
+    records = _memmap_records(path)
+    for start in range(0, len(records), block_size):
+        indexer.add(np.asarray(records[start:start + block_size]))
+    indexer.save(path)
+
+def convert(inputfile, path, mode='T3', block_size=CHUNK_SIZE, **header):
+    '''
+    Convert a file with bare records, such as the .out files
+    written by picoharp.read_buffer, to a .tttr file.
+    '''
+    records = np.memmap(inputfile, dtype='<u4', mode='r') if os.path.getsize(inputfile) else []
+    with TTTRWriter(path, mode=mode, **header) as writer:
+        for start in range(0, len(records), block_size):
+            writer.write(records[start:start + block_size])
+
+def _memmap_records(path):
+    if os.path.getsize(path) <= HEADER_SIZE:
+        return np.zeros(0, dtype='<u4')
+    return np.memmap(path, dtype='<u4', mode='r', offset=HEADER_SIZE)
+
+class TTTRFile():
+    '''
+    Read a .tttr file, the records are memory mapped and only
+    the requested ones are decoded.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        if self.header is None:
+            raise ValueError('%s is not a .tttr file.' % path)
+        self.mode = self.header['mode']
+        self.records = _memmap_records(path)
+        if not os.path.exists(path + INDEX_SUFFIX):
+            build_index(path)
+        with np.load(path + INDEX_SUFFIX) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.chunk_size = int(self.index['chunk_size'])
+        if int(self.index['num_records']) != len(self.records):
+            raise ValueError('The index of %s is out of date, rebuild it with build_index.' % path)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def num_markers(self):
+        return len(self.index['marker_record'])
+
+    def decoder_at(self, chunk):
+        '''
+        A decoder with the state it has at the start of the chunk.
+        '''
+        decoder = _decoder(self.mode)
+        _set_state(decoder, self.index['chunk_oflcorrection'][chunk],
+                   self.index['chunk_last_time'][chunk])
+        return decoder
+
+    def read(self, start=0, stop=None):
+        '''
+        Decode the records from start to stop.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return _decoder(self.mode).decode(np.zeros(0, dtype=np.uint32))
+        chunk = start // self.chunk_size
+        decoder = self.decoder_at(chunk)
+        # bring the decoder from the start of the chunk to the first record
+        decoder.decode(self.records[chunk * self.chunk_size:start])
+        return decoder.decode(self.records[start:stop])
+
+    def chunks(self, start=0, stop=None):
+        '''
+        Yield the decoded records from start to stop,
+        at most one chunk at a time.
+        '''
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        chunk = start // self.chunk_size
+        decoder = self.decoder_at(chunk)
+        decoder.decode(self.records[chunk * self.chunk_size:start])
+        while start < stop:
+            end = min((start // self.chunk_size + 1) * self.chunk_size, stop)
+            yield decoder.decode(self.records[start:end])
+            start = end
+
+    def window(self, t0, t1):
+        '''
+        Decoded events with times (truensync in T3, truetime in T2)
+        in [t0, t1).
+        '''
+        start_time = self.index['chunk_start_time']
+        first = max(int(np.searchsorted(start_time, t0, side='right')) - 1, 0)
+        last = int(np.searchsorted(start_time, t1, side='left'))
+        events = self.read(first * self.chunk_size, last * self.chunk_size)
+        times = event_times(events, self.mode)
+        return events[np.searchsorted(times, t0):np.searchsorted(times, t1)]
+
+    def markers(self):
+        '''
+        Return the records, times and bits of all markers.
+        '''
+        return (self.index['marker_record'], self.index['marker_time'],
+                self.index['marker_bits'])
+
+    def between_markers(self, m0, m1):
+        '''
+        Decoded events from marker m0 up to, but not including, marker m1.
+        '''
+        marker_record = self.index['marker_record']
+        stop = marker_record[m1] if m1 < len(marker_record) else len(self)
+        return self.read(int(marker_record[m0]), int(stop))
+
+    def close(self):
+        self.records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_records(path):
+    '''
+    The raw records of a .tttr file, a PicoQuant .ptu file,
+    or a file of bare records, memory mapped.
+    '''
+    if read_header(path) is not None:
+        return _memmap_records(path)
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+    if magic == PTU_MAGIC:
+        return PTUFile(path).records
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype='<u4')
+    return np.memmap(path, dtype='<u4', mode='r')
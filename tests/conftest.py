@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the tests import the package as zialab, as the rest of the codebase does
+codebase_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if codebase_dir not in sys.path:
+    sys.path.insert(0, codebase_dir)
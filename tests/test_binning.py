@@ -0,0 +1,26 @@
+import numpy as np
+from zialab.analysis import binning
+from zialab.instruments import runways
+
+PERIOD = 1000
+
+def jitter(markers, expected):
+    photons = np.arange(0, markers[-1] + PERIOD, 7)
+    binned = binning.bin_markers(photons, markers, expected=expected, dwell_time=1e-3)
+    return runways.marker_jitter(binned['boundaries'], binned['measured'])
+
+def test_repaired_markers_are_not_jitter():
+    markers = np.arange(50) * PERIOD
+    missing = np.delete(markers, 20)
+    duplicated = np.sort(np.append(markers, markers[20] + 3))
+    assert runways.marker_jitter(missing) >= 1.
+    assert jitter(missing, 50) == 0.
+    assert jitter(duplicated, 50) == 0.
+    # a marker missed at the end is appended
+    assert jitter(markers[:-1], 50) == 0.
+
+def test_uneven_speed_is_jitter():
+    intervals = np.full(49, PERIOD)
+    intervals[-5:] = [1100, 1200, 1300, 1350, 1400] # slowing down before the end
+    markers = np.concatenate([[0], np.cumsum(intervals)])
+    assert jitter(markers, 50) > runways.MAX_JITTER
@@ -0,0 +1,33 @@
+import numpy as np
+from zialab.instruments import confocal
+from zialab.instruments.tttr import T2RESOLUTION
+
+def t2_linescan(direction, lag=30., offset=3.7, spot=(0.0124, 0.0128)):
+    # a T2 linescan at constant speed from 0 to 0.02 mm with 1 um pixels,
+    # times in ms, the picoharp clock starting offset ms after the data recorder,
+    # the sample seeing the stage lag ms late, and photons only from the spot
+    linescan = {'xi': 0., 'xf': 0.02, 'dx': 0.001, 'e': 0.002, 'velx': 0.01,
+                'direction': direction}
+    confocal.set_line_geometry(linescan)
+    velocity = linescan['velx'] / 1e3 # mm/ms
+    sign = -1 if direction == 'backward' else 1
+    times = np.arange(0., linescan['ts'] * 1e3, 0.1)
+    positions = linescan['start'] + sign * velocity * times
+    triggers = linescan['first_trigger'] + sign * linescan['dx'] * np.arange(linescan['N'])
+    trigger_times = np.abs(triggers - linescan['start']) / velocity
+    photon_times = np.arange(0., times[-1], 0.001)
+    seen = linescan['start'] + sign * velocity * (photon_times - lag)
+    photon_times = photon_times[(seen >= spot[0]) & (seen < spot[1])]
+    to_t2 = lambda t: np.round((t + offset) / (T2RESOLUTION * 1e3)).astype(np.int64)
+    linescan['events'] = to_t2(photon_times)
+    linescan['bintimes'] = to_t2(trigger_times + lag) # as given by bin_markers with the lag
+    linescan['trajectory'] = {'times': times, 'actual_positions': positions,
+                              'commanded_positions': positions}
+    return linescan
+
+def test_trajectory_rows_align_in_both_directions():
+    forward, _ = confocal.trajectory_row(t2_linescan('forward'))
+    backward, _ = confocal.trajectory_row(t2_linescan('backward'))
+    assert forward.sum() > 0 and backward.sum() > 0
+    assert np.argmax(forward) == np.argmax(backward) == 12
+    assert forward[12] == forward.sum() and backward[12] == backward.sum()
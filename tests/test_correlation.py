@@ -0,0 +1,18 @@
+import warnings
+import numpy as np
+from zialab.analysis import correlation
+
+def test_g2_without_photons():
+    lags, g2 = correlation.g2(np.zeros((0, 2), dtype=np.int64), 100, 10)
+    assert len(lags) == len(g2) and not g2.any()
+    # photons in only one of the channels
+    events = np.array([[0, 5], [0, 50]], dtype=np.int64)
+    lags, g2 = correlation.g2(events, 100, 10)
+    assert not g2.any()
+
+def test_g2_of_a_single_event_is_finite():
+    events = np.array([[0, 5]], dtype=np.int64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)
+        lags, g2 = correlation.g2(events, 100, 10, channels=(0, 0))
+    assert np.all(np.isfinite(g2))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from zialab.analysis import flim
+
+def line_events(dtimes):
+    # a marker, one photon per dtime, and a closing marker
+    marker = [0xF, 8, 0, 0]
+    events = [marker]
+    events += [[0, d, 0, 10 + i] for i, d in enumerate(dtimes)]
+    events.append([0xF, 8, 0, 10 + len(dtimes)])
+    return np.array(events, dtype=np.int64)
+
+def test_flim_cube_bins_dtimes():
+    events = line_events([0, 15, 16, 4095])
+    cube = flim.flim_cube(events, num_bins=256)
+    assert cube.shape == (1, 256)
+    assert cube[0, 0] == 2 and cube[0, 1] == 1 and cube[0, 255] == 1
+
+@pytest.mark.parametrize('num_bins', [300, 0, -4, 8192])
+def test_num_bins_has_to_divide_dtimes(num_bins):
+    events = line_events([0, 4095])
+    with pytest.raises(ValueError):
+        flim.flim_cube(events, num_bins=num_bins)
+    with pytest.raises(ValueError):
+        flim.microtimes(num_bins)
@@ -0,0 +1,16 @@
+import numpy as np
+from zialab.analysis import localization
+
+def test_hot_pixel_is_not_an_emitter():
+    rng = np.random.default_rng(0)
+    v, u = np.mgrid[0:40, 0:40]
+    image = 10. + 100. * np.exp(-((u - 25.3)**2 + (v - 12.6)**2) / (2 * 1.8**2))
+    image = rng.poisson(image).astype(float)
+    image[30, 8] = 30. # hot pixel
+    emitters = localization.localize(image)
+    good = emitters['ok']
+    assert good.sum() == 1
+    assert abs(emitters['x'][good][0] - 25.3) < 0.3
+    assert abs(emitters['y'][good][0] - 12.6) < 0.3
+    hot = (emitters['row'] == 30) & (emitters['col'] == 8)
+    assert hot.sum() == 1 and not emitters['ok'][hot][0]
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from zialab.instruments import confocal, mosaic
+
+@pytest.mark.parametrize('region, dx, tile_size, overlap', [
+    ((0., 1., 0., 1.), 0.001, 0.05, 0.005),
+    ((0.1, 0.1733, -0.02, 0.0411), 0.0005, 0.02, 0.002),
+    ((0., 0.01, 0., 0.03), 0.001, 0.02, 0.004)])
+def test_tiles_lie_inside_the_region(region, dx, tile_size, overlap):
+    xi, xf, yi, yf = region
+    tiles = mosaic.plan_tiles(region, dx, tile_size, overlap)
+    # the region rounded up to the pixel grid
+    xf_grid = xi + np.ceil((xf - xi) / dx - 1e-6) * dx
+    yf_grid = yi + np.ceil((yf - yi) / dx - 1e-6) * dx
+    for tile in tiles:
+        assert tile['xi'] >= xi - 1e-9 and tile['xf'] <= xf_grid + 1e-9
+        assert tile['yi'] >= yi - 1e-9 and tile['yf'] <= yf_grid + 1e-9
+        for edge, origin in [('xi', xi), ('xf', xi), ('yi', yi), ('yf', yi)]:
+            pixels = (tile[edge] - origin) / dx
+            assert abs(pixels - round(pixels)) < 1e-6
+    # and they cover it, overlapping by at least the overlap
+    assert max(t['xf'] for t in tiles) == pytest.approx(xf_grid)
+    assert max(t['yf'] for t in tiles) == pytest.approx(yf_grid)
+    columns = sorted({(t['xi'], t['xf']) for t in tiles})
+    for (_, previous_xf), (next_xi, _) in zip(columns, columns[1:]):
+        assert previous_xf - next_xi >= min(overlap, tile_size) - 1e-9
+
+def test_tiles_fill_the_mosaic(tmp_path):
+    region = (0., 0.06, 0., 0.05)
+    dx = 0.001
+    tiles = mosaic.plan_tiles(region, dx, 0.02, 0.004)
+    shape = (int(round((region[3] - region[2]) / dx)), int(round((region[1] - region[0]) / dx)))
+    pyramid = mosaic.PyramidFile.create(str(tmp_path / 'mosaic'), shape, dx, (region[0], region[2]))
+    truth = np.arange(shape[0] * shape[1], dtype=float).reshape(shape)
+    for tile in tiles:
+        # a tile with the geometry of confocal.scanner, mosaic_scanner sets grid_rows
+        scan = confocal.row_positions(dict(tile, dx=dx, grid_rows=True))
+        num_cols = int(np.ceil((scan['xf'] - scan['xi']) / dx - 1e-6))
+        row, col = int(round(scan['yi'] / dx)), int(round(scan['xi'] / dx))
+        scan['final_map'] = truth[row:row + scan['Ny'], col:col + num_cols]
+        # what is already in the mosaic lines up with the tile
+        patch = mosaic.tile_patch(pyramid, scan)
+        known = np.isfinite(patch)
+        assert np.array_equal(patch[known], scan['final_map'][known])
+        mosaic.place_tile(pyramid, scan)
+    assert np.array_equal(np.array(pyramid.levels[0]), truth.astype(np.float32))
@@ -0,0 +1,37 @@
+import numpy as np
+from zialab.instruments import confocal, multires
+
+def pass_scan(params, roi, dx):
+    # a pass as multires_scanner gives it to confocal.scanner, with
+    # the geometry that the scanner computes and a map of distinct values
+    xi, xf, yi, yf = roi
+    scan = confocal.row_positions(multires._pass(params, 'roi', xi=xi, xf=xf, yi=yi, yf=yf, dx=dx))
+    num_cols = int(np.ceil((scan['xf'] - scan['xi']) / scan['dx']))
+    scan['final_map'] = np.arange(scan['Ny'] * num_cols, dtype=float).reshape(scan['Ny'], num_cols)
+    return scan
+
+def test_place_scan_fills_every_row_once():
+    region = (0., 0.05, 0., 0.05)
+    dx = 0.0005
+    level = multires.empty_level(region, dx)
+    roi = multires.snap_roi((0.0123, 0.0311, 0.0071, 0.0269), (region[0], region[2]), dx)
+    scan = pass_scan({'xi': 0., 'xf': 0.05, 'yi': 0., 'yf': 0.05}, roi, dx)
+    multires.place_scan(level, scan)
+    filled = np.isfinite(level['map'])
+    rows = np.flatnonzero(filled.any(axis=1))
+    cols = np.flatnonzero(filled.any(axis=0))
+    # the filled pixels are exactly the pixels of the region of interest
+    assert rows[0] == round((roi[2] - region[2]) / dx) and rows[-1] == round((roi[3] - region[2]) / dx) - 1
+    assert cols[0] == round((roi[0] - region[0]) / dx) and cols[-1] == round((roi[1] - region[0]) / dx) - 1
+    assert filled.sum() == len(rows) * len(cols)
+    # and every pixel of the scan is in one of them
+    assert np.array_equal(np.sort(level['map'][filled]), np.ravel(scan['final_map']))
+
+def test_coarse_and_fine_levels_line_up():
+    region = (0., 0.02, 0., 0.02)
+    coarse = multires.empty_level(region, 0.002)
+    fine = multires.empty_level(region, 0.0005)
+    multires.place_scan(coarse, pass_scan({}, region, 0.002))
+    multires.place_scan(fine, pass_scan({}, region, 0.0005))
+    assert np.isfinite(coarse['map']).all() and np.isfinite(fine['map']).all()
+    assert fine['map'].shape[0] == 4 * coarse['map'].shape[0]
@@ -0,0 +1,20 @@
+import numpy as np
+from zialab.instruments import confocal
+from zialab.instruments.simulated import SimClock, SimulatedStage
+
+def test_simulated_stage_needs_a_runway():
+    stage = SimulatedStage(SimClock(speedup=10.))
+    runway_slow = confocal.measure_runway(stage, 0.05)
+    runway_fast = confocal.measure_runway(stage, 0.3)
+    assert 0 < runway_slow < runway_fast
+
+def test_tracking_error_settles():
+    stage = SimulatedStage(SimClock(speedup=10.))
+    stage.VEL('1', 0.3)
+    stage.MOV('1', 0.1)
+    motion = stage.motions['1']
+    times = motion.t0 + stage.lag + np.array([0.02, motion.t_acc + 0.2, motion.duration + 0.2])
+    error = stage.actual('1', times) - stage.commanded('1', times)
+    # behind while accelerating, on the commanded path at constant speed and after settling
+    assert error[0] < -1e-3
+    assert np.all(np.abs(error[1:]) < 1e-5)